@@ -18,101 +18,309 @@ import json
 import csv
 
 import apiaccess as aa
-from operator import itemgetter as iget
+import datastore
+import identity
+import matchups
+import ratings
+import statsengine as se
+from metrics import METRICS, METRICS_FILE
+from operator import attrgetter, itemgetter
 
-from constants import BASE, SHORTRACES
+from constants import RACES, ACADEMY
+
+
+GAME_KEYS = ['id', 'name', 'status', 'datecreated', 'dateended', 'turn', 'winner', 'race']
 
 
 def get_winner_race(data, gameid, playername):
-    if  type(gameid) is int:
-        gameid = str(gameid)
-    if data['games'][gameid]['status'] == 'Finished':
-        return data['players'][playername][gameid]['race'][0]
+    game = data.games[int(gameid)]
+    if game.status == 'Finished' and playername in data.players:
+        return RACES[data.players[playername].games[game.id].races[0]]
     return 'No Race'
 
 
+def game_rows(data):
+    """Return the game overview rows of a data set, oldest game first
+    """
+    rows = []
+    for game in sorted(data.games.values(), key=attrgetter('datecreated')):
+        row = game.to_dict()
+        row['race'] = get_winner_race(data, game.id, game.winner)
+        rows.append(row)
+    return rows
+
+
+def game_csv(csvfile, rows, fieldnames=GAME_KEYS):
+    """Write game overview rows as CSV to an open file
+    """
+    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+
+
+def write_game_rows(rows, fieldnames, filename='game_stats.csv'):
+    """Write game overview rows to a CSV file
+    """
+    with METRICS.timer('CSV write'), open(filename, 'w', newline='') as csvfile:
+        game_csv(csvfile, rows, fieldnames)
+
+
 def write_games_csv(data, fieldnames, filename='game_stats.csv'):
     """Write out the game overview dict to a CSV file
     """
-    gamelist = []
-    for game, gamedata in data['games'].items():
-        gamelist.append(gamedata)
-    # print (gamelist)
-    gamelist.sort(key=iget('datecreated'))
-
-    with open(filename, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        writer.writeheader()
-        for game in gamelist:
-            game['race'] = get_winner_race(data, game['id'], game['winner'])
-            writer.writerow(game)
-
-
-def write_per_player_stats(data, filename='player_stats.csv'):
-    playerkeys = ['name']
-    endstates = [' finished', ' won', ' dropped', ' resigned', ' died']
-    statlist = []
-    for stat in endstates:
-        for key, race in SHORTRACES.items():
-            statlist.append(race + stat)
-        statlist.append('Sum' + stat)
-
-    playerkeys += statlist
-
-    players = data['players']
-    allstats = {}
-    i = 0
-    for player, playerdata in players.items():
-        allstats[player] = {}
-        playerstat = allstats[player]
-        playerstat['name'] = player
-        # Initialize all entries first!
-        for stat in statlist:
-            playerstat[stat] = 0
-        for game, stats in playerdata.items():
-            # ASSUMPTION! We only use the first race we find
-            if game == 'accountid':
-                continue
-
-            race = SHORTRACES[stats['race'][0]]
-            if 'score' in stats.keys() and stats['score']['finished'] == 1:
-                if stats['score']['rank'] == 1:
-                    playerstat[race + ' won'] += 1
-                playerstat[race + ' finished'] += 1
-            for s in stats['status']:
-                if s['what'] == 'dead':
-                    playerstat[race + ' died'] += 1
-                elif s['what'] == 'dropped':
-                    playerstat[race + ' dropped'] += 1
-                elif s['what'] == 'resigned':
-                    playerstat[race + ' resigned'] += 1
-        for stat in endstates:
-            playerstat['Sum' + stat] = sum(playerstat[race + stat] for race in SHORTRACES.values())
-        aa.print_progress(i+1, len(players), prefix = 'Gather player stats:', suffix = 'Done')
-        i += 1
-    
-    # print (allstats)
-    with open(filename, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=playerkeys)
-        
-        writer.writeheader()
-        for player, stats in allstats.items():
-            writer.writerow(stats)
-            
-    
+    write_game_rows(game_rows(data), fieldnames, filename)
+
+
+def write_stats(names, counts, filename='player_stats.csv', races=None):
+    """Write a players x races x endstates count array to a CSV file,
+    races are all races unless a list of race IDs is given
+    """
+    with METRICS.timer('player stats'):
+        table = se.stats_table(counts, races).tolist()
+
+    with METRICS.timer('CSV write'), open(filename, 'w', newline='') as csvfile:
+        stats_csv(csvfile, names, table, races)
+
+
+def stats_csv(csvfile, names, table, races=None):
+    """Write rows of se.stats_table() as CSV to an open file
+    """
+    writer = csv.writer(csvfile)
+
+    writer.writerow(['name'] + se.stats_columns(races))
+    for name, row in zip(names, table):
+        writer.writerow([name] + row)
+
+
+def write_per_player_stats(data, filename='player_stats.csv', races=None):
+    """Write per player and race counts of finished, won, dropped,
+    resigned and dead games to a CSV file
+    """
+    with METRICS.timer('player stats'):
+        names, counts = se.player_race_counts(data)
+    write_stats(names, counts, filename, races)
+
+
+def write_ratings(conn, filename='player_ratings.csv', kind=ratings.PLAYER):
+    """Write the current ratings of players or races to a CSV file,
+    best first
+    """
+    table = ratings.rating_table(conn, kind)
+    with METRICS.timer('CSV write'), open(filename, 'w', newline='') as csvfile:
+        ratings_csv(csvfile, table, kind)
+
+
+def ratings_csv(csvfile, table, kind=ratings.PLAYER):
+    """Write rows of ratings.rating_table() as CSV to an open file
+    """
+    writer = csv.writer(csvfile)
+
+    writer.writerow(['name' if kind == ratings.PLAYER else 'race', 'rating', 'games'])
+    for name, rating, games in table:
+        writer.writerow([name, round(rating, 1), games])
+
+
+def matchup_csv(csvfile, rows):
+    """Write rows of matchups.matchup_rows() as CSV to an open file
+    """
+    writer = csv.writer(csvfile)
+
+    writer.writerow(['race', 'opponent', 'games', 'wins', 'win rate', 'ahead rate', 'average rank'])
+    writer.writerows(rows)
+
+
+def head_to_head_csv(csvfile, rows):
+    """Write rows of matchups.head_to_head_rows() as CSV to an open file
+    """
+    writer = csv.writer(csvfile)
+
+    writer.writerow(['player', 'opponent', 'games', 'wins', 'ahead', 'behind'])
+    writer.writerows(rows)
+
+
+def rate_shard(gametype, rerate=False):
+    """Rate the games of a shard finished since the last update
+
+    Does nothing for a shard that only has a snapshot.
+
+    Args:
+        gametype (int): Game type, see constants.GAME_TYPES
+        rerate (bool, optional): Rate all games again
+
+    Returns:
+        int: Number of rated games, see ratings.update_ratings()
+    """
+    db_file = aa.shard_file(aa.DB_FILE, gametype)
+    if not os.path.exists(db_file):
+        return 0
+    conn = datastore.connect(db_file)
+    rated = ratings.update_ratings(conn, rerate)
+    conn.close()
+    return rated
+
+
+def read_shard(gametype, index=None, data=None):
+    """Read what the reports need from the shard of one game type
+
+    The game overview, the per player counts and the matchups come
+    from the aggregates of the data store, see write_reports(). Nothing
+    is written, the ratings are read as they were last updated, see
+    rate_shard().
+
+    Every shard names players on its own, so the same account can have
+    different names in two shards and two accounts the same one. Player
+    names are therefore resolved by account ID with `index`, which the
+    caller shares between all shards of a report, see share_names().
+
+    Args:
+        gametype (int): Game type, see constants.GAME_TYPES
+        index (identity.IdentityIndex, optional): Names shared by all
+            shards read so far, a new one if not given
+        data (model.Dataset, optional): The games of the type if the
+            caller already loaded them, only used if there is no data
+            store but just a snapshot
+
+    Returns:
+        rows (list): Game overview rows, not sorted
+        counts (tuple): (names, counts) as returned by se.stored_counts()
+        tables (dict): Rows of ratings.rating_table() by kind, None if
+            the shard only has a snapshot
+        matches (tuple): (race rows, pair rows) of the matchups, see
+            datastore.load_matchups()
+        names (dict): Shared name by the name in the shard
+        None if there is no stored data for the game type
+    """
+    if index is None:
+        index = identity.IdentityIndex()
+    db_file = aa.shard_file(aa.DB_FILE, gametype)
+    if not os.path.exists(db_file):
+        if data is None:
+            data = aa.load_offline(gametype)
+        if data is None:
+            return None
+        with METRICS.timer('player stats'):
+            shard = game_rows(data), se.player_race_counts(data), None, matchups.count_matchups(data)
+        accounts = [(name, player.accountid) for name, player in data.players.items()]
+        return share_names(shard, accounts, index)
+    conn = datastore.connect(db_file)
+    with METRICS.timer('load'):
+        rows = list(datastore.game_index(conn))
+        counts = se.stored_counts(*datastore.load_player_counts(conn))
+        matches = datastore.load_matchups(conn)
+        accounts = datastore.load_accounts(conn)
+    tables = {kind: ratings.rating_table(conn, kind) for kind in (ratings.PLAYER, ratings.RACE)}
+    conn.close()
+    return share_names((rows, counts, tables, matches), accounts, index)
+
+
+def share_names(shard, accounts, index):
+    """Rename the players of a shard to the names shared by all shards
+
+    An account gets the name it was first seen with in any shard, so it
+    is counted as one player over all of them, and a name used by two
+    accounts is made unique as in the data store.
+
+    Args:
+        shard (tuple): (rows, counts, tables, matches), see read_shard()
+        accounts (list): (name, account ID) of all players of the shard,
+            oldest first
+        index (identity.IdentityIndex): Shared names, updated here
+
+    Returns:
+        tuple: The shard with the shared names, see read_shard()
+    """
+    names = {name: index.resolve(accountid, name) for name, accountid in accounts}
+    rows, (counted, counts), tables, (race_rows, pair_rows) = shard
+    rows = [dict(row, winner=names.get(row['winner'], row['winner'])) for row in rows]
+    counted = [names.get(name, name) for name in counted]
+    if tables is not None:
+        tables = dict(tables)
+        tables[ratings.PLAYER] = [(names.get(name, name), rating, games)
+                                  for name, rating, games in tables[ratings.PLAYER]]
+    pair_rows = [(names.get(name, name), names.get(other, other), *pair)
+                 for name, other, *pair in pair_rows]
+    return rows, (counted, counts), tables, (race_rows, pair_rows), names
+
+
+def write_reports(gametypes, offline=False, rerate=False):
+    """Write the game overview, per player statistics and matchups over
+    the shards of several game types
+
+    All are read from the aggregates the data store keeps up to date
+    with every synced game, so no games or players need to be loaded and
+    nothing is counted again. Only a shard that has no data store but
+    just a snapshot is loaded and counted in full.
+
+    Ratings are updated with the games finished since the last run, or
+    all rated again if `rerate` is set, and written per game type to
+    player_ratings.csv and race_ratings.csv, see aa.shard_file() for the
+    names of the other types. Race matchups and head-to-head results
+    over all game types go to race_matchups.csv and head_to_head.csv.
+    Returns False if there is no data for any of the game types.
+    """
+    rows = []
+    parts = []
+    matches = []
+    index = identity.IdentityIndex()
+    for gametype in gametypes:
+        if not offline and aa.sync_games(gametype=gametype) is None:
+            continue
+        rate_shard(gametype, rerate)
+        shard = read_shard(gametype, index)
+        if shard is None:
+            continue
+        rows += shard[0]
+        parts.append(shard[1])
+        matches.append(shard[3])
+        if shard[2] is not None:
+            for kind, filename in ((ratings.PLAYER, 'player_ratings.csv'),
+                                   (ratings.RACE, 'race_ratings.csv')):
+                with METRICS.timer('CSV write'), \
+                        open(aa.shard_file(filename, gametype), 'w', newline='') as csvfile:
+                    ratings_csv(csvfile, shard[2][kind], kind)
+    if not parts:
+        return False
+
+    rows.sort(key=itemgetter('datecreated'))
+    write_game_rows(rows, GAME_KEYS)
+    with METRICS.timer('player stats'):
+        names, counts = se.merge_counts(parts)
+    races = se.report_races(gametypes)
+    write_stats(names, counts, races=races)
+
+    with METRICS.timer('matchups'):
+        matrix, pairs = matchups.merge_matchups(matches)
+        race_rows = matchups.matchup_rows(matrix, races)
+        pair_rows = matchups.head_to_head_rows(pairs)
+    with METRICS.timer('CSV write'):
+        with open('race_matchups.csv', 'w', newline='') as csvfile:
+            matchup_csv(csvfile, race_rows)
+        with open('head_to_head.csv', 'w', newline='') as csvfile:
+            head_to_head_csv(csvfile, pair_rows)
+    return True
+
 
 # Wrappers for the different data filter tools
 # [TODO markus] Make these into a class!
 def game_writer(gamedata):
-    gamekeys = ['id', 'name', 'status', 'datecreated', 'dateended', 'turn', 'winner', 'race']
-
-    write_games_csv(gamedata, gamekeys)
+    write_games_csv(gamedata, GAME_KEYS)
     
 
 if __name__ == "__main__":
-    gamedata = aa.load_gamedata()
-    
-    game_writer(gamedata)
-    write_per_player_stats(gamedata)
+    import argparse
+    parser = argparse.ArgumentParser(description='Write game and player statistics')
+    parser.add_argument('--offline', action='store_true',
+                        help='only use the stored data, do not ask the API for new games')
+    parser.add_argument('-t', '--type', dest='types', action='append', type=aa.game_type,
+                        help='game type to report on, can be given several times (default: academy)')
+    parser.add_argument('--rerate', action='store_true',
+                        help='rate all games again instead of only the newly finished ones')
+    parser.add_argument('--metrics', metavar='FILE', default=METRICS_FILE,
+                        help='where to write the run time metrics (default: %(default)s)')
+    args = parser.parse_args()
 
+    if not write_reports(args.types or [ACADEMY], args.offline, args.rerate):
+        sys.exit('No game data available')
+    METRICS.write(args.metrics)
@@ -14,20 +14,62 @@
 
 import os
 import sys
-import requests as rq
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 
 import json
 import csv
+import multiprocessing
 
 from operator import itemgetter as iget
 from datetime import datetime
 from pathlib import Path
 
-from constants import BASE, RACES
+from constants import BASE, RACES, SCORE_KEYS, ACADEMY, API_RACES, GAME_TYPES
+import apicache
+import datastore
+import identity
+import jsonstream
+import model
+from metrics import METRICS, METRICS_FILE
 
 
-ACCOUNT_CACHE = {}
+# Data file of earlier versions, imported into DB_FILE on first run
 DATA_FILE = 'player_data.json'
+# Every game type is stored in its own shard, a data store and its
+# snapshot; these are the files of the Academy shard, see shard_file()
+DB_FILE = datastore.DB_FILE
+# Snapshot of DB_FILE for fast loading without network access
+SNAPSHOT_FILE = 'player_data.pickle'
+# Parsed games are committed to DB_FILE after this many games or seconds,
+# so an interrupted sync only needs to fetch the uncommitted ones again
+CHECKPOINT_GAMES = 10
+CHECKPOINT_SECONDS = 5.0
+# Maximum number of games fetched in parallel from the API, the request
+# scheduler adapts the actual number of requests in flight below that
+FETCH_WORKERS = 16
+# Processes parsing downloaded games, 0 parses in the calling thread
+PARSE_PROCESSES = 0
+
+_SESSION = None
+_SCHEDULER = None
+# Set to None to disable caching of API responses
+CACHE = None
+# Minimum seconds between two updates of a progress bar
+PROGRESS_INTERVAL = 0.2
+_progress_shown = 0.0
+
+# Game status names by the numbers used in the API
+GAME_STATUS = {0: 'Interest', 1: 'Joining', 2: 'Running', 3: 'Finished', 4: 'On Hold'}
+# Fields of events and players parse_game_players() needs
+EVENT_KEYS = ['eventtype', 'playerid', 'accountid', 'turn', 'description']
+PLAYER_KEYS = ['id', 'username', 'raceid', 'finishrank']
+# Events that carry no player data: created, started, win condition, won
+IGNORED_EVENTS = {1, 2, 5, 6}
 
 # Progress bar code copied from:
 #     https://gist.github.com/aubricus/f91fb55dc6ba5557fbab06119420dd6a
@@ -37,6 +79,9 @@ def print_progress(iteration, total, prefix='', suffix='', decimals=1, bar_lengt
     """
     Call in a loop to create terminal progress bar
 
+    The bar is redrawn at most every PROGRESS_INTERVAL seconds and on
+    the last iteration, so calling this for every item is cheap.
+
     Args:
         iteration   - Required  : current iteration (Int)
         total       - Required  : total iterations (Int)
@@ -45,6 +90,12 @@ def print_progress(iteration, total, prefix='', suffix='', decimals=1, bar_lengt
         decimals    - Optional  : positive number of decimals in percent complete (Int)
         bar_length  - Optional  : character length of bar (Int)
     """
+    global _progress_shown
+    now = time.monotonic()
+    if iteration != total and now - _progress_shown < PROGRESS_INTERVAL:
+        return
+    _progress_shown = now
+
     str_format = "{0:." + str(decimals) + "f}"
     percents = str_format.format(100 * (iteration / float(total)))
     filled_length = int(round(bar_length * iteration / float(total)))
@@ -57,48 +108,273 @@ def print_progress(iteration, total, prefix='', suffix='', decimals=1, bar_lengt
     sys.stdout.flush()
 
 
+def game_type(name):
+    """Return the API number of a game type given by name, e.g. 'academy'"""
+    for gametype, typename in GAME_TYPES.items():
+        if typename.lower() == name.lower():
+            return gametype
+    raise ValueError('Unknown game type: {}'.format(name))
+
+
+def shard_file(filename, gametype=ACADEMY):
+    """Return the name of a file of the shard storing games of one type
+
+    Academy games keep the file names of earlier versions, the other
+    types get the type name appended, e.g. player_data_standard.db.
+
+    Args:
+        filename (str): File name of the Academy shard, e.g. DB_FILE
+        gametype (int, optional): Game type, see constants.GAME_TYPES
+    """
+    if gametype == ACADEMY:
+        return filename
+    return ('_' + GAME_TYPES[gametype].lower()).join(os.path.splitext(filename))
+
+
 def date_converter(datestr):
     # IN: 2/17/2017 4:43:38 AM - OUT:  2017-02-17 04:43:38 
     return str(datetime.strptime(datestr, '%m/%d/%Y %I:%M:%S %p'))
 
 
-def get_academy_games(keys_wanted, maxgames=0):
+def get_session(pool_size=FETCH_WORKERS):
+    """Return the HTTP session shared by all API calls
+
+    The session keeps connections to the API server alive between
+    requests, so consecutive calls do not pay for a new TCP handshake.
+
+    Args:
+        pool_size (int, optional): Number of pooled connections, only used
+            when the session is created on first call
+    """
+    global _SESSION
+    if _SESSION is None:
+        # Only import requests when we actually go online
+        import requests as rq
+        adapter = rq.adapters.HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=max(pool_size, 1))
+        _SESSION = rq.Session()
+        _SESSION.mount('http://', adapter)
+        _SESSION.mount('https://', adapter)
+    return _SESSION
+
+
+def get_scheduler(max_concurrency=FETCH_WORKERS):
+    """Return the request scheduler all API calls go through
+
+    Args:
+        max_concurrency (int, optional): Upper bound for parallel
+            requests, only used when the scheduler is created on first call
+    """
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        import scheduler
+        _SCHEDULER = scheduler.RequestScheduler(get_session(max_concurrency),
+                                                max_concurrency=max_concurrency)
+    return _SCHEDULER
+
+
+def download_chunks(response, writer=None, prefix=None):
+    """Yield the body of a streamed response in chunks
+
+    Args:
+        response (requests.Response): Response requested with stream=True
+        writer (apicache.CacheWriter, optional): Also write the body here
+        prefix (str, optional): Show a progress bar with this label, if
+            the server sent the size of the body
+    """
+    total = int(response.headers.get('Content-Length') or 0)
+    for chunk in response.iter_content(jsonstream.CHUNK_SIZE):
+        METRICS.count('bytes downloaded', len(chunk))
+        if writer is not None:
+            writer.write(chunk)
+        if prefix and total:
+            # Compressed bytes read, to match the Content-Length
+            print_progress(min(response.raw.tell(), total), total, prefix = prefix, suffix = 'Done')
+        yield chunk
+
+
+def api_read(endpoint, payload, decode, ttl=0, tag=None, prefix=None, store=True):
+    """Query an API endpoint and yield what is decoded from the response
+
+    Responses are read from and written to CACHE if it is set, a
+    response is only cached once its body was read completely. Requests
+    go through the scheduler, which limits the number of parallel
+    downloads and retries transient failures, also when a body breaks
+    off while it downloads. The request keeps its scheduler slot until
+    the caller has read all items or stops.
+
+    Args:
+        endpoint (str): Endpoint path relative to BASE, e.g. 'games/list'
+        payload (dict): URL parameters of the request
+        decode (callable): Called with the chunks of the UTF-8 encoded
+            JSON body as they arrive, returns an iterable of items. Called
+            again from the start if a download is retried, the items
+            passed on before are then skipped
+        ttl (int, optional): Maximum age in seconds of a cached response,
+            None accepts any age and 0 always asks the API
+        tag (str, optional): Only use a cached response stored with this tag
+        prefix (str, optional): Show a download progress bar with this label
+        store (bool, optional): Write the response to CACHE, False for
+            responses that are only ever read once
+
+    Yields:
+        The items returned by `decode`
+    """
+    if CACHE is not None and ttl != 0:
+        f = CACHE.open_entry(endpoint, payload, ttl, tag)
+        if f is not None:
+            METRICS.count('cache hits')
+            with f:
+                yield from decode(iter(partial(f.read, jsonstream.CHUNK_SIZE), b''))
+            return
+        METRICS.count('cache misses')
+
+    def download(response):
+        response.raise_for_status()
+        METRICS.count('requests')
+        if CACHE is None or not store:
+            yield from decode(download_chunks(response, None, prefix))
+            return
+        with CACHE.writer(endpoint, payload, tag) as writer:
+            chunks = download_chunks(response, writer, prefix)
+            yield from decode(chunks)
+            # The cache needs the complete body
+            for _ in chunks:
+                pass
+            writer.commit()
+
+    yield from get_scheduler().stream(BASE + endpoint, payload, endpoint, download)
+
+
+def api_body(endpoint, payload, ttl=0, tag=None):
+    """Query an API endpoint and return the raw response body
+
+    See api_read() for caching and retries.
+
+    Returns:
+        bytes: The UTF-8 encoded JSON body
+    """
+    body, = api_read(endpoint, payload, lambda chunks: [b''.join(chunks)], ttl, tag)
+    return body
+
+
+def api_stream(endpoint, payload, key=None, ttl=0, tag=None, prefix=None, store=True, select=None):
+    """Query an API endpoint and decode the response while it downloads
+
+    Yields the elements of one JSON array of the response as soon as
+    they arrived, see jsonstream.iter_items(), so the caller works on
+    them while the rest downloads and memory use does not grow with the
+    size of the response. See api_read() for caching and retries.
+
+    Args:
+        endpoint (str): Endpoint path relative to BASE, e.g. 'games/list'
+        payload (dict): URL parameters of the request
+        key (str or list, optional): Name of the array in the response
+            object, see jsonstream.iter_items(), None if the response is
+            the array
+        ttl (int, optional): Maximum age in seconds of a cached response,
+            None accepts any age and 0 always asks the API
+        tag (str, optional): Only use a cached response stored with this tag
+        prefix (str, optional): Show a download progress bar with this label
+        store (bool, optional): Write the response to CACHE
+        select (callable, optional): Filter or cut down the elements,
+            called with an iterator over them and returning an iterable
+
+    Yields:
+        The decoded array elements, or what `select` makes of them
     """
-    Read public info on all academy games
+    def decode(chunks):
+        items = jsonstream.iter_items(chunks, key)
+        return items if select is None else select(items)
+
+    return api_read(endpoint, payload, decode, ttl, tag, prefix, store)
+
+
+def game_cache_policy(game):
+    """Return how long cached API responses of a game stay valid
+
+    Cached responses are tagged with the game status and turn, so any
+    progress of the game invalidates them right away.
+
+    Args:
+        game (dict): Game data as returned by get_games, or None
+
+    Returns:
+        ttl (int): Maximum age of a cached response, see api_get()
+        tag (str): Tag for the cached responses
+    """
+    if game is None:
+        return 0, None
+    tag = '{}/{}'.format(game['status'], game['turn'])
+    return apicache.CACHE_TTL.get(game['status'], 0), tag
+
+
+def skip_test_games(games):
+    """Drop the early test games from a stream of games"""
+    for game in games:
+        if 'Test' not in game['shortdescription']:
+            yield game
+
+
+def project_games(games, keys_wanted):
+    """Keep only the wanted keys of a stream of games
+
+    Args:
+        games (iterable): Game objects as returned by games/list
+        keys_wanted (:obj:`list` of :obj:`str`): Keys to keep, missing
+            ones are set to None
+
+    Yields:
+        dict: Game data with the status as name instead of number
+    """
+    for game in games:
+        l = {k: game.get(k, None) for k in keys_wanted}
+        l['status'] = GAME_STATUS[l['status']]
+        yield l
+
+
+def get_games(keys_wanted, gametype=ACADEMY, maxgames=0, prefix='Getting games:'):
+    """
+    Read public info on all games of one type
+
+    The game list is filtered while it downloads, so only the wanted
+    keys of each game are ever kept in memory.
 
     Args:
         keys_wanted (:obj:`list` of :obj:`str`): specify keys we need from the game data
+        gametype (int, optional): Game type, see constants.GAME_TYPES
         maxgames (int, optional): How many games to read data of, defaults to all
+        prefix (str, optional): Label of the progress bar, None for none
 
     Returns:
         dict with specified keys of game data or None
     """
-    url = BASE + 'games/list'
-    # Get all Academy games that are Running, Finished or On Hold
+    # Get all games that are Running, Finished or On Hold
     # Other games give incomplete data
-    payload = {'type':'7', 'status':'2,3,4', 'limit':maxgames}
-    status = {0: 'Interest', 1: 'Joining', 2: 'Running', 3: 'Finished', 4: 'On Hold'}
+    payload = {'type':str(gametype), 'status':'2,3,4', 'limit':maxgames}
 
     # Access the API
-    r = rq.get(url, params=payload)
-    games_json = r.json()
-    glen = len(games_json)
     gamelist = {}
-    for i, game in enumerate(games_json):
-        # Ignore the early test games
-        if 'Test' in game['shortdescription']:
-            continue
-        # filter desired keys
-        l = {k: game.get(k, None) for k in keys_wanted}
-        l['status'] = status[l['status']]
-        gamelist[str(l['id'])] = l
-        print_progress(i+1, glen, prefix = 'Getting games:', suffix = 'Done')
+    def select(games):
+        if gametype == ACADEMY:
+            games = skip_test_games(games)
+        return project_games(games, keys_wanted)
+
+    with METRICS.timer('list fetch'):
+        for game in api_stream('games/list', payload, ttl=apicache.LIST_TTL, prefix=prefix,
+                               store=apicache.LIST_TTL != 0, select=select):
+            gamelist[str(game['id'])] = game
 
     if len(gamelist) == 0:
         return None
     return gamelist
 
 
+def get_academy_games(keys_wanted, maxgames=0):
+    """Read public info on all academy games, see get_games()"""
+    return get_games(keys_wanted, ACADEMY, maxgames)
+
+
 def player_add(all_players, name, gameid, stat, value, accountid=0):
     """Register a certain statistic for a given player name.
     Stores statistics for a given player which are of the types:
@@ -161,22 +437,324 @@ def crop_scores(player):
         score['finished'] = 0
         score['rank'] = player['finishrank']
         return score
-    
-    keys_wanted = [
-        'capitalships',
-        'freighters',
-        'planets',
-        'starbases',
-        'militaryscore',
-        'percent',
-    ]
-    score = {k: player['score'].get(k, None) for k in keys_wanted}
+
+    score = {k: player['score'].get(k, None) for k in SCORE_KEYS}
     score['finished'] = 1
     score['rank'] = player['finishrank']
     return score
 
 
-def get_game_players(all_players, gameid):
+def project_events(events):
+    """Keep only the events and fields parse_game_players() uses"""
+    for event in events:
+        if event['eventtype'] not in IGNORED_EVENTS:
+            yield {k: event.get(k, None) for k in EVENT_KEYS}
+
+
+def project_players(players):
+    """Keep only the player fields and scores parse_game_players() uses"""
+    for player in players:
+        p = {k: player.get(k, None) for k in PLAYER_KEYS}
+        p['score'] = {k: player['score'].get(k, None) for k in SCORE_KEYS + ['turn']}
+        yield p
+
+
+def fetch_game_data(gameid, ttl=0, tag=None):
+    """Download the event and player data of a single game
+
+    Both responses are decoded while they download and only the parts
+    needed for parsing are kept. The player data comes first, parsing
+    needs it before the events. The events are only downloaded while
+    they are read, so they can be parsed as they arrive.
+
+    Args:
+        gameid (int): Game ID
+        ttl (int, optional): Maximum age of cached responses, see api_stream()
+        tag (str, optional): Cache tag of the responses, see api_stream()
+
+    Returns:
+        events (iterator): Event objects from game/loadevents, to be
+            read once and to the end
+        player_info (list): Player objects from game/loadinfo
+    """
+    with METRICS.timer('info fetch'):
+        player_info = list(api_stream('game/loadinfo', {'gameid': gameid}, 'players', ttl, tag,
+                                      select=project_players))
+    events = api_stream('game/loadevents', {'gameid': gameid}, 'events', ttl, tag,
+                        select=project_events)
+    return events, player_info
+
+
+def read_game(gametype, gameid, ttl=0, tag=None):
+    """Download a game and extract its records while the events arrive
+
+    Runs in the download threads, see iter_game_players(). The events
+    are parsed as they are decoded, so only the records are kept.
+
+    Args:
+        gametype (int): Game type, see constants.GAME_TYPES
+        gameid (int): Game ID
+        ttl (int, optional): Maximum age of cached responses, see api_stream()
+        tag (str, optional): Cache tag of the responses, see api_stream()
+
+    Returns:
+        tuple: See extract_game()
+    """
+    events, player_info = fetch_game_data(gameid, ttl, tag)
+    # Parsing happens while the events download and is counted with them
+    with METRICS.timer('event fetch'):
+        return extract_game(events, player_info, gametype)
+
+
+def fetch_game_bodies(gameid, ttl=0, tag=None):
+    """Download the raw event and player responses of a single game
+
+    Same as fetch_game_data(), but the responses are not decoded.
+
+    Returns:
+        events (bytes): Body of game/loadevents
+        player_info (bytes): Body of game/loadinfo
+    """
+    with METRICS.timer('event fetch'):
+        events = api_body('game/loadevents', {'gameid': gameid}, ttl, tag)
+    with METRICS.timer('info fetch'):
+        player_info = api_body('game/loadinfo', {'gameid': gameid}, ttl, tag)
+    return events, player_info
+
+
+def parse_responses(events, player_info, gametype=ACADEMY):
+    """Decode the raw responses of a game and extract its records
+
+    Runs in the processes of the parse pool, see iter_game_players().
+
+    Args:
+        events (bytes): Body of game/loadevents
+        player_info (bytes): Body of game/loadinfo
+        gametype (int, optional): Game type, see constants.GAME_TYPES
+
+    Returns:
+        records (tuple): See extract_game()
+        seconds (float): Time spent
+    """
+    start = time.perf_counter()
+    events = project_events(json.loads(events)['events'])
+    player_info = list(project_players(json.loads(player_info)['players']))
+    records = extract_game(events, player_info, gametype)
+    return records, time.perf_counter() - start
+
+
+def bounded_map(pool, func, *iterables, window):
+    """Call a function in a pool for every set of arguments, a few at a time
+
+    Like pool.map(), but only `window` calls are submitted ahead of the
+    result the caller takes next, the next call is submitted when a
+    result is taken. A caller that is slower than the pool thus never
+    has more than `window` results waiting in memory.
+
+    Args:
+        pool (concurrent.futures.Executor): Pool to run the calls in
+        func (callable): Function to call
+        iterables: Arguments of the calls, as for map()
+        window (int): Maximum number of calls submitted but not taken
+
+    Yields:
+        The results, in the order of the arguments
+    """
+    calls = zip(*iterables)
+    pending = deque(pool.submit(func, *args) for args in islice(calls, window))
+    try:
+        while pending:
+            result = pending.popleft().result()
+            for args in islice(calls, 1):
+                pending.append(pool.submit(func, *args))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def submit_game(pool, gametype, gameid, ttl=0, tag=None):
+    """Download the responses of a game and queue them for parsing
+
+    Args:
+        pool (concurrent.futures.ProcessPoolExecutor): Parse pool
+        gametype (int): Game type, see constants.GAME_TYPES
+        gameid (int): Game ID
+        ttl (int, optional): Maximum age of cached responses, see api_stream()
+        tag (str, optional): Cache tag of the responses, see api_stream()
+
+    Returns:
+        concurrent.futures.Future: Result of parse_responses()
+    """
+    events, player_info = fetch_game_bodies(gameid, ttl, tag)
+    return pool.submit(parse_responses, events, player_info, gametype)
+
+
+def get_game_players(all_players, gameid, winners=None, gametype=ACADEMY, index=None):
+    """
+    Add player data to the global playerlist for a given game ID
+    based both on event and actual game data.
+
+    Args:
+        all_players  (:obj:`dict`): Dict containing all player stats
+        gameid (int): Game ID
+        winners (dict, optional): Winner index, see parse_game_players()
+        gametype (int, optional): Game type, see constants.GAME_TYPES
+        index (identity.IdentityIndex, optional): Names of known accounts
+    """
+    events, player_info = fetch_game_data(gameid)
+    parse_game_players(all_players, gameid, events, player_info, winners, gametype, index)
+
+
+def iter_game_players(gameids, workers=FETCH_WORKERS, games=None, prefix='Getting player stats:',
+                      gametype=ACADEMY, index=None, processes=PARSE_PROCESSES):
+    """Fetch and parse several games, yielding the players of each game
+
+    Downloads run in a pool of `workers` threads sharing one session,
+    each thread decoding the events of its game and extracting their
+    records while they arrive (see read_game()). The calling thread
+    resolves the names and applies the records (see apply_game()) in
+    the order of `gameids`, yielding each game as soon as it is done.
+
+    With `processes` set, the threads only download the responses and
+    hand them to a pool of processes, which decode them and extract the
+    records of each game (see extract_game()) while the next games
+    download. The calling thread applies the records game by game in
+    the order of `gameids`, so the result is the same as without the
+    process pool.
+
+    At most twice as many games as there are threads or processes are
+    downloaded ahead of the game the calling thread applies next, so a
+    large backfill does not pile up downloaded games when parsing is
+    slower than downloading.
+
+    Args:
+        gameids (:obj:`list`): Game IDs to read
+        workers (int, optional): Maximum number of parallel downloads,
+            1 disables threading
+        games (dict, optional): Game data by ID, the game status decides
+            whether cached API responses may be used
+        prefix (str, optional): Label of the progress bar, None for none
+        gametype (int, optional): Game type, see constants.GAME_TYPES
+        index (identity.IdentityIndex, optional): Names of known accounts,
+            by default a new index is shared by all games read here
+        processes (int, optional): Number of parse processes, 0 parses
+            in the calling thread
+
+    Yields:
+        gameid (str): Game ID
+        players (dict): Player stats of this game only
+        winner (str): Name of the winning player or None
+    """
+    gameids = list(gameids)
+    glen = len(gameids)
+    games = games or {}
+    if index is None:
+        index = identity.IdentityIndex()
+    policies = [game_cache_policy(games.get(gameid)) for gameid in gameids]
+    ttls = [ttl for ttl, _ in policies]
+    tags = [tag for _, tag in policies]
+    parsers = None
+    fetch = partial(read_game, gametype)
+    if processes > 0:
+        # Forking a process while the download threads run could copy
+        # locks they hold, fresh interpreters are safe
+        parsers = ProcessPoolExecutor(max_workers=processes,
+                                      mp_context=multiprocessing.get_context('spawn'))
+        fetch = partial(submit_game, parsers, gametype)
+    if workers <= 1:
+        results = map(fetch, gameids, ttls, tags)
+        pool = None
+    else:
+        get_scheduler(workers)
+        pool = ThreadPoolExecutor(max_workers=workers)
+        results = bounded_map(pool, fetch, gameids, ttls, tags, window=2 * max(workers, processes))
+    try:
+        for i, (gameid, result) in enumerate(zip(gameids, results)):
+            players = {}
+            winners = {}
+            if parsers is None:
+                records = result
+            else:
+                records, seconds = result.result()
+                METRICS.add_time('parse', seconds)
+            with METRICS.timer('reduce'):
+                apply_game(players, gameid, records, winners, index)
+            if prefix is not None:
+                print_progress(i+1, glen, prefix = prefix, suffix = 'Done')
+            yield gameid, players, winners.get(gameid)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if parsers is not None:
+            parsers.shutdown(cancel_futures=True)
+
+
+def merge_players(all_players, players):
+    """Add the player stats of some games to another player dict
+
+    Args:
+        all_players  (:obj:`dict`): Dict to merge into
+        players (dict): Player stats of games not yet in `all_players`
+    """
+    for name, player in players.items():
+        if name not in all_players:
+            all_players[name] = {}
+        target = all_players[name]
+        for key, value in player.items():
+            if key == 'accountid':
+                target.setdefault(key, value)
+            else:
+                target[key] = value
+
+
+def get_all_game_players(all_players, gameids, workers=FETCH_WORKERS, games=None,
+                         winners=None, prefix='Getting player stats:', gametype=ACADEMY,
+                         index=None, processes=PARSE_PROCESSES):
+    """Add player data for several games, fetching them concurrently
+
+    See iter_game_players(). Games are merged in the order of `gameids`,
+    so the resulting player data is the same as when calling
+    get_game_players() for each game in turn.
+
+    Args:
+        all_players  (:obj:`dict`): Dict containing all player stats
+        gameids (:obj:`list`): Game IDs to read, in the order to merge them
+        workers (int, optional): Maximum number of parallel downloads
+        games (dict, optional): Game data by ID, see iter_game_players()
+        winners (dict, optional): Winner index, see parse_game_players()
+        prefix (str, optional): Label of the progress bar
+        gametype (int, optional): Game type, see constants.GAME_TYPES
+        index (identity.IdentityIndex, optional): Names of known accounts
+        processes (int, optional): Number of parse processes
+    """
+    for gameid, players, winner in iter_game_players(gameids, workers, games, prefix, gametype,
+                                                     index, processes):
+        merge_players(all_players, players)
+        if winners is not None and winner is not None:
+            winners[gameid] = winner
+
+
+def slot_races(gametype, player_info):
+    """Return the race ID played in each slot of a game
+
+    In Academy games the slot number is the race ID, in other game
+    types every player has a 'raceid', see constants.API_RACES.
+
+    Args:
+        gametype (int): Game type, see constants.GAME_TYPES
+        player_info (list): Player objects as returned by game/loadinfo
+
+    Returns:
+        dict: Race ID by slot
+    """
+    if gametype == ACADEMY:
+        return {slot: slot for slot in RACES}
+    return {player['id']: API_RACES[player['raceid']] for player in player_info}
+
+
+def parse_game_players(all_players, gameid, events, player_info, winners=None, gametype=ACADEMY,
+                       index=None):
     """
     Add player data to the global playerlist for a given game ID
     based both on event and actual game data.
@@ -194,218 +772,416 @@ def get_game_players(all_players, gameid):
         *  9: ???
         * 10: <player> has dropped
 
+    The events are read in a single pass, so they can come from a stream.
+    Players are stored under the canonical name of their account, see
+    identity.py, so renamed players stay one player.
+
+    This is extract_game() followed by apply_game().
+
     Args:
         all_players  (:obj:`dict`): Dict containing all player stats
         gameid (int): Game ID
+        events (iterable): Event objects as returned by game/loadevents
+        player_info (list): Player objects as returned by game/loadinfo
+        winners (dict, optional): Winner index, the name of the player
+            with rank 1 is stored here by game ID
+        gametype (int, optional): Game type, see constants.GAME_TYPES
+        index (identity.IdentityIndex, optional): Names of known accounts,
+            new accounts and names are added to it
     """
+    apply_game(all_players, gameid, extract_game(events, player_info, gametype), winners, index)
 
-    url = BASE + 'game/loadevents'
-    payload = {'gameid': gameid}
-    response = rq.get(url, params=payload)
 
-    json_data = response.json()
-    events = json_data["events"]
+def extract_game(events, player_info, gametype=ACADEMY):
+    """Extract the records of a game from its events and player data
 
-    url = BASE + 'game/loadinfo'
-    payload = {'gameid': gameid}
-    response = rq.get(url, params=payload)
+    Names are cut out of the event texts but not resolved to players
+    yet, so the result only depends on the responses of this game and
+    can be computed in another process.
 
-    json_data = response.json()
-    player_info = json_data["players"]
+    Args:
+        events (iterable): Event objects as returned by game/loadevents
+        player_info (list): Player objects as returned by game/loadinfo
+        gametype (int, optional): Game type, see constants.GAME_TYPES
 
-    # Dict for the last seen player of a certain race
-    last_per_race = {}
-    # First we need to go through all normal "joined" Events to fill
-    # the ACCOUNT_CACHE; the events are not ordered chronological
+    Returns:
+        actions (list): (what, account ID, name, turn, slot, race) in
+            event order; what is 'joined', 'resigned', 'dropped', 'dead'
+            or 'unknown' with the event text as name. Joins and dead
+            events have a slot, only joins a race, dead events no name.
+        slots (list): (slot, alive, turn, score) of every slot, score
+            as returned by crop_scores()
+    """
+    races = slot_races(gametype, player_info)
+    actions = []
     for event in events:
-        if event['eventtype'] ==  3:
+        t = event['eventtype']
+        if t ==  3:
             text = event['description']
             name = text[:(text.find('has joined')-1)]
-            name = (name.rstrip(' +')).replace('+', ' ')
             # playerid is actually the game slot
-            if event['playerid'] not in last_per_race:
-                last_per_race[event['playerid']] = {}
-                last_per_race[event['playerid']]['turn'] = -1
-                
-            if last_per_race[event['playerid']]['turn'] < event['turn']:
-                last_per_race[event['playerid']]['turn'] = event['turn']
-                last_per_race[event['playerid']]['name'] = name
-            
-            ACCOUNT_CACHE[event['accountid']] = name
-            # add this game's race to the players list
-            # print (name, ' ', gameid, ' ', event['playerid'])
-            player_add(all_players, name, gameid, 'race',
-                       RACES[event['playerid']], event['accountid'])
-
-    for event in events:
-        t = event['eventtype']
-        # If a player resigned or dropped just add that stat
-        if t in [7, 8, 10]:
+            actions.append(('joined', event['accountid'], (name.rstrip(' +')).replace('+', ' '),
+                            event['turn'], event['playerid'], RACES[races[event['playerid']]]))
+        elif t in [8, 10]:
             text = event['description']
             if t == 8:
                 name = text[:(text.find('has resigned')-1)]
                 stat = 'resigned'
-            elif t == 10:
+            else:
                 name = text[:(text.find('has been dropped')-1)]
                 stat = 'dropped'
-            else:
-                name = ACCOUNT_CACHE[event['accountid']]
-                stat = 'dead'
-            name = (name.rstrip(' +')).replace('+', ' ')
-            player_add(all_players, name, gameid, 'status',
-                       {'what': stat, 'when': event['turn']})
-
+            actions.append((stat, event['accountid'], (name.rstrip(' +')).replace('+', ' '),
+                            event['turn'], None, None))
+        elif t == 7:
+            # The event only names the race, the account tells the player
+            actions.append(('dead', event['accountid'], None, event['turn'], event['playerid'], None))
         # Just in case we see unknown events in the future
-        if t in [4, 9] or t > 10:
-            print('========>>>>> ' + str(event['eventtype']) + ': ' + event['description'])
+        elif t in [4, 9] or t > 10:
+            actions.append(('unknown', None, str(t) + ': ' + event['description'], None, None, None))
+
+    slots = [(player['id'], player['username'] != 'dead', player['score']['turn'], crop_scores(player))
+             for player in player_info]
+    return actions, slots
+
+
+def apply_game(all_players, gameid, records, winners=None, index=None):
+    """Add the records of a game to the player stats
+
+    Resolves the names of the records with the identity index, so games
+    have to be applied in the same order every time for the same result.
+
+    Args:
+        all_players  (:obj:`dict`): Dict containing all player stats
+        gameid (int): Game ID
+        records (tuple): (actions, slots) as returned by extract_game()
+        winners (dict, optional): Winner index, the name of the player
+            with rank 1 is stored here by game ID
+        index (identity.IdentityIndex, optional): Names of known accounts,
+            new accounts and names are added to it
+    """
+    if index is None:
+        index = identity.IdentityIndex()
+    actions, slots = records
+    # Dict for the last seen player of a certain race
+    last_per_race = {}
+    # Status changes are added after the joins so players keep the order
+    # they joined in; the events are not ordered chronological
+    status = []
+    for what, accountid, name, turn, slot, race in actions:
+        if what == 'joined':
+            name = index.resolve(accountid, name)
+            if slot not in last_per_race:
+                last_per_race[slot] = {}
+                last_per_race[slot]['turn'] = -1
+
+            if last_per_race[slot]['turn'] < turn:
+                last_per_race[slot]['turn'] = turn
+                last_per_race[slot]['name'] = name
+
+            # add this game's race to the players list
+            player_add(all_players, name, gameid, 'race', race, accountid)
+        # If a player resigned or dropped just add that stat
+        elif what in ['resigned', 'dropped']:
+            status.append((accountid, index.resolve(accountid, name), what, turn, slot))
+        elif what == 'dead':
+            status.append((accountid, None, what, turn, slot))
+        else:
+            print('========>>>>> ' + name)
+
+    for accountid, name, stat, turn, slot in status:
+        if name is None and accountid:
+            # A new account is only known once its join event was seen
+            name = index.name(accountid)
+        if name is None and slot in last_per_race:
+            # Without a known account the slot tells who died
+            name = last_per_race[slot]['name']
+        if name is None:
+            print('Game {}: no player found for the {} event of turn {}, skipped'.format(
+                gameid, stat, turn))
+            continue
+        player_add(all_players, name, gameid, 'status', {'what': stat, 'when': turn})
 
     # Add scores for players that were last seen for a race
-    for player in player_info:
-        if player['username'] != 'dead':
-            # Check in the  player that are still living 
-            player_add(all_players, last_per_race[player['id']]['name'], gameid, 'status',
-                       {'what': 'alive', 'when': player['score']['turn']})
-            # print ('Added status for ',last_per_race[player['id']]['name'])
-
-        score = crop_scores(player)
+    for slot, alive, turn, score in slots:
+        if alive:
+            # Check in the  player that are still living
+            player_add(all_players, last_per_race[slot]['name'], gameid, 'status',
+                       {'what': 'alive', 'when': turn})
+
         # Register the select final score for all players dead or otherwise
-        player_add(all_players, last_per_race[player['id']]['name'],
-                   gameid, 'score', score)
+        player_add(all_players, last_per_race[slot]['name'], gameid, 'score', score)
+
+    if winners is not None:
+        start = time.perf_counter()
+        # Only the last registered score of a player counts
+        for slot, _, _, _ in slots:
+            name = last_per_race[slot]['name']
+            if all_players[name][gameid]['score']['rank'] == 1:
+                winners[gameid] = name
+        METRICS.add_time('winner resolution', time.perf_counter() - start)
+
 
+def game_watermark(game):
+    """Return the fields of a game that change while it progresses
 
-def check_load_data(games_actual, gcount, filename):
-    """Check if we have old data and compare the game count to actual
-    
     Args:
-        games_actual (int): number of games from live API data
-        filename (str): File name to load data from
+        game (dict): Game data as returned by get_games
 
     Returns:
-        data (dict): Either stored data if it exists or None
-        games (list): If live data has more entries than the stored data
-            return the missing game IDs
+        list: status, turn and end date of the game
     """
-    try:
-        f = open(filename,'r')
-    except FileNotFoundError:
-        return None, None
-    except IOError as e:
-        print ("I/O error({0}): {1}".format(e.errno, e.strerror))
-    except: #handle other exceptions such as attribute errors
-        print ("Unexpected error:", sys.exc_info()[0])
-    else:
-        try:
-            data = json.load(f)
-        except:
-            print ("Unexpected error:", sys.exc_info()[0])
-            data = {}
-            data['players'] = None
-            all_gameids = None
-        else:
-            if data['gamecount'] == gcount:
-                all_gameids = None
-            elif data['gamecount'] > gcount:
-                assert 0, 'Stored data corrupted! Remove file {} and re-run!'.format(filename)
-            else:
-                # Need to find the missing IDs
-                stored_gameids = set()
-                # for game, fields in data['games'].items():
-                #    stored_gameids.add(fields['id'])
-                for gid in data['games']:
-                    stored_gameids.add(gid)
-                print ('stored games: ', stored_gameids)
-                all_gameids = set()
-                for game in games_actual:
-                    all_gameids.add(game)
-                print ('all games: ', all_gameids)
-                all_gameids.difference_update(stored_gameids)
-
-                assert len(all_gameids) > 0, 'Gamecount should differ, still no new game IDs found!'
-                print ('{0} new game(s) found, IDs are: {1}'.format(len(all_gameids), all_gameids))
-
-        f.close()
-        return data, all_gameids
-
-def add_winning_player(games, players, new_gameids=None):
-    # Add the winning player (rank 1) to the games list
-    i = 0
-    for playername, player in players.items():
-        # print (playername)
-        for gameid, playerdata in player.items():
-            # print (playerdata)
-            if gameid == 'accountid':
-                continue
-            check = False
-            if new_gameids is None:
-                check = True
-            elif gameid in new_gameids:
-                check = True
-            if check and 'score' in playerdata.keys():
-                gdata = playerdata['score']
-                if gdata['rank'] == 1:
-                    # print (playername, ' has won Game ',gameid)
-                    assert games[gameid], 'For some reason GameID {} is not registered yet!'.format(gameid)
-                    games[gameid]['winner'] = playername
-        print_progress(i+1, len(players), prefix = 'Getting game winner:', suffix = 'Done')
-        i += 1
-
-
-def load_gamedata():
-    # define desired keys to load for every academy games
+    return [game['status'], game['turn'], game['dateended']]
+
+
+def plan_sync(games_actual, watermarks):
+    """Compare live game data to the stored watermarks
+
+    Args:
+        games_actual (dict): Game data from the live API by game ID
+        watermarks (dict): Stored watermarks by game ID
+
+    Returns:
+        new (list): IDs of games not stored yet
+        changed (list): IDs of stored games whose watermark differs
+    """
+    new = []
+    changed = []
+    for gameid, game in games_actual.items():
+        if gameid not in watermarks:
+            new.append(gameid)
+        elif watermarks[gameid] != game_watermark(game):
+            changed.append(gameid)
+    return new, changed
+
+
+def check_load_data(games_actual, conn, verbose=True):
+    """Find the games that need to be read from the API
+
+    Args:
+        games_actual (dict): Game data from the live API by game ID
+        conn (sqlite3.Connection): Open data store
+        verbose (bool, optional): List the new and changed games
+
+    Returns:
+        games (list): IDs of the games that are new or changed since
+            they were stored, None if nothing changed
+    """
+    new, changed = plan_sync(games_actual, datastore.load_watermarks(conn))
+    if new and verbose:
+        print ('{0} new game(s) found, IDs are: {1}'.format(len(new), new))
+    if changed and verbose:
+        print ('{0} changed game(s) found, IDs are: {1}'.format(len(changed), changed))
+    if not new and not changed:
+        return None
+    return new + changed
+
+
+def checkpoint(conn, games, players, gameids, index=None):
+    """Commit completely parsed games to the data store
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        games (dict): Game data by game ID
+        players (dict): Player stats of the games to commit
+        gameids (:obj:`list`): IDs of the games to commit
+        index (identity.IdentityIndex, optional): Names of known accounts,
+            its new entries are committed together with the games
+    """
+    with METRICS.timer('serialize'):
+        datastore.save_games(conn, games, players, gameids, index)
+    METRICS.count('checkpoints')
+
+
+def sync_games(workers=FETCH_WORKERS, use_cache=True, gametype=ACADEMY, processes=PARSE_PROCESSES,
+               verbose=True):
+    """Update the stored games of one type with new games from the API
+
+    Games are committed to the data store in small batches while they
+    are read. If a sync is interrupted, the next one picks up where it
+    stopped, as all committed games already have an up to date watermark.
+
+    Only the shard of one game type is updated, the shards of other
+    types are not touched. The stored data is not loaded, see
+    load_gamedata().
+
+    Args:
+        workers (int, optional): Maximum number of games fetched in parallel
+        use_cache (bool, optional): Keep API responses in an on-disk cache
+            so later runs can skip downloading unchanged games
+        gametype (int, optional): Game type, see constants.GAME_TYPES
+        processes (int, optional): Number of parse processes, see
+            iter_game_players()
+        verbose (bool, optional): Show progress bars and messages, False
+            for syncs in the background
+
+    Returns:
+        int: Number of new or changed games, None if the API did not
+            return any games
+    """
+    global CACHE
+    if use_cache and CACHE is None:
+        CACHE = apicache.ResponseCache()
+    get_scheduler(workers)
+
+    # define desired keys to load for every game
     gamekeys = ['id', 'name', 'status', 'datecreated', 'dateended', 'turn', 'winner']
-    # setting maxgames to 17 gives three results since the first 14 are test games
-    # games = get_academy_games(gamekeys, maxgames = 17)
-    games = get_academy_games(gamekeys)
+    # setting maxgames to 17 gives three Academy games since the first 14 are test games
+    # games = get_games(gamekeys, gametype, maxgames = 17)
+    games = get_games(gamekeys, gametype, prefix='Getting games:' if verbose else None)
     # First check if we even read any games from the API
     if games is None:
         return None
 
-    glen = len(games)
-    mark_for_save = False
-    stored_data, gameids = check_load_data(games, glen, DATA_FILE)
-    if stored_data is None:
-        # First time storing or re-reading data
+    for game in games.values():
+        game['datecreated'] = date_converter(game['datecreated'])
+        game['dateended'] = date_converter(game['dateended'])
+
+    conn = datastore.connect(shard_file(DB_FILE, gametype))
+    if gametype == ACADEMY and datastore.is_empty(conn) and os.path.exists(DATA_FILE):
+        if verbose:
+            print('Importing stored data from {}'.format(DATA_FILE))
+        datastore.import_json(conn, DATA_FILE)
+
+    gameids = check_load_data(games, conn, verbose)
+    if gameids is not None:
+        # Only the players of the games not committed yet are kept in
+        # memory, the store replaces whatever it had for these games
         gameplayers = {}
-        mark_for_save = True
-        i = 0
-        for gameid, game in games.items():
-            game['datecreated'] = date_converter(game['datecreated'])
-            game['dateended'] = date_converter(game['dateended'])
-            # Get the players of each game
-            get_game_players(gameplayers, gameid)
-            print_progress(i+1, glen, prefix = 'Getting player stats:', suffix = 'Done')
-            i += 1
-        add_winning_player(games, gameplayers)
-        stored_data = {'games': games, 'players': gameplayers, 'gamecount': glen}
-    elif gameids is not None:
-        storedgames = stored_data['games']
-        gameplayers = stored_data['players']
-        mark_for_save = True
-        # We need to read data for the new gameids
-        for i, gameid in enumerate(gameids):
-            newgame = games[gameid]
-            newgame['datecreated'] = date_converter(newgame['datecreated'])
-            newgame['dateended'] = date_converter(newgame['dateended'])
-            storedgames[gameid] = games[gameid]
-            get_game_players(gameplayers, gameid)
-            print_progress(i+1, len(gameids), prefix = 'Updating games and players:', suffix = 'Done')
-        add_winning_player(storedgames, gameplayers, gameids)
-        stored_data['gamecount'] += len(gameids)
-
-    if mark_for_save:
+        pending = []
+        last_checkpoint = time.monotonic()
+        index = datastore.load_identity(conn)
         try:
-            f = open(DATA_FILE, 'w')
-        except IOError as e:
-            print ("I/O error({0}): {1}".format(e.errno, e.strerror))
-        except: #handle other exceptions such as attribute errors
-            print ("Unexpected error:", sys.exc_info()[0])
-        else:
-            json.dump(stored_data, f)
-            f.close()
-    else:
-        print('No new games found.')
+            for gameid, players, winner in iter_game_players(
+                    gameids, workers, games, 'Updating games and players:' if verbose else None,
+                    gametype, index, processes):
+                if winner is not None:
+                    games[gameid]['winner'] = winner
+                merge_players(gameplayers, players)
+                pending.append(gameid)
+                if (len(pending) >= CHECKPOINT_GAMES
+                        or time.monotonic() - last_checkpoint >= CHECKPOINT_SECONDS):
+                    checkpoint(conn, games, gameplayers, pending, index)
+                    gameplayers = {}
+                    pending = []
+                    last_checkpoint = time.monotonic()
+        finally:
+            # Keep the games parsed so far even if the sync was interrupted
+            if pending:
+                checkpoint(conn, games, gameplayers, pending, index)
+    elif verbose:
+        print('No new or changed games found.')
+    METRICS.count('games synced', len(gameids or ()))
+    conn.close()
+
+    METRICS.set('scheduler', get_scheduler().stats())
+    if CACHE is not None:
+        CACHE.flush()
+        METRICS.set('cache', CACHE.stats())
+        if verbose:
+            print('API cache: {hits} hits, {misses} misses'.format(**CACHE.stats()))
+    return len(gameids or ())
+
+
+def load_gamedata(workers=FETCH_WORKERS, use_cache=True, gametype=ACADEMY,
+                  processes=PARSE_PROCESSES):
+    """Load the game and player data, reading new games from the API
+
+    See sync_games() for the update. Afterwards all stored games of the
+    type are loaded. The snapshot for offline use is only written again
+    if games changed, otherwise it is loaded, see load_offline().
+
+    Args:
+        workers (int, optional): Maximum number of games fetched in parallel
+        use_cache (bool, optional): Keep API responses in an on-disk cache
+            so later runs can skip downloading unchanged games
+        gametype (int, optional): Game type, see constants.GAME_TYPES
+        processes (int, optional): Number of parse processes, see
+            iter_game_players()
+
+    Returns:
+        model.Dataset: All stored games and players of this type, None
+            if the API did not return any games
+    """
+    synced = sync_games(workers, use_cache, gametype, processes)
+    if synced is None:
+        return None
+    if synced:
+        return update_snapshot(gametype)
+    return load_offline(gametype)
 
+
+def update_snapshot(gametype=ACADEMY):
+    """Load all stored games of a type and write them to the snapshot
+
+    Args:
+        gametype (int, optional): Game type of the shard, see
+            constants.GAME_TYPES
+
+    Returns:
+        model.Dataset: All stored games and players of this type
+    """
+    conn = datastore.connect(shard_file(DB_FILE, gametype))
+    with METRICS.timer('load'):
+        stored_data = datastore.load_dataset(conn)
+    conn.close()
+    with METRICS.timer('serialize'):
+        model.save_snapshot(stored_data, shard_file(SNAPSHOT_FILE, gametype))
     return stored_data
-            
+
+
+def load_offline(gametype=ACADEMY):
+    """Load the stored game and player data without accessing the API
+
+    Reads the snapshot, or the data store if the snapshot is missing or
+    older than the store. In that case the snapshot is written again.
+
+    Args:
+        gametype (int, optional): Game type of the shard to load, see
+            constants.GAME_TYPES
+
+    Returns:
+        model.Dataset: All stored games and players of this type, None
+            if there is no stored data yet
+    """
+    db_file = shard_file(DB_FILE, gametype)
+    snapshot_file = shard_file(SNAPSHOT_FILE, gametype)
+    try:
+        snapshot_time = os.path.getmtime(snapshot_file)
+    except OSError:
+        snapshot_time = None
+    if not os.path.exists(db_file):
+        if snapshot_time is None:
+            return None
+        return model.load_snapshot(snapshot_file)
+    if snapshot_time is not None and snapshot_time >= os.path.getmtime(db_file):
+        with METRICS.timer('load'):
+            return model.load_snapshot(snapshot_file)
+    return update_snapshot(gametype)
+
+
 if __name__ == "__main__":
-    _ = load_gamedata()
+    import argparse
+    parser = argparse.ArgumentParser(description='Download game and player data')
+    parser.add_argument('-w', '--workers', type=int, default=FETCH_WORKERS,
+                        help='maximum number of games to fetch in parallel (default: %(default)s)')
+    parser.add_argument('-t', '--type', dest='types', action='append', type=game_type,
+                        help='game type to update, can be given several times (default: academy)')
+    parser.add_argument('-p', '--processes', type=int, default=PARSE_PROCESSES,
+                        help='parse downloaded games in this many processes (default: %(default)s)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='do not keep API responses in the local cache')
+    parser.add_argument('--export', metavar='FILE', nargs='?', const=DATA_FILE,
+                        help='also write all data to a JSON file per game type (default: %(const)s)')
+    parser.add_argument('--metrics', metavar='FILE', default=METRICS_FILE,
+                        help='where to write the run time metrics (default: %(default)s)')
+    args = parser.parse_args()
+    for gametype in args.types or [ACADEMY]:
+        # Each shard is synced on its own, and only loaded into memory for
+        # the snapshot if any of its games changed
+        if sync_games(args.workers, args.cache, gametype, args.processes):
+            update_snapshot(gametype)
+        if args.export:
+            conn = datastore.connect(shard_file(DB_FILE, gametype))
+            datastore.export_json(conn, shard_file(args.export, gametype))
+            conn.close()
+    METRICS.write(args.metrics)
@@ -0,0 +1,276 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""On-disk cache for raw API responses.
+
+Every response body is stored in its own file, named by a hash of the
+endpoint and the request parameters. A small index keeps track of when
+each entry was stored and last used, so entries can expire and the
+cache can be kept below a size limit by dropping the least recently
+used entries first.
+
+Entries can carry a tag, e.g. the game status and turn at the time
+the response was stored. A lookup with a different tag is a miss, so a
+response stored while a game was running is not mistaken for the final
+state of the game.
+
+Large responses can be read and written in parts with open_entry() and
+writer(), so they never have to be held in memory as a whole."""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+
+CACHE_DIR = 'api_cache'
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+INDEX_FILE = 'index.json'
+# Seconds a cached game response stays valid, by game status.
+# None means the entry never expires, finished games do not change anymore.
+CACHE_TTL = {'Finished': None, 'Running': 3600, 'On Hold': 3600}
+# Seconds a cached game list stays valid. The list is how a sync finds
+# new and changed games, so by default it is always read from the API
+# and not cached, a list reused for a while misses the changes since
+LIST_TTL = 0
+# Write the index to disk after this many changes
+FLUSH_EVERY = 100
+
+
+def cache_key(endpoint, payload):
+    """Build the cache key for an API request
+
+    Args:
+        endpoint (str): Endpoint path relative to BASE
+        payload (dict): URL parameters of the request
+
+    Returns:
+        str: Hex digest identifying the request
+    """
+    params = '&'.join('{}={}'.format(k, payload[k]) for k in sorted(payload))
+    return hashlib.sha1((endpoint + '?' + params).encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Size bounded LRU cache of API response bodies on disk
+
+    Args:
+        directory (str, optional): Where to store the cached responses
+        max_bytes (int, optional): Upper limit for the summed size of all
+            cached responses
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._dirty = 0
+        self._reordered = False
+        # key -> [stored, size, tag], ordered from least to most recently used
+        self._index = OrderedDict()
+        self._size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _load_index(self):
+        try:
+            with open(self._path(INDEX_FILE), 'r') as f:
+                entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            entries = []
+        files = set(os.listdir(self.directory))
+        for key, stored, size, tag in entries:
+            if key in files:
+                self._index[key] = [stored, size, tag]
+                self._size += size
+                files.discard(key)
+        # Pick up entries written after the index was last saved
+        for key in files:
+            if key == INDEX_FILE or key.endswith('.tmp'):
+                continue
+            stat = os.stat(self._path(key))
+            self._index[key] = [stat.st_mtime, stat.st_size, None]
+            self._size += stat.st_size
+
+    def open_entry(self, endpoint, payload, ttl=None, tag=None):
+        """Open a cached response body for reading
+
+        Args:
+            endpoint (str): Endpoint path relative to BASE
+            payload (dict): URL parameters of the request
+            ttl (int, optional): Maximum age of the entry in seconds,
+                None accepts entries of any age
+            tag (str, optional): Tag the entry must have been stored with
+
+        Returns:
+            file: The cached response opened in binary mode or None if
+                there is no valid entry
+        """
+        key = cache_key(endpoint, payload)
+        with self._lock:
+            entry = self._index.get(key)
+            if (entry is None or entry[2] != tag
+                    or (ttl is not None and time.time() - entry[0] > ttl)):
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self._reordered = True
+        try:
+            f = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            with self._lock:
+                self._drop(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return f
+
+    def get(self, endpoint, payload, ttl=None, tag=None):
+        """Return a cached response body
+
+        See open_entry() for the arguments.
+
+        Returns:
+            bytes: The cached response or None if there is no valid entry
+        """
+        f = self.open_entry(endpoint, payload, ttl, tag)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def writer(self, endpoint, payload, tag=None):
+        """Return a CacheWriter to store a response body in parts
+
+        Args:
+            endpoint (str): Endpoint path relative to BASE
+            payload (dict): URL parameters of the request
+            tag (str, optional): Tag to store the entry with
+        """
+        return CacheWriter(self, cache_key(endpoint, payload), tag)
+
+    def put(self, endpoint, payload, content, tag=None):
+        """Store a response body, evicting old entries if needed
+
+        Args:
+            endpoint (str): Endpoint path relative to BASE
+            payload (dict): URL parameters of the request
+            content (bytes): Raw response body
+            tag (str, optional): Tag to store the entry with
+        """
+        with self.writer(endpoint, payload, tag) as writer:
+            writer.write(content)
+            writer.commit()
+
+    def _add(self, key, size, tag):
+        with self._lock:
+            self._drop(key)
+            self._index[key] = [time.time(), size, tag]
+            self._size += size
+            while self._size > self.max_bytes and len(self._index) > 1:
+                old = next(iter(self._index))
+                self._drop(old)
+                try:
+                    os.remove(self._path(old))
+                except FileNotFoundError:
+                    pass
+                self.evictions += 1
+            self._dirty += 1
+            if self._dirty >= FLUSH_EVERY:
+                self._flush()
+
+    def _drop(self, key):
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def _flush(self):
+        entries = [[key] + entry for key, entry in self._index.items()]
+        tmp = self._path(INDEX_FILE) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, self._path(INDEX_FILE))
+        self._dirty = 0
+        self._reordered = False
+
+    def flush(self):
+        """Write the cache index to disk"""
+        with self._lock:
+            if self._dirty or self._reordered:
+                self._flush()
+
+    def stats(self):
+        """Return the hit/miss counters and the current cache size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitrate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._index),
+                'bytes': self._size,
+            }
+
+
+class CacheWriter:
+    """Response body written to the cache while it is downloaded
+
+    The entry only replaces an older one when commit() is called,
+    closing the writer without committing throws away what was
+    written. Use ResponseCache.writer() to create one.
+    """
+
+    def __init__(self, cache, key, tag):
+        self.cache = cache
+        self.key = key
+        self.tag = tag
+        self.size = 0
+        self._path = cache._path(key)
+        self._tmp = '{}.{}.tmp'.format(self._path, threading.get_ident())
+        self._file = open(self._tmp, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        """Make the written body the cache entry, evicting old entries if needed"""
+        self._file.close()
+        self._file = None
+        os.replace(self._tmp, self._path)
+        self.cache._add(self.key, self.size, self.tag)
+
+    def close(self):
+        """Throw away the written body unless it was committed"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,190 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Benchmark of syncing and report generation against a local stand-in.
+
+Generates a synthetic data set, serves it with standin.py and measures
+wall time, throughput and peak Python memory of
+
+  * a cold sync into an empty directory,
+  * an incremental sync after adding and finishing some games,
+  * report generation from the stored data.
+
+Tracing memory slows Python down a lot, so all phases run twice on the
+same data: once for timing and once, without artificial latency, with
+tracemalloc for the peak memory. Everything runs in a temporary
+directory, no real API is contacted."""
+
+import io
+import os
+import json
+import time
+import tempfile
+import tracemalloc
+
+from contextlib import redirect_stdout
+
+import apiaccess as aa
+import analyse_csv
+import standin
+import synthdata
+
+from constants import ACADEMY
+
+
+def measure(func, *args, trace=False):
+    """Run a function and return its result, run time and peak memory
+
+    Output of the function, e.g. progress bars, is swallowed. The peak
+    memory is only measured if `trace` is set, otherwise it is 0.
+    """
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        result = func(*args)
+    seconds = time.perf_counter() - start
+    peak = 0
+    if trace:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def report_generation(dataset):
+    # The reports are built from the stored aggregates, the data set of
+    # the last sync is only passed through for the game and player counts
+    analyse_csv.write_reports([ACADEMY], offline=True)
+    return dataset
+
+
+def scenario(api, latency, workers, new_games, finished, use_cache, trace, error_rate=0.0,
+             processes=0):
+    """Run the benchmark phases once against a fresh stand-in and directory
+
+    Returns:
+        list: One dict of measurements per phase
+    """
+    server = standin.StandinServer(api, latency, error_rate=error_rate).start()
+    old_base, old_cwd = aa.BASE, os.getcwd()
+    results = []
+    datasets = []
+    try:
+        aa.BASE = server.base
+        aa.CACHE = None
+        aa._SESSION = None
+        aa._SCHEDULER = None
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir)
+
+            def phase(name, func, *args):
+                requests, sent = server.requests, server.bytes_sent
+                dataset, seconds, peak = measure(func, *args, trace=trace)
+                datasets.append(dataset)
+                results.append({
+                    'phase': name,
+                    'seconds': seconds,
+                    'games': len(dataset.games),
+                    'players': len(dataset.players),
+                    'requests': server.requests - requests,
+                    'bytes': server.bytes_sent - sent,
+                    'games_per_second': len(dataset.games) / seconds,
+                    'requests_per_second': (server.requests - requests) / seconds,
+                    'peak_memory': peak,
+                })
+
+            phase('cold sync', aa.load_gamedata, workers, use_cache, ACADEMY, processes)
+            api.add_games(new_games)
+            api.finish_games(finished)
+            phase('incremental sync', aa.load_gamedata, workers, use_cache, ACADEMY, processes)
+            phase('report generation', report_generation, datasets[-1])
+    finally:
+        os.chdir(old_cwd)
+        aa.BASE = old_base
+        aa.CACHE = None
+        aa._SESSION = None
+        aa._SCHEDULER = None
+        server.stop()
+    return results
+
+
+def run(ngames=500, nplayers=1000, churn=0.2, latency=0.02, workers=aa.FETCH_WORKERS,
+        new_games=20, finished=10, use_cache=False, seed=0, error_rate=0.0, processes=0):
+    """Run all benchmark phases
+
+    Args:
+        ngames (int, optional): Games in the initial data set
+        nplayers (int, optional): Size of the player population
+        churn (float, optional): Chance of a player leaving a game
+        latency (float, optional): Seconds the stand-in waits per request
+        workers (int, optional): Parallel downloads during syncs
+        new_games (int, optional): Games added before the incremental sync
+        finished (int, optional): Games finished before the incremental sync
+        use_cache (bool, optional): Use the API response cache
+        seed (int, optional): Random seed of the synthetic data
+        error_rate (float, optional): Share of requests the stand-in fails
+        processes (int, optional): Parse processes during syncs, the peak
+            memory does not include them
+
+    Returns:
+        list: One dict of measurements per phase
+    """
+    args = (workers, new_games, finished, use_cache)
+    results = scenario(synthdata.generate(ngames, nplayers, churn, seed), latency, *args, trace=False,
+                       error_rate=error_rate, processes=processes)
+    traced = scenario(synthdata.generate(ngames, nplayers, churn, seed), 0.0, *args, trace=True,
+                      processes=processes)
+    for result, memory in zip(results, traced):
+        result['peak_memory'] = memory['peak_memory']
+    return results
+
+
+def print_results(results):
+    print('{:<20}{:>10}{:>8}{:>10}{:>12}{:>12}{:>12}'.format(
+        'phase', 'seconds', 'games', 'requests', 'games/s', 'requests/s', 'peak MB'))
+    for r in results:
+        print('{phase:<20}{seconds:>10.3f}{games:>8}{requests:>10}{games_per_second:>12.1f}'
+              '{requests_per_second:>12.1f}{mb:>12.1f}'.format(mb=r['peak_memory'] / 2**20, **r))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark syncing and reports on synthetic data')
+    parser.add_argument('--games', type=int, default=500, help='number of games (default: %(default)s)')
+    parser.add_argument('--players', type=int, default=1000, help='number of players (default: %(default)s)')
+    parser.add_argument('--churn', type=float, default=0.2,
+                        help='chance of a player leaving a game (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the stand-in delays every answer (default: %(default)s)')
+    parser.add_argument('-w', '--workers', type=int, default=aa.FETCH_WORKERS,
+                        help='maximum number of games to fetch in parallel (default: %(default)s)')
+    parser.add_argument('--new-games', type=int, default=20,
+                        help='games added before the incremental sync (default: %(default)s)')
+    parser.add_argument('--finished', type=int, default=10,
+                        help='games finished before the incremental sync (default: %(default)s)')
+    parser.add_argument('--cache', action='store_true', help='use the API response cache')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of requests failing with HTTP 503 (default: %(default)s)')
+    parser.add_argument('-p', '--processes', type=int, default=0,
+                        help='parse processes during syncs (default: %(default)s)')
+    parser.add_argument('--json', metavar='FILE', help='also write the results to a JSON file')
+    args = parser.parse_args()
+
+    results = run(args.games, args.players, args.churn, args.latency, args.workers,
+                  args.new_games, args.finished, args.cache, error_rate=args.error_rate,
+                  processes=args.processes)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,254 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Columnar export of the data store for analysis with Arrow and Pandas.
+
+The stored games are flattened into one typed table each for games,
+participations, races, status events and scores, keyed by game ID and
+player name. Race, status and player names repeat a lot, they are
+dictionary encoded, dates become timestamps.
+
+Tables are written as Arrow IPC files by default. These are not
+compressed, so load_tables() memory-maps them and reading a table costs
+next to nothing until its columns are used. Parquet files are smaller
+but have to be decoded on every load.
+
+pyarrow is only needed here, and pandas only for load_frames(), so the
+rest of the tools work without them."""
+
+import os
+import importlib
+
+import datastore
+from constants import SCORE_KEYS
+from metrics import METRICS
+
+
+# Directory of the exported tables of the Academy shard
+EXPORT_DIR = 'player_data_columnar'
+# File extension by export format
+FORMATS = {'arrow': '.arrow', 'parquet': '.parquet'}
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# End date of games that did not end yet
+NO_DATE = '0001-01-01 00:00:00'
+
+# Rows of every table, the column names are the names in the export
+QUERIES = {
+    # The API reports the winner of unfinished games as 0
+    'games': 'SELECT id AS game_id, name, status, datecreated, '
+             "NULLIF(dateended, '" + NO_DATE + "') AS dateended, turn, "
+             "CASE WHEN typeof(winner) = 'text' THEN winner END AS winner FROM games ORDER BY id",
+    'participations': 'SELECT pa.game_id, p.name AS player, p.accountid, r.race FROM participations pa '
+                      'JOIN players p ON p.id = pa.player_id '
+                      'LEFT JOIN races r ON r.game_id = pa.game_id AND r.player_id = pa.player_id '
+                      'AND r.seq = 0 ORDER BY pa.game_id, pa.player_id',
+    'races': 'SELECT r.game_id, p.name AS player, r.seq, r.race FROM races r '
+             'JOIN players p ON p.id = r.player_id ORDER BY r.game_id, r.player_id, r.seq',
+    'status_events': 'SELECT e.game_id, p.name AS player, e.seq, e.what AS status, e.turn '
+                     'FROM status_events e JOIN players p ON p.id = e.player_id '
+                     'ORDER BY e.game_id, e.player_id, e.seq',
+    'scores': 'SELECT s.game_id, p.name AS player, s.finished, s.rank, '
+              + ', '.join('s.' + k for k in SCORE_KEYS) + ' FROM scores s '
+              'JOIN players p ON p.id = s.player_id ORDER BY s.game_id, s.player_id',
+}
+TABLES = list(QUERIES)
+
+
+def _require(module):
+    """Import an optional dependency, with a hint how to get it"""
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise ImportError('{} is needed for columnar data, install it with '
+                          '"pip install {}"'.format(module, module.split('.')[0])) from None
+
+
+def column_types(pa):
+    """Return the Arrow type of every exported column
+
+    Args:
+        pa (module): pyarrow
+
+    Returns:
+        dict: Arrow type by column name, the same for all tables
+    """
+    category = pa.dictionary(pa.int32(), pa.string())
+    types = {
+        'game_id': pa.int64(),
+        'name': pa.string(),
+        'status': category,
+        # Parquet has no timestamps in seconds
+        'datecreated': pa.timestamp('ms'),
+        'dateended': pa.timestamp('ms'),
+        'turn': pa.int32(),
+        'winner': category,
+        'player': category,
+        'accountid': pa.int64(),
+        'race': category,
+        'seq': pa.int16(),
+        'finished': pa.bool_(),
+        'rank': pa.int16(),
+        'percent': pa.float64(),
+    }
+    for key in SCORE_KEYS:
+        types.setdefault(key, pa.int64())
+    return types
+
+
+def build_table(conn, name):
+    """Read one table from the data store
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        name (str): One of TABLES
+
+    Returns:
+        pyarrow.Table
+    """
+    pa = _require('pyarrow')
+    pc = _require('pyarrow.compute')
+    types = column_types(pa)
+    cursor = conn.execute(QUERIES[name])
+    names = [column[0] for column in cursor.description]
+    rows = cursor.fetchall()
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    arrays = []
+    for column, values in zip(names, columns):
+        kind = types[column]
+        if pa.types.is_timestamp(kind):
+            array = pc.strptime(pa.array(values, pa.string()), DATE_FORMAT, kind.unit)
+        elif pa.types.is_boolean(kind):
+            array = pa.array(values, pa.int8()).cast(kind)
+        else:
+            array = pa.array(values, kind)
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names)
+
+
+def export_tables(conn, directory=EXPORT_DIR, fmt='arrow'):
+    """Write all tables of a data store to a directory
+
+    Every table is written to a file of its own, named after the table.
+    Files are written under a temporary name first and then renamed.
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        directory (str, optional): Directory to write to, created if needed
+        fmt (str, optional): 'arrow' or 'parquet'
+
+    Returns:
+        dict: Number of rows by table name
+    """
+    pa = _require('pyarrow')
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    for name in TABLES:
+        with METRICS.timer('columnar export'):
+            table = build_table(conn, name)
+            filename = os.path.join(directory, name + FORMATS[fmt])
+            tmp = filename + '.tmp'
+            if fmt == 'parquet':
+                _require('pyarrow.parquet').write_table(table, tmp, compression='zstd')
+            else:
+                with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp, filename)
+        # Files of the other format are out of date now
+        for other in FORMATS.values():
+            stale = os.path.join(directory, name + other)
+            if other != FORMATS[fmt] and os.path.exists(stale):
+                os.remove(stale)
+        counts[name] = table.num_rows
+    return counts
+
+
+def load_table(directory, name):
+    """Load one exported table, memory-mapped if it is an Arrow file
+
+    Args:
+        directory (str): Directory written by export_tables()
+        name (str): One of TABLES
+
+    Returns:
+        pyarrow.Table
+
+    Raises:
+        FileNotFoundError: If the table was not exported
+    """
+    pa = _require('pyarrow')
+    filename = os.path.join(directory, name + FORMATS['arrow'])
+    if os.path.exists(filename):
+        return pa.ipc.open_file(pa.memory_map(filename)).read_all()
+    filename = os.path.join(directory, name + FORMATS['parquet'])
+    if os.path.exists(filename):
+        return _require('pyarrow.parquet').read_table(filename, memory_map=True)
+    raise FileNotFoundError('No exported {} table in {}'.format(name, directory))
+
+
+def load_tables(directory=EXPORT_DIR, tables=None):
+    """Load exported tables
+
+    Args:
+        directory (str, optional): Directory written by export_tables()
+        tables (:obj:`list`, optional): Names of the tables to load,
+            default all of TABLES
+
+    Returns:
+        dict: pyarrow.Table by table name
+    """
+    with METRICS.timer('columnar load'):
+        return {name: load_table(directory, name) for name in tables or TABLES}
+
+
+def load_frames(directory=EXPORT_DIR, tables=None):
+    """Load exported tables as Pandas DataFrames
+
+    Dictionary encoded columns become categoricals.
+
+    Args:
+        directory (str, optional): Directory written by export_tables()
+        tables (:obj:`list`, optional): Names of the tables to load,
+            default all of TABLES
+
+    Returns:
+        dict: pandas.DataFrame by table name
+    """
+    _require('pandas')
+    return {name: table.to_pandas() for name, table in load_tables(directory, tables).items()}
+
+
+if __name__ == "__main__":
+    import argparse
+    import apiaccess as aa
+    from constants import ACADEMY
+    from metrics import METRICS_FILE
+
+    parser = argparse.ArgumentParser(description='Export stored games as columnar tables')
+    parser.add_argument('-t', '--type', dest='types', action='append', type=aa.game_type,
+                        help='game type to export, can be given several times (default: academy)')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='arrow',
+                        help='file format of the tables (default: %(default)s)')
+    parser.add_argument('--dir', default=EXPORT_DIR,
+                        help='directory of the Academy tables, other types get the type '
+                             'name appended (default: %(default)s)')
+    parser.add_argument('--metrics', metavar='FILE', default=METRICS_FILE,
+                        help='where to write the run time metrics (default: %(default)s)')
+    args = parser.parse_args()
+    for gametype in args.types or [ACADEMY]:
+        conn = datastore.connect(aa.shard_file(aa.DB_FILE, gametype))
+        directory = aa.shard_file(args.dir, gametype)
+        counts = export_tables(conn, directory, args.format)
+        conn.close()
+        print('{}: {}'.format(directory, ', '.join('{} {}'.format(n, t) for t, n in counts.items())))
+    METRICS.write(args.metrics)
@@ -22,7 +22,11 @@ RACES={ 1: 'The Solar Federation',
         4: 'The Fascist Empire',
         5: 'The Robotic Imperium',
         6: 'The Rebel Confederation',
-        7: 'The Missing Colonies of Man'}
+        7: 'The Missing Colonies of Man',
+        8: 'The Privateer Bands',
+        9: 'The Cyborg',
+        10: 'The Crystal Confederation',
+        11: 'The Evil Empire'}
 
 SHORTRACES={ 'The Solar Federation': 'Feds',
              'The Lizard Alliance': 'Lizards',
@@ -30,4 +34,36 @@ SHORTRACES={ 'The Solar Federation': 'Feds',
              'The Fascist Empire': 'Fascists',
              'The Robotic Imperium': 'Robots',
              'The Rebel Confederation': 'Rebels',
-             'The Missing Colonies of Man': 'Colos'}
+             'The Missing Colonies of Man': 'Colos',
+             'The Privateer Bands': 'Privateers',
+             'The Cyborg': 'Cyborg',
+             'The Crystal Confederation': 'Crystals',
+             'The Evil Empire': 'Empire'}
+
+# Race IDs by race name. In Academy games the race ID is the same as the
+# game slot, the other races were added later and come after them
+RACE_IDS={ name: raceid for raceid, name in RACES.items() }
+
+# Race IDs of the Academy races
+ACADEMY_RACES=[ 1, 2, 3, 4, 5, 6, 7 ]
+
+# Race IDs by the 'raceid' of a player in other game types
+API_RACES={ 1: 1, 2: 2, 3: 3, 4: 4, 5: 8, 6: 9, 7: 10, 8: 11, 9: 5, 10: 6, 11: 7 }
+
+# Game type names by the 'gametype' number used in the API
+ACADEMY=7
+GAME_TYPES={ 1: 'Training',
+             2: 'Standard',
+             3: 'Team',
+             4: 'Melee',
+             5: 'Blitz',
+             6: 'Championship',
+             7: 'Academy' }
+
+# Score fields kept from the final score of every player
+SCORE_KEYS=[ 'capitalships',
+             'freighters',
+             'planets',
+             'starbases',
+             'militaryscore',
+             'percent' ]
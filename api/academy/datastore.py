@@ -0,0 +1,764 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""SQLite storage for game and player data.
+
+Games are written one by one, replacing everything stored for a game
+when it is read again, so an update only touches the rows of the games
+that changed. load_dataset() returns the data as model.Dataset, while
+load_data() returns the same dict layout that used to be kept in
+player_data.json:
+
+    {'games': {gameid: game},
+     'players': {name: {'accountid': id, gameid: {'race': [...],
+                                                  'status': [...],
+                                                  'score': {...}}}},
+     'gamecount': number of games,
+     'watermarks': {gameid: [status, turn, dateended]}}
+
+Next to the game data the store keeps the aggregates the reports are
+built from: the per player, race and end state counts of
+player_stats.csv, the game index of game_stats.csv, sorted by
+creation date and with the race of the winner resolved, and the race
+matchups and player head-to-head results (see matchups.py). save_games()
+subtracts what a game contributed before replacing it and adds its new
+contribution afterwards, so the aggregates are never recomputed from
+all games.
+
+Players are stored under the canonical name of their account (see
+identity.py). The accounts table maps every account ID to that name and
+the aliases table keeps every name an account was seen with, so the
+identity index is loaded with the data instead of being rebuilt from
+the events of all games. Stores written before the index existed are
+migrated once, merging players that share an account ID.
+
+Ratings (see ratings.py) are kept as a history of the rating every
+player and race had after each game, so they can be rewound to any
+point in time and games rated from there on. The latest rating of every
+player and race is kept in a table of its own, so reading the current
+ratings does not go through the history.
+"""
+
+import os
+import json
+import sqlite3
+
+import identity
+
+from constants import RACE_IDS, SCORE_KEYS
+from model import Dataset, Game, Participation, Score, GAME_FIELDS, STATUS_IDS
+
+
+DB_FILE = 'player_data.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    status TEXT,
+    datecreated TEXT,
+    dateended TEXT,
+    turn INTEGER,
+    winner
+);
+CREATE INDEX IF NOT EXISTS games_status ON games (status);
+
+CREATE TABLE IF NOT EXISTS players (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    accountid INTEGER
+);
+CREATE INDEX IF NOT EXISTS players_accountid ON players (accountid);
+
+CREATE TABLE IF NOT EXISTS participations (
+    game_id INTEGER NOT NULL,
+    player_id INTEGER NOT NULL,
+    PRIMARY KEY (game_id, player_id)
+);
+CREATE INDEX IF NOT EXISTS participations_player ON participations (player_id);
+
+CREATE TABLE IF NOT EXISTS races (
+    game_id INTEGER NOT NULL,
+    player_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    race TEXT NOT NULL,
+    PRIMARY KEY (game_id, player_id, seq)
+);
+CREATE INDEX IF NOT EXISTS races_race ON races (race);
+CREATE INDEX IF NOT EXISTS races_player ON races (player_id);
+
+CREATE TABLE IF NOT EXISTS status_events (
+    game_id INTEGER NOT NULL,
+    player_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    what TEXT NOT NULL,
+    turn INTEGER,
+    PRIMARY KEY (game_id, player_id, seq)
+);
+CREATE INDEX IF NOT EXISTS status_events_player ON status_events (player_id);
+
+CREATE TABLE IF NOT EXISTS scores (
+    game_id INTEGER NOT NULL,
+    player_id INTEGER NOT NULL,
+    finished INTEGER NOT NULL,
+    rank INTEGER,
+    capitalships,
+    freighters,
+    planets,
+    starbases,
+    militaryscore,
+    percent,
+    PRIMARY KEY (game_id, player_id)
+);
+CREATE INDEX IF NOT EXISTS scores_player ON scores (player_id);
+
+CREATE TABLE IF NOT EXISTS player_counts (
+    player_id INTEGER NOT NULL,
+    race TEXT NOT NULL,
+    endstate TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (player_id, race, endstate)
+);
+
+CREATE TABLE IF NOT EXISTS game_index (
+    game_id INTEGER PRIMARY KEY,
+    datecreated TEXT,
+    race TEXT
+);
+CREATE INDEX IF NOT EXISTS game_index_created ON game_index (datecreated, game_id);
+
+CREATE TABLE IF NOT EXISTS race_matchups (
+    race TEXT NOT NULL,
+    opponent TEXT NOT NULL,
+    games INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    ahead INTEGER NOT NULL,
+    rank_sum INTEGER NOT NULL,
+    PRIMARY KEY (race, opponent)
+);
+
+CREATE TABLE IF NOT EXISTS head_to_head (
+    player_id INTEGER NOT NULL,
+    opponent_id INTEGER NOT NULL,
+    games INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    ahead INTEGER NOT NULL,
+    PRIMARY KEY (player_id, opponent_id)
+);
+
+CREATE TABLE IF NOT EXISTS rating_history (
+    kind TEXT NOT NULL,
+    entity TEXT NOT NULL,
+    datecreated TEXT NOT NULL,
+    game_id INTEGER NOT NULL,
+    rating REAL NOT NULL,
+    PRIMARY KEY (kind, entity, datecreated, game_id)
+);
+CREATE INDEX IF NOT EXISTS rating_history_game ON rating_history (datecreated, game_id);
+
+CREATE TABLE IF NOT EXISTS current_ratings (
+    kind TEXT NOT NULL,
+    entity TEXT NOT NULL,
+    rating REAL NOT NULL,
+    games INTEGER NOT NULL,
+    PRIMARY KEY (kind, entity)
+);
+
+CREATE TABLE IF NOT EXISTS rated_games (
+    game_id INTEGER PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS accounts (
+    accountid INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS aliases (
+    alias TEXT NOT NULL,
+    accountid INTEGER NOT NULL,
+    PRIMARY KEY (alias, accountid)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+
+CREATE TEMP TABLE IF NOT EXISTS changed_games (
+    id INTEGER PRIMARY KEY
+);
+"""
+
+# Tables holding per game rows, children before parents
+GAME_TABLES = ['scores', 'status_events', 'races', 'participations', 'games']
+
+# Version of the aggregate tables, stores with an older one are rebuilt
+AGGREGATES_VERSION = 2
+# Version of the identity tables, stores with an older one are migrated
+IDENTITY_VERSION = 1
+# Version of the current ratings table, stores with an older one are filled
+RATINGS_VERSION = 1
+# Tables referring to players by ID
+PLAYER_TABLES = ['participations', 'races', 'status_events', 'scores']
+
+# End states counted per player and race, by the first race a player had
+# in a game, in the column order of player_stats.csv. Every select gives
+# (player_id, race, endstate) rows, {scope} limits them to some games.
+ENDSTATE_QUERY = """
+SELECT r.player_id, r.race, 'finished' AS endstate FROM scores s
+    JOIN races r ON r.game_id = s.game_id AND r.player_id = s.player_id AND r.seq = 0
+    WHERE s.finished = 1 {scope}
+UNION ALL
+SELECT r.player_id, r.race, 'won' FROM scores s
+    JOIN races r ON r.game_id = s.game_id AND r.player_id = s.player_id AND r.seq = 0
+    WHERE s.finished = 1 AND s.rank = 1 {scope}
+UNION ALL
+SELECT r.player_id, r.race, CASE e.what WHEN 'dead' THEN 'died' ELSE e.what END
+    FROM status_events e
+    JOIN races r ON r.game_id = e.game_id AND r.player_id = e.player_id AND r.seq = 0
+    WHERE e.what IN ('dropped', 'resigned', 'dead') {scope}
+"""
+# Race of the winner of every finished game
+GAME_INDEX_QUERY = """
+SELECT g.id, g.datecreated, CASE WHEN g.status = 'Finished' THEN r.race END FROM games g
+    LEFT JOIN players p ON p.name = g.winner
+    LEFT JOIN races r ON r.game_id = g.id AND r.player_id = p.id AND r.seq = 0
+    WHERE 1 {scope}
+"""
+# Race and final rank of the player who ended each slot of a finished game
+SLOTS_QUERY = """
+WITH slots AS (SELECT s.game_id, s.player_id, r.race, s.rank FROM scores s
+    JOIN races r ON r.game_id = s.game_id AND r.player_id = s.player_id AND r.seq = 0
+    JOIN games g ON g.id = s.game_id
+    WHERE g.status = 'Finished' AND s.rank > 0 {scope})
+"""
+# Every race against itself counts all games of the race, against another
+# race the games both played in
+RACE_MATCHUP_QUERY = SLOTS_QUERY + """
+SELECT race, race, COUNT(*), SUM(rank = 1), 0, SUM(rank) FROM slots GROUP BY race
+UNION ALL
+SELECT a.race, b.race, COUNT(*), SUM(a.rank = 1), SUM(a.rank < b.rank), SUM(a.rank) FROM slots a
+    JOIN slots b ON b.game_id = a.game_id AND b.race != a.race
+    GROUP BY a.race, b.race
+"""
+HEAD_TO_HEAD_QUERY = SLOTS_QUERY + """
+SELECT a.player_id, b.player_id, COUNT(*), SUM(a.rank = 1), SUM(a.rank < b.rank) FROM slots a
+    JOIN slots b ON b.game_id = a.game_id AND b.player_id != a.player_id
+    GROUP BY a.player_id, b.player_id
+"""
+
+
+def connect(filename=DB_FILE):
+    """Open the data store, creating the tables if needed
+
+    Args:
+        filename (str, optional): SQLite database file
+
+    Returns:
+        sqlite3.Connection
+    """
+    conn = sqlite3.connect(filename)
+    conn.executescript(SCHEMA)
+    row = conn.execute("SELECT value FROM meta WHERE key = 'identity'").fetchone()
+    if row is None or row[0] != IDENTITY_VERSION:
+        migrate_identity(conn)
+    row = conn.execute("SELECT value FROM meta WHERE key = 'aggregates'").fetchone()
+    if row is None or row[0] != AGGREGATES_VERSION:
+        rebuild_aggregates(conn)
+    row = conn.execute("SELECT value FROM meta WHERE key = 'ratings'").fetchone()
+    if row is None or row[0] != RATINGS_VERSION:
+        with conn:
+            _update_current_ratings(conn, conn.execute(
+                'SELECT DISTINCT kind, entity FROM rating_history').fetchall())
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('ratings', ?)", (RATINGS_VERSION,))
+    return conn
+
+
+def is_empty(conn):
+    """Check whether any game is stored yet"""
+    return conn.execute('SELECT 1 FROM games LIMIT 1').fetchone() is None
+
+
+def _player_id(conn, name, accountid):
+    # The first account ID seen for a name is kept
+    conn.execute('INSERT OR IGNORE INTO players (name, accountid) VALUES (?, ?)',
+                 (name, accountid))
+    pid, stored_account = conn.execute('SELECT id, accountid FROM players WHERE name = ?',
+                                       (name,)).fetchone()
+    if stored_account is None and accountid is not None:
+        conn.execute('UPDATE players SET accountid = ? WHERE id = ?', (accountid, pid))
+    return pid
+
+
+def load_identity(conn):
+    """Load the identity index of all accounts in the store
+
+    Returns:
+        identity.IdentityIndex
+    """
+    index = identity.IdentityIndex()
+    for accountid, name in conn.execute('SELECT accountid, name FROM accounts'):
+        index.add(accountid, name)
+    for alias, accountid in conn.execute('SELECT alias, accountid FROM aliases'):
+        index.add(accountid, index.name(accountid), alias)
+    for name, in conn.execute('SELECT name FROM players WHERE accountid IS NULL'):
+        index.unknown.add(name)
+    return index
+
+
+def _save_identity(conn, index):
+    accounts, aliases = index.pending()
+    conn.executemany('INSERT OR REPLACE INTO accounts VALUES (?, ?)', accounts)
+    conn.executemany('INSERT OR IGNORE INTO aliases VALUES (?, ?)', aliases)
+    return accounts, aliases
+
+
+def migrate_identity(conn):
+    """Fill the identity tables of a store written before they existed
+
+    Every account keeps the name of its oldest player row. Players with
+    the same account ID under other names were stored separately before,
+    their games are moved to that player. If any were merged, the
+    aggregates are rebuilt and all games rated again.
+
+    Returns:
+        bool: True if any players were merged
+    """
+    index = identity.IdentityIndex()
+    merged = {}
+    with conn:
+        for pid, name, accountid in conn.execute(
+                'SELECT id, name, accountid FROM players ORDER BY id').fetchall():
+            if not accountid:
+                continue
+            canonical = index.name(accountid)
+            index.resolve(accountid, name)
+            if canonical is not None:
+                merged[pid] = canonical
+        for pid, canonical in merged.items():
+            keep, = conn.execute('SELECT id FROM players WHERE name = ?', (canonical,)).fetchone()
+            for table in PLAYER_TABLES:
+                # A player in a game under two names keeps the first one
+                conn.execute('UPDATE OR IGNORE {} SET player_id = ? WHERE player_id = ?'.format(table),
+                             (keep, pid))
+                conn.execute('DELETE FROM {} WHERE player_id = ?'.format(table), (pid,))
+            conn.execute('UPDATE games SET winner = ? WHERE winner = '
+                         '(SELECT name FROM players WHERE id = ?)', (canonical, pid))
+            conn.execute('DELETE FROM players WHERE id = ?', (pid,))
+        conn.execute('DELETE FROM accounts')
+        conn.execute('DELETE FROM aliases')
+        _save_identity(conn, index)
+        if merged:
+            conn.execute('DELETE FROM rating_history')
+            conn.execute('DELETE FROM current_ratings')
+            conn.execute('DELETE FROM rated_games')
+            conn.execute("DELETE FROM meta WHERE key = 'aggregates'")
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('identity', ?)", (IDENTITY_VERSION,))
+    return bool(merged)
+
+
+def delete_games(conn, gameids):
+    """Remove all rows belonging to the given games
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        gameids (:obj:`list`): IDs of the games to remove
+    """
+    rows = [(int(gid),) for gid in gameids]
+    for table in GAME_TABLES:
+        column = 'id' if table == 'games' else 'game_id'
+        conn.executemany('DELETE FROM {} WHERE {} = ?'.format(table, column), rows)
+
+
+def _update_aggregates(conn, sign):
+    """Add the contribution of the games in changed_games to the aggregates,
+    or subtract it for a negative sign"""
+    query = ENDSTATE_QUERY.format(scope='AND r.game_id IN (SELECT id FROM changed_games)')
+    counts = [(pid, race, state, sign * n) for pid, race, state, n in conn.execute(
+        'SELECT player_id, race, endstate, COUNT(*) FROM (' + query + ') '
+        'GROUP BY player_id, race, endstate')]
+    conn.executemany(
+        'INSERT INTO player_counts VALUES (?, ?, ?, ?) ON CONFLICT (player_id, race, endstate) '
+        'DO UPDATE SET count = count + excluded.count', counts)
+    scope = 'AND s.game_id IN (SELECT id FROM changed_games)'
+    matchups = [(race, opponent) + tuple(sign * n for n in counts) for race, opponent, *counts
+                in conn.execute(RACE_MATCHUP_QUERY.format(scope=scope))]
+    conn.executemany(
+        'INSERT INTO race_matchups VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (race, opponent) '
+        'DO UPDATE SET games = games + excluded.games, wins = wins + excluded.wins, '
+        'ahead = ahead + excluded.ahead, rank_sum = rank_sum + excluded.rank_sum', matchups)
+    pairs = [(pid, opponent) + tuple(sign * n for n in counts) for pid, opponent, *counts
+             in conn.execute(HEAD_TO_HEAD_QUERY.format(scope=scope))]
+    conn.executemany(
+        'INSERT INTO head_to_head VALUES (?, ?, ?, ?, ?) ON CONFLICT (player_id, opponent_id) '
+        'DO UPDATE SET games = games + excluded.games, wins = wins + excluded.wins, '
+        'ahead = ahead + excluded.ahead', pairs)
+    if sign > 0:
+        conn.execute('INSERT INTO game_index ' + GAME_INDEX_QUERY.format(
+            scope='AND g.id IN (SELECT id FROM changed_games)'))
+    else:
+        # Only the rows just subtracted from can have dropped to zero
+        conn.executemany('DELETE FROM player_counts WHERE player_id = ? AND race = ? '
+                         'AND endstate = ? AND count = 0', [row[:3] for row in counts])
+        conn.executemany('DELETE FROM race_matchups WHERE race = ? AND opponent = ? AND games = 0',
+                         [row[:2] for row in matchups])
+        conn.executemany('DELETE FROM head_to_head WHERE player_id = ? AND opponent_id = ? '
+                         'AND games = 0', [row[:2] for row in pairs])
+        conn.execute('DELETE FROM game_index WHERE game_id IN (SELECT id FROM changed_games)')
+
+
+def rebuild_aggregates(conn):
+    """Compute the aggregate tables from all stored games
+
+    Only needed for stores written before the aggregates existed,
+    save_games() keeps them up to date.
+    """
+    with conn:
+        conn.execute('DELETE FROM player_counts')
+        conn.execute('DELETE FROM game_index')
+        conn.execute('DELETE FROM race_matchups')
+        conn.execute('DELETE FROM head_to_head')
+        conn.execute(
+            'INSERT INTO player_counts SELECT player_id, race, endstate, COUNT(*) FROM ('
+            + ENDSTATE_QUERY.format(scope='') + ') GROUP BY player_id, race, endstate')
+        conn.execute('INSERT INTO race_matchups ' + RACE_MATCHUP_QUERY.format(scope=''))
+        conn.execute('INSERT INTO head_to_head ' + HEAD_TO_HEAD_QUERY.format(scope=''))
+        conn.execute('INSERT INTO game_index ' + GAME_INDEX_QUERY.format(scope=''))
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('aggregates', ?)", (AGGREGATES_VERSION,))
+
+
+def save_games(conn, games, players, gameids, index=None):
+    """Store or replace the data of some games in one transaction
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        games (dict): Game data by game ID, must contain all of `gameids`
+        players (dict): Player stats as built by get_game_players(),
+            only entries of games in `gameids` are stored
+        gameids (:obj:`list`): IDs of the games to store
+        index (identity.IdentityIndex, optional): Identity index the
+            players were named with, its new entries are stored as well
+    """
+    gameids = set(str(gid) for gid in gameids)
+    with conn:
+        if index is not None:
+            saved = _save_identity(conn, index)
+        conn.execute('DELETE FROM changed_games')
+        conn.executemany('INSERT INTO changed_games VALUES (?)', [(int(gid),) for gid in gameids])
+        _update_aggregates(conn, -1)
+        # Changed games need to be rated again
+        conn.execute('DELETE FROM rated_games WHERE game_id IN (SELECT id FROM changed_games)')
+        delete_games(conn, gameids)
+        conn.executemany(
+            'INSERT INTO games (id, name, status, datecreated, dateended, turn, winner) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(int(gid), games[gid]['name'], games[gid]['status'],
+              games[gid]['datecreated'], games[gid]['dateended'],
+              games[gid]['turn'], games[gid]['winner']) for gid in gameids])
+        for name, player in players.items():
+            mine = gameids.intersection(player)
+            if not mine:
+                continue
+            pid = _player_id(conn, name, player.get('accountid'))
+            for gid in mine:
+                stats = player[gid]
+                gid = int(gid)
+                conn.execute('INSERT INTO participations VALUES (?, ?)', (gid, pid))
+                conn.executemany('INSERT INTO races VALUES (?, ?, ?, ?)',
+                                 [(gid, pid, i, race) for i, race in enumerate(stats['race'])])
+                conn.executemany('INSERT INTO status_events VALUES (?, ?, ?, ?, ?)',
+                                 [(gid, pid, i, s['what'], s['when'])
+                                  for i, s in enumerate(stats['status'])])
+                if 'score' in stats:
+                    score = stats['score']
+                    conn.execute('INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 [gid, pid, score['finished'], score['rank']]
+                                 + [score.get(k) for k in SCORE_KEYS])
+        _update_aggregates(conn, 1)
+    if index is not None:
+        index.saved(*saved)
+
+
+def load_watermarks(conn):
+    """Return the watermark of every stored game
+
+    Returns:
+        dict: [status, turn, dateended] by game ID
+    """
+    return {str(gid): [status, turn, dateended] for gid, status, turn, dateended
+            in conn.execute('SELECT id, status, turn, dateended FROM games')}
+
+
+def _load_players(conn, dataset, player_id=None):
+    if player_id is None:
+        where, params = '', ()
+    else:
+        where, params = ' WHERE player_id = ?', (player_id,)
+
+    players = {}
+    for pid, name, accountid in conn.execute(
+            'SELECT id, name, accountid FROM players WHERE id IN '
+            '(SELECT player_id FROM participations' + where + ') ORDER BY id', params):
+        players[pid] = dataset.player(name, accountid)
+
+    parts = {}
+    for gid, pid in conn.execute(
+            'SELECT game_id, player_id FROM participations' + where, params):
+        parts[gid, pid] = players[pid].games[gid] = Participation()
+    races = {}
+    for gid, pid, race in conn.execute(
+            'SELECT game_id, player_id, race FROM races' + where
+            + ' ORDER BY game_id, player_id, seq', params):
+        races.setdefault((gid, pid), []).append(RACE_IDS[race])
+    for key, value in races.items():
+        parts[key].races = tuple(value)
+    status = {}
+    for gid, pid, what, turn in conn.execute(
+            'SELECT game_id, player_id, what, turn FROM status_events' + where
+            + ' ORDER BY game_id, player_id, seq', params):
+        status.setdefault((gid, pid), []).append((STATUS_IDS[what], turn))
+    for key, value in status.items():
+        parts[key].status = tuple(value)
+    for row in conn.execute(
+            'SELECT game_id, player_id, finished, rank, ' + ', '.join(SCORE_KEYS)
+            + ' FROM scores' + where, params):
+        parts[row[0], row[1]].score = Score(*row[2:])
+
+
+def load_player_counts(conn):
+    """Load the aggregated end state counts of all players
+
+    Returns:
+        names (list): Names of all players that took part in a game
+        counts (list): (name, race, end state, count) rows
+    """
+    names = [name for name, in conn.execute(
+        'SELECT name FROM players WHERE id IN (SELECT player_id FROM participations) ORDER BY id')]
+    counts = conn.execute(
+        'SELECT p.name, c.race, c.endstate, c.count FROM player_counts c '
+        'JOIN players p ON p.id = c.player_id').fetchall()
+    return names, counts
+
+
+def load_accounts(conn):
+    """Load the account ID of every player
+
+    Returns:
+        list: (name, account ID) rows, oldest player first
+    """
+    return conn.execute('SELECT name, accountid FROM players ORDER BY id').fetchall()
+
+
+def load_matchups(conn):
+    """Load the aggregated race matchups and head-to-head results
+
+    Returns:
+        races (list): (race, opponent, games, wins, ahead, rank sum) rows
+        pairs (list): (player, opponent, games, wins, ahead) rows
+    """
+    races = conn.execute('SELECT race, opponent, games, wins, ahead, rank_sum '
+                         'FROM race_matchups').fetchall()
+    pairs = conn.execute(
+        'SELECT p.name, o.name, h.games, h.wins, h.ahead FROM head_to_head h '
+        'JOIN players p ON p.id = h.player_id JOIN players o ON o.id = h.opponent_id').fetchall()
+    return races, pairs
+
+
+def game_index(conn):
+    """Iterate over all games, oldest first
+
+    Yields:
+        dict: The game data plus the race of the winner as 'race',
+            'No Race' if the game is not finished or the winner unknown
+    """
+    for row in conn.execute(
+            'SELECT g.id, g.name, g.status, g.datecreated, g.dateended, g.turn, g.winner, i.race '
+            'FROM game_index i JOIN games g ON g.id = i.game_id ORDER BY i.datecreated, i.game_id'):
+        game = dict(zip(GAME_FIELDS, row))
+        game['race'] = row[-1] or 'No Race'
+        yield game
+
+
+def unrated_games(conn):
+    """Return the earliest finished game that has not been rated yet
+
+    Returns:
+        tuple: (datecreated, game ID) or None if all games are rated
+    """
+    return conn.execute(
+        "SELECT datecreated, id FROM games WHERE status = 'Finished' "
+        'AND id NOT IN (SELECT game_id FROM rated_games) '
+        'ORDER BY datecreated, id LIMIT 1').fetchone()
+
+
+def load_ratings(conn, before=None):
+    """Load the latest rating of every player and race
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        before (tuple, optional): (datecreated, game ID), only ratings
+            from games before this one count. Without it the current
+            ratings are read, which does not go through the history
+
+    Returns:
+        dict: (rating, number of rated games) by (kind, entity)
+    """
+    if before is None:
+        return {(kind, entity): (rating, games) for kind, entity, rating, games in conn.execute(
+            'SELECT kind, entity, rating, games FROM current_ratings')}
+    return {(kind, entity): (rating, games) for kind, entity, rating, games in conn.execute(
+        'SELECT kind, entity, rating, games FROM ('
+        'SELECT kind, entity, rating, COUNT(*) OVER (PARTITION BY kind, entity) AS games, '
+        'ROW_NUMBER() OVER (PARTITION BY kind, entity ORDER BY datecreated DESC, game_id DESC) AS latest '
+        'FROM rating_history WHERE (datecreated, game_id) < (?, ?)) WHERE latest = 1', tuple(before))}
+
+
+def rating_rows(conn, since=None):
+    """Return the participations in finished games, in game order
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        since (tuple, optional): (datecreated, game ID) of the first game
+
+    Returns:
+        list: (datecreated, game ID, player name, first race, rank) rows,
+            the rank is None for players without a final score
+    """
+    where, params = '', ()
+    if since is not None:
+        where, params = ' AND (g.datecreated, g.id) >= (?, ?)', tuple(since)
+    return conn.execute(
+        'SELECT g.datecreated, g.id, p.name, r.race, s.rank FROM games g '
+        'JOIN participations pa ON pa.game_id = g.id '
+        'JOIN players p ON p.id = pa.player_id '
+        'LEFT JOIN races r ON r.game_id = g.id AND r.player_id = pa.player_id AND r.seq = 0 '
+        'LEFT JOIN scores s ON s.game_id = g.id AND s.player_id = pa.player_id '
+        "WHERE g.status = 'Finished'" + where
+        + ' ORDER BY g.datecreated, g.id, pa.player_id', params).fetchall()
+
+
+def save_ratings(conn, since, history):
+    """Replace the ratings of all games from a point in time on
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        since (tuple): (datecreated, game ID) of the first rated game
+        history (list): (kind, entity, datecreated, game ID, rating) rows
+    """
+    with conn:
+        # Players and races whose latest rating changes
+        changed = set(conn.execute('SELECT DISTINCT kind, entity FROM rating_history '
+                                   'WHERE (datecreated, game_id) >= (?, ?)', tuple(since)))
+        changed.update((kind, entity) for kind, entity, *_ in history)
+        conn.execute('DELETE FROM rating_history WHERE (datecreated, game_id) >= (?, ?)',
+                     tuple(since))
+        conn.executemany('INSERT INTO rating_history VALUES (?, ?, ?, ?, ?)', history)
+        _update_current_ratings(conn, changed)
+        conn.execute(
+            'INSERT OR IGNORE INTO rated_games SELECT id FROM games '
+            "WHERE status = 'Finished' AND (datecreated, id) >= (?, ?)", tuple(since))
+
+
+def _update_current_ratings(conn, entities):
+    """Copy the latest rating of some players and races from the history
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        entities (iterable): (kind, entity) pairs
+    """
+    entities = list(entities)
+    conn.executemany('DELETE FROM current_ratings WHERE kind = ? AND entity = ?', entities)
+    conn.executemany(
+        'INSERT INTO current_ratings SELECT kind, entity, rating, '
+        '(SELECT COUNT(*) FROM rating_history h WHERE h.kind = r.kind AND h.entity = r.entity) '
+        'FROM rating_history r WHERE kind = ? AND entity = ? '
+        'ORDER BY datecreated DESC, game_id DESC LIMIT 1', entities)
+
+
+def load_dataset(conn):
+    """Load all stored games and players
+
+    Returns:
+        model.Dataset
+    """
+    dataset = Dataset()
+    for row in conn.execute(
+            'SELECT id, name, status, datecreated, dateended, turn, winner FROM games'):
+        dataset.add_game(Game(*row))
+    _load_players(conn, dataset)
+    return dataset
+
+
+def load_data(conn):
+    """Load all stored games and players
+
+    Returns:
+        dict: Data in the layout described in the module documentation
+    """
+    return load_dataset(conn).to_data()
+
+
+def player_games(conn, name):
+    """Load the stats of a single player
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        name (str): Player name, any name the player was seen with
+
+    Returns:
+        model.Player: The player and their games, or None
+    """
+    row = conn.execute('SELECT id FROM players WHERE name = ?', (name,)).fetchone()
+    if row is None:
+        # Renamed players are stored under the first name of their account
+        row = conn.execute(
+            'SELECT p.id, p.name FROM aliases a JOIN accounts c ON c.accountid = a.accountid '
+            'JOIN players p ON p.name = c.name WHERE a.alias = ? ORDER BY p.id', (name,)).fetchone()
+        if row is None:
+            return None
+        name = row[1]
+    dataset = Dataset()
+    _load_players(conn, dataset, row[0])
+    return dataset.players.get(name)
+
+
+def import_json(conn, filename):
+    """Copy the contents of an old player_data.json file into the store
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        filename (str): JSON file as written by earlier versions
+    """
+    with open(filename, 'r') as f:
+        data = json.load(f)
+    save_games(conn, data['games'], data['players'], data['games'].keys())
+    # The file has no identity index, it is derived like for old stores
+    if migrate_identity(conn):
+        rebuild_aggregates(conn)
+
+
+def export_json(conn, filename):
+    """Write the stored data to a JSON file in the old player_data.json layout
+
+    The file is written under a temporary name first and then renamed,
+    so an interrupted export never leaves a broken file behind.
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        filename (str): File to write
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(load_data(conn), f)
+    os.replace(tmp, filename)
@@ -0,0 +1,113 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Player identity by account ID.
+
+Events name players by their display name at the time, which can
+change. The index maps every account ID to one canonical name, the
+first name seen for the account, and keeps every name ever seen as an
+alias. Player data is always stored under the canonical name, so a
+renamed player stays one player. Players without an account ID can
+only be told apart by name, but they never merge with an account that
+goes by the same name.
+
+The index is kept in the data store (see datastore.load_identity()),
+so names of accounts seen in earlier runs resolve without looking at
+their events again."""
+
+
+class IdentityIndex:
+    """Canonical player names by account ID, plus all their aliases
+
+    Attributes:
+        names (dict): Canonical name by account ID
+        owners (dict): Account ID by canonical name
+        aliases (dict): Set of account IDs by every name seen
+        unknown (set): Names of players seen without an account ID
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.owners = {}
+        self.aliases = {}
+        self.unknown = set()
+        # Entries not written to the data store yet
+        self._new_accounts = []
+        self._new_aliases = []
+
+    def add(self, accountid, name, alias=None):
+        """Register a known account, e.g. when loading the index"""
+        self.names[accountid] = name
+        self.owners[name] = accountid
+        self.aliases.setdefault(name, set()).add(accountid)
+        if alias is not None:
+            self.aliases.setdefault(alias, set()).add(accountid)
+
+    def resolve(self, accountid, name):
+        """Return the canonical name for a name seen with an account ID
+
+        New accounts and names are added to the index. Without an
+        account ID the name is returned as it is, unless an account
+        already goes by it, and an account never gets a name that a
+        player without account ID uses; such names get '#' and the
+        account ID appended, '#0' without account ID.
+
+        Args:
+            accountid (int): Account ID, 0 or None if unknown
+            name (str): Display name as found in an event
+
+        Returns:
+            str: Canonical name of the account
+        """
+        if not accountid:
+            if name in self.owners:
+                name = '{} #0'.format(name)
+            self.unknown.add(name)
+            return name
+        canonical = self.names.get(accountid)
+        if canonical is None:
+            canonical = name
+            if canonical in self.owners or canonical in self.unknown:
+                # Another player already goes by this name
+                canonical = '{} #{}'.format(name, accountid)
+            self.names[accountid] = canonical
+            self.owners[canonical] = accountid
+            self._new_accounts.append((accountid, canonical))
+        accounts = self.aliases.setdefault(name, set())
+        if accountid not in accounts:
+            accounts.add(accountid)
+            self._new_aliases.append((name, accountid))
+        return canonical
+
+    def name(self, accountid):
+        """Return the canonical name of an account ID or None"""
+        return self.names.get(accountid)
+
+    def lookup(self, name):
+        """Return the canonical names of all accounts that used a name"""
+        return sorted(self.names[accountid] for accountid in self.aliases.get(name, ()))
+
+    def pending(self):
+        """Return the accounts and aliases not written to the data store yet
+
+        Returns:
+            accounts (list): (account ID, canonical name) pairs
+            aliases (list): (name, account ID) pairs
+        """
+        return list(self._new_accounts), list(self._new_aliases)
+
+    def saved(self, accounts, aliases):
+        """Mark entries returned by pending() as written"""
+        del self._new_accounts[:len(accounts)]
+        del self._new_aliases[:len(aliases)]
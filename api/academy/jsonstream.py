@@ -0,0 +1,242 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Incremental decoding of JSON arrays.
+
+The API answers every request with one JSON document, and the list of
+games grows with every game ever played. Instead of decoding a whole
+response at once, iter_items() decodes the elements of one array in the
+document while the chunks of the body arrive, so only a single element
+is held in memory at a time. Everything outside of the array is skipped
+without decoding it.
+
+Where an object, array or string ends is found by following brackets
+and strings while the chunks arrive, so every character is looked at
+once, however many chunks a value spans. Only complete values are
+decoded, with the json module."""
+
+import re
+import json
+import codecs
+
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+
+_decoder = json.JSONDecoder()
+# Everything outside of strings up to the next bracket, with complete strings
+_OUTSIDE = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.DOTALL)
+# The rest of a string up to its closing quote or a final backslash
+_STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+# A number, true, false or null, up to the next delimiter
+_SCALAR = re.compile(r'[^,\]}\s]*')
+
+
+def _scan(text, pos, state):
+    """Look for the end of a value in a piece of text
+
+    Args:
+        text (str): Piece of the document
+        pos (int): Where to start in `text`
+        state (list): [depth, in string, escape pending] at `pos`,
+            updated in place
+
+    Returns:
+        int: Position after the end of the value, None if it goes on
+            after `text`
+    """
+    depth, in_string, escape = state
+    end = None
+    while pos < len(text):
+        if escape:
+            pos += 1
+            escape = False
+        elif in_string:
+            pos = _STRING_BODY.match(text, pos).end()
+            if pos == len(text):
+                break
+            if text[pos] == '\\':
+                # Backslash at the end, the escaped character comes next
+                escape = True
+            else:
+                in_string = False
+                if depth == 0:
+                    end = pos + 1
+                    break
+            pos += 1
+        else:
+            pos = _OUTSIDE.match(text, pos).end()
+            if pos == len(text):
+                break
+            char = text[pos]
+            pos += 1
+            if char == '"':
+                # A string going on in the next piece
+                in_string = True
+            elif char in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    end = pos
+                    break
+    state[:] = depth, in_string, escape
+    return end
+
+
+class _Reader:
+    """Text buffer over a stream of byte chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decode = codecs.getincrementaldecoder('utf-8')().decode
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        """Append the next chunk to the buffer, False at the end of the input"""
+        while not self.eof:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.eof = True
+                text = self.decode(b'', True)
+            else:
+                text = self.decode(chunk)
+            if text:
+                # Drop everything already consumed
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self):
+        """Skip whitespace and return the next character, '' at the end"""
+        while True:
+            buf, pos = self.buf, self.pos
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            self.pos = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not self.more():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected {!r} but found {!r}'.format(char, found or 'end of input'))
+        self.pos += 1
+
+    def _extent(self, keep):
+        """Move past the next object, array or string
+
+        Args:
+            keep (bool): Return the text of the value, otherwise it is
+                dropped as soon as it was scanned
+
+        Returns:
+            str: The text of the value if `keep` is set
+        """
+        pieces = []
+        # A string is one value of its own, start right inside it
+        string = self.buf[self.pos] == '"'
+        state = [0, string, False]
+        pos = self.pos + string
+        while True:
+            end = _scan(self.buf, pos, state)
+            if end is not None:
+                if keep:
+                    pieces.append(self.buf[self.pos:end])
+                self.pos = end
+                return ''.join(pieces)
+            if keep:
+                pieces.append(self.buf[self.pos:])
+            # All of the buffer is scanned, the next chunk starts afresh
+            self.buf, self.pos = '', 0
+            if not self.more():
+                raise ValueError('Unterminated value at end of input')
+            pos = 0
+
+    def _scalar(self):
+        """Decode the next number, true, false or null"""
+        while True:
+            end = _SCALAR.match(self.buf, self.pos).end()
+            # A number at the end of the buffer may go on in the next chunk
+            if end < len(self.buf) or not self.more():
+                break
+        text = self.buf[self.pos:end]
+        self.pos = end
+        return _decoder.decode(text)
+
+    def value(self):
+        """Decode the next complete JSON value"""
+        if self.peek() in ('[', '{', '"'):
+            return _decoder.decode(self._extent(True))
+        return self._scalar()
+
+    def skip(self):
+        """Move past the next JSON value without decoding it"""
+        if self.peek() in ('[', '{', '"'):
+            self._extent(False)
+        else:
+            self._scalar()
+
+
+def iter_items(chunks, key=None):
+    """Decode the elements of a JSON array one at a time
+
+    Args:
+        chunks (iterable): The document as UTF-8 encoded byte chunks
+        key (str or list, optional): Name of the array in the top level
+            object, a list of names for an array in nested objects, e.g.
+            ['rst', 'scores'], None if the document itself is the array
+
+    Yields:
+        The decoded array elements
+
+    Raises:
+        KeyError: If an object on the way has no such key
+        ValueError: If the document is not valid JSON
+    """
+    reader = _Reader(chunks)
+    if key is None:
+        keys = []
+    elif isinstance(key, str):
+        keys = [key]
+    else:
+        keys = list(key)
+    for key in keys:
+        reader.expect('{')
+        while True:
+            if reader.peek() == '}':
+                raise KeyError(key)
+            name = reader.value()
+            reader.expect(':')
+            if name == key:
+                break
+            reader.skip()
+            if reader.peek() == ',':
+                reader.pos += 1
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.value()
+        char = reader.peek()
+        reader.pos += 1
+        if char == ']':
+            return
+        if char != ',':
+            raise ValueError("Expected ',' or ']' but found {!r}".format(char or 'end of input'))
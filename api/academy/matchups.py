@@ -0,0 +1,167 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Race matchups and player head-to-head results.
+
+Every finished game is counted once for every pair of slots in it, by
+the race and final rank of the player who ended each slot. For a race
+against another race this gives the games both played in, the games
+the race won with the other one in the game, how often it ranked ahead
+of it and the summed rank of the race, so the win rate of a race when
+another race is in the game and its average rank are simple quotients.
+A race against itself counts all its games. Players are counted against
+each other the same way.
+
+The counts are aggregates of the data store, updated with the games of
+every sync (see datastore.save_games()), so no report has to go through
+all games again. For shards that only have a snapshot they are counted
+from the model with count_matchups(). The race counts of several
+shards are added up as races x races x RACE_FIELDS arrays, the sparse
+player counts as dicts of pairs."""
+
+import numpy as np
+
+from constants import RACES, RACE_IDS
+
+
+# Counts of a race against another race
+RACE_FIELDS = ['games', 'wins', 'ahead', 'rank_sum']
+GAMES, WINS, AHEAD, RANK_SUM = range(len(RACE_FIELDS))
+# Counts of a player against another player
+PAIR_FIELDS = ['games', 'wins', 'ahead']
+
+
+def count_matchups(dataset):
+    """Count the matchups of all finished games of a model
+
+    Gives the same rows as datastore.load_matchups().
+
+    Args:
+        dataset (model.Dataset): All games and players
+
+    Returns:
+        races (list): (race, opponent, games, wins, ahead, rank sum) rows
+        pairs (list): (player, opponent, games, wins, ahead) rows
+    """
+    slots = {}
+    for player, gameid, part in dataset.participations():
+        score = part.score
+        if (dataset.games[gameid].status == 'Finished' and score is not None
+                and score.rank is not None and score.rank > 0 and part.races):
+            slots.setdefault(gameid, []).append((player.name, RACES[part.races[0]], score.rank))
+
+    races = {}
+    pairs = {}
+    for members in slots.values():
+        for name, race, rank in members:
+            counts = races.setdefault((race, race), [0] * len(RACE_FIELDS))
+            counts[GAMES] += 1
+            counts[WINS] += rank == 1
+            counts[RANK_SUM] += rank
+            for other, other_race, other_rank in members:
+                if other == name:
+                    continue
+                result = (1, rank == 1, rank < other_rank)
+                if other_race != race:
+                    counts = races.setdefault((race, other_race), [0] * len(RACE_FIELDS))
+                    for i, n in enumerate(result + (rank,)):
+                        counts[i] += n
+                counts = pairs.setdefault((name, other), [0] * len(PAIR_FIELDS))
+                for i, n in enumerate(result):
+                    counts[i] += n
+    return ([key + tuple(counts) for key, counts in races.items()],
+            [key + tuple(counts) for key, counts in pairs.items()])
+
+
+def race_matrix(rows):
+    """Lay out race matchup rows as an array
+
+    Args:
+        rows (list): (race, opponent, games, wins, ahead, rank sum) rows
+
+    Returns:
+        np.ndarray: races x races x RACE_FIELDS counts, indexed by race
+            ID minus one
+    """
+    matrix = np.zeros((len(RACES), len(RACES), len(RACE_FIELDS)), dtype=np.int64)
+    if rows:
+        race, opponent, *counts = zip(*rows)
+        matrix[[RACE_IDS[r] - 1 for r in race], [RACE_IDS[r] - 1 for r in opponent]] = \
+            np.array(counts, dtype=np.int64).T
+    return matrix
+
+
+def merge_matchups(parts):
+    """Add up the matchups of several shards
+
+    Args:
+        parts (iterable): (race rows, pair rows) as returned by
+            count_matchups() or datastore.load_matchups()
+
+    Returns:
+        matrix (np.ndarray): Summed race counts, see race_matrix()
+        pairs (dict): Summed counts, a PAIR_FIELDS list by
+            (player, opponent)
+    """
+    matrix = np.zeros((len(RACES), len(RACES), len(RACE_FIELDS)), dtype=np.int64)
+    pairs = {}
+    for race_rows, pair_rows in parts:
+        matrix += race_matrix(race_rows)
+        for name, other, *counts in pair_rows:
+            total = pairs.get((name, other))
+            if total is None:
+                pairs[name, other] = counts
+            else:
+                pairs[name, other] = [a + b for a, b in zip(total, counts)]
+    return matrix, pairs
+
+
+def matchup_rows(matrix, races):
+    """Return the rows of race_matchups.csv
+
+    Args:
+        matrix (np.ndarray): See race_matrix()
+        races (list): Race IDs to show
+
+    Returns:
+        list: (race, opponent, games, wins, win rate, share of games
+            ranked ahead, average rank) for every pair of races that met,
+            the opponent is 'All' for the totals of a race
+    """
+    rows = []
+    for race in races:
+        for opponent in races:
+            games, wins, ahead, rank_sum = matrix[race - 1, opponent - 1].tolist()
+            if not games:
+                continue
+            rows.append([RACES[race], 'All' if race == opponent else RACES[opponent], games, wins,
+                         round(wins / games, 3), '' if race == opponent else round(ahead / games, 3),
+                         round(rank_sum / games, 2)])
+    return rows
+
+
+def head_to_head_rows(pairs):
+    """Return the rows of head_to_head.csv, sorted by player and opponent
+
+    Args:
+        pairs (dict): See merge_matchups()
+
+    Returns:
+        list: (player, opponent, games, wins, ahead, behind) rows, behind
+            counts the games the opponent ranked ahead
+    """
+    rows = []
+    for (name, other), (games, wins, ahead) in sorted(pairs.items()):
+        rows.append([name, other, games, wins, ahead, pairs[other, name][2]])
+    return rows
@@ -0,0 +1,130 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Run time metrics: phase timers, latency histograms and counters.
+
+All code records into the module wide METRICS object. Recording is a
+dict update under a lock, cheap enough to always stay on. At the end
+of a run the collected values can be written as a JSON report.
+
+Phases running in several threads at once, like fetching games, add up
+the time of all threads, so their sum can exceed the wall time."""
+
+import json
+import time
+import bisect
+import threading
+
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+METRICS_FILE = 'metrics.json'
+
+
+class Histogram:
+    """Count of observed values per bucket, plus sum, min and max"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self):
+        buckets = {'le {}'.format(b): c for b, c in zip(self.buckets, self.counts)}
+        buckets['inf'] = self.counts[-1]
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None, 'buckets': buckets}
+
+
+class Metrics:
+    """Collected phase timers, histograms, counters and plain values"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.timers = {}
+            self.histograms = {}
+            self.counters = {}
+            self.values = {}
+
+    @contextmanager
+    def timer(self, phase):
+        """Context manager adding the time spent inside to a phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def add_time(self, phase, seconds):
+        with self._lock:
+            timer = self.timers.get(phase)
+            if timer is None:
+                timer = self.timers[phase] = {'count': 0, 'seconds': 0.0}
+            timer['count'] += 1
+            timer['seconds'] += seconds
+
+    def observe(self, name, value):
+        """Add a value, e.g. a request latency, to a histogram"""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        """Store a plain JSON serializable value"""
+        with self._lock:
+            self.values[name] = value
+
+    def report(self):
+        """Return all metrics as a JSON serializable dict"""
+        with self._lock:
+            return {
+                'started': self.started,
+                'seconds': time.time() - self.started,
+                'timers': {k: dict(v) for k, v in self.timers.items()},
+                'histograms': {k: v.to_dict() for k, v in self.histograms.items()},
+                'counters': dict(self.counters),
+                'values': dict(self.values),
+            }
+
+    def write(self, filename=METRICS_FILE):
+        """Write the JSON report"""
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+METRICS = Metrics()
@@ -0,0 +1,246 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Compact in-memory model of games, players and participations.
+
+The nested dicts of the JSON layout keep a full dict per player and
+game, with race and status names as strings. Here every object uses
+__slots__, game IDs are integers, races are stored by race ID (see
+constants.RACES), status events by an index into STATUS_NAMES and
+player names are interned. The account ID is an attribute of the
+player instead of a fake game key.
+
+Dataset.from_data() and Dataset.to_data() convert from and to the
+dict layout described in datastore.py. A Dataset can also be saved as
+a pickled snapshot, which is the fastest way to load it again."""
+
+import os
+import sys
+import json
+import pickle
+
+from constants import RACES, RACE_IDS, SCORE_KEYS
+
+
+STATUS_NAMES = ['alive', 'dead', 'dropped', 'resigned']
+STATUS_IDS = {name: i for i, name in enumerate(STATUS_NAMES)}
+
+GAME_FIELDS = ['id', 'name', 'status', 'datecreated', 'dateended', 'turn', 'winner']
+
+
+class Game:
+    """Public information on one game"""
+    __slots__ = GAME_FIELDS
+
+    def __init__(self, id, name, status, datecreated, dateended, turn, winner):
+        self.id = id
+        self.name = name
+        self.status = sys.intern(status)
+        self.datecreated = datecreated
+        self.dateended = dateended
+        self.turn = turn
+        self.winner = winner
+
+    @classmethod
+    def from_dict(cls, game):
+        return cls(*(game[k] for k in GAME_FIELDS))
+
+    def __reduce__(self):
+        return Game, tuple(getattr(self, k) for k in GAME_FIELDS)
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in GAME_FIELDS}
+
+
+class Score:
+    """Final score of a player in a game, see apiaccess.crop_scores()"""
+    __slots__ = ['finished', 'rank'] + SCORE_KEYS
+
+    def __init__(self, finished, rank, *values):
+        self.finished = finished
+        self.rank = rank
+        for key, value in zip(SCORE_KEYS, values or [None] * len(SCORE_KEYS)):
+            setattr(self, key, value)
+
+    @classmethod
+    def from_dict(cls, score):
+        return cls(score['finished'], score['rank'], *(score.get(k) for k in SCORE_KEYS))
+
+    def __reduce__(self):
+        return Score, tuple(getattr(self, k) for k in self.__slots__)
+
+    def to_dict(self):
+        # Dead or open slots only have a rank
+        if self.finished:
+            score = {k: getattr(self, k) for k in SCORE_KEYS}
+        else:
+            score = {}
+        score['finished'] = self.finished
+        score['rank'] = self.rank
+        return score
+
+
+class Participation:
+    """What a player did in one game
+
+    Attributes:
+        races (tuple): Race IDs the player played, in order
+        status (tuple): (status ID, turn) pairs, in order
+        score (Score): Final score or None
+    """
+    __slots__ = ('races', 'status', 'score')
+
+    def __init__(self, races=(), status=(), score=None):
+        self.races = races
+        self.status = status
+        self.score = score
+
+    def __reduce__(self):
+        return Participation, (self.races, self.status, self.score)
+
+    @classmethod
+    def from_dict(cls, stats):
+        score = stats.get('score')
+        return cls(tuple(RACE_IDS[race] for race in stats['race']),
+                   tuple((STATUS_IDS[s['what']], s['when']) for s in stats['status']),
+                   None if score is None else Score.from_dict(score))
+
+    def to_dict(self):
+        stats = {'status': [{'what': STATUS_NAMES[what], 'when': turn} for what, turn in self.status],
+                 'race': [RACES[race] for race in self.races]}
+        if self.score is not None:
+            stats['score'] = self.score.to_dict()
+        return stats
+
+
+class Player:
+    """A player and the games they took part in
+
+    Attributes:
+        name (str): Interned player name
+        accountid (int): Account ID or None
+        games (dict): Participation by integer game ID
+    """
+    __slots__ = ('name', 'accountid', 'games')
+
+    def __init__(self, name, accountid=None):
+        self.name = sys.intern(name)
+        self.accountid = accountid
+        self.games = {}
+
+    def __reduce__(self):
+        return Player, (self.name, self.accountid), self.games
+
+    def __setstate__(self, games):
+        self.games = games
+
+
+class Dataset:
+    """All games and players
+
+    Attributes:
+        games (dict): Game by integer game ID
+        players (dict): Player by name
+    """
+    __slots__ = ('games', 'players')
+
+    def __init__(self):
+        self.games = {}
+        self.players = {}
+
+    def __reduce__(self):
+        return Dataset, (), (self.games, self.players)
+
+    def __setstate__(self, state):
+        self.games, self.players = state
+
+    def add_game(self, game):
+        self.games[game.id] = game
+
+    def player(self, name, accountid=None):
+        """Return the player of this name, adding it if needed"""
+        player = self.players.get(name)
+        if player is None:
+            player = self.players[name] = Player(name, accountid)
+        elif player.accountid is None:
+            player.accountid = accountid
+        return player
+
+    def participations(self):
+        """Iterate over (player, game ID, participation) of all players"""
+        for player in self.players.values():
+            for gameid, part in player.games.items():
+                yield player, gameid, part
+
+    @classmethod
+    def from_data(cls, data):
+        """Build the model from the dict layout
+
+        Args:
+            data (dict): Games and players as returned by datastore.load_data()
+        """
+        dataset = cls()
+        for game in data['games'].values():
+            dataset.add_game(Game.from_dict(game))
+        for name, games in data['players'].items():
+            player = dataset.player(name, games.get('accountid'))
+            for gameid, stats in games.items():
+                if gameid == 'accountid':
+                    continue
+                player.games[int(gameid)] = Participation.from_dict(stats)
+        return dataset
+
+    def to_data(self):
+        """Convert the model back to the dict layout"""
+        games = {str(gid): game.to_dict() for gid, game in self.games.items()}
+        players = {}
+        for name, player in self.players.items():
+            entry = players[name] = {}
+            if player.accountid is not None:
+                entry['accountid'] = player.accountid
+            for gameid, part in player.games.items():
+                entry[str(gameid)] = part.to_dict()
+        watermarks = {gid: [g['status'], g['turn'], g['dateended']] for gid, g in games.items()}
+        return {'games': games, 'players': players, 'gamecount': len(games),
+                'watermarks': watermarks}
+
+
+def load_json(filename):
+    """Read a file in the player_data.json layout into a Dataset"""
+    with open(filename, 'r') as f:
+        return Dataset.from_data(json.load(f))
+
+
+def dump_json(dataset, filename):
+    """Write a Dataset to a file in the player_data.json layout"""
+    with open(filename, 'w') as f:
+        json.dump(dataset.to_data(), f)
+
+
+def save_snapshot(dataset, filename):
+    """Write a Dataset to a binary snapshot file
+
+    The file is written under a temporary name first and then renamed,
+    so readers never see a partly written snapshot.
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(dataset, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, filename)
+
+
+def load_snapshot(filename):
+    """Read a Dataset from a snapshot written by save_snapshot()"""
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,184 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Multi-player Elo ratings of players and races.
+
+Finished games are rated in the order they were created. Every game
+counts as a set of duels between all its participants: a better final
+rank wins the duel, equal ranks draw, and players who resigned or were
+dropped lose to everyone who stayed. A participant's rating changes by
+K_FACTOR / (participants - 1) times the sum of won duels minus expected
+wins. Races are rated the same way by the rank of the player who ended
+the game in their slot.
+
+Ratings only depend on earlier games, so a rating run only needs to
+start at the earliest game that was not rated yet. The rating of every
+player and race after each game is kept in the data store, the ratings
+before that game are read from there and only the games from there on
+are rated again.
+
+Rating many games is vectorized: games are put into layers so that no
+player appears twice in a layer and all earlier games of a player are
+in earlier layers. All games of a layer are then rated in one step with
+NumPy, which gives exactly the same result as rating game by game."""
+
+import numpy as np
+
+import datastore
+from metrics import METRICS
+
+
+INITIAL_RATING = 1500.0
+K_FACTOR = 32.0
+# Rank of players who left a game, below every final rank
+LEFT_RANK = 1000
+# Kinds of rated entities
+PLAYER, RACE = 'player', 'race'
+
+
+def layers(game, entity, nentities):
+    """Assign every game to a layer
+
+    Args:
+        game (np.ndarray): Game code per row, rows of a game are adjacent
+            and games are in the order they are rated
+        entity (np.ndarray): Entity code per row
+        nentities (int): Number of entity codes
+
+    Returns:
+        np.ndarray: Layer per row, games without common entities can
+            share a layer
+    """
+    layer = np.empty(len(game), dtype=np.int64)
+    last = np.full(nentities, -1, dtype=np.int64)
+    bounds = np.flatnonzero(np.diff(game)) + 1
+    for start, end in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(game)]))):
+        members = entity[start:end]
+        layer[start:end] = current = last[members].max() + 1
+        last[members] = current
+    return layer
+
+
+def rate(game, entity, rank, ratings, k=K_FACTOR):
+    """Rate games, updating the ratings in place
+
+    Args:
+        game (np.ndarray): Game code per row, rows of a game are adjacent
+            and games are in the order they are rated
+        entity (np.ndarray): Entity code per row
+        rank (np.ndarray): Final rank per row, lower is better
+        ratings (np.ndarray): Rating by entity code, updated in place
+        k (float, optional): Maximum change of a rating per game
+
+    Returns:
+        np.ndarray: Rating of the entity of every row after its game
+    """
+    after = np.empty(len(game))
+    if not len(game):
+        return after
+    layer = layers(game, entity, len(ratings))
+    order = np.argsort(layer, kind='stable')
+    game, entity, rank, layer = game[order], entity[order], rank[order], layer[order]
+
+    # Rows of each game are still adjacent, pair every row with all rows of its game
+    starts = np.flatnonzero(np.concatenate(([True], game[1:] != game[:-1])))
+    sizes = np.diff(np.concatenate((starts, [len(game)])))
+    row_start = np.repeat(starts, sizes)
+    row_size = np.repeat(sizes, sizes)
+    first = np.repeat(np.arange(len(game)), row_size)
+    second = (np.repeat(row_start, row_size)
+              + np.arange(len(first)) - np.repeat(np.cumsum(row_size) - row_size, row_size))
+    keep = first != second
+    first, second = first[keep], second[keep]
+    score = (rank[first] < rank[second]) + 0.5 * (rank[first] == rank[second])
+    weight = k / np.maximum(row_size[first] - 1, 1)
+
+    row_bounds = np.flatnonzero(np.diff(layer)) + 1
+    row_bounds = np.concatenate(([0], row_bounds, [len(game)]))
+    pair_bounds = np.searchsorted(first, row_bounds)
+    for i in range(len(row_bounds) - 1):
+        a, b = row_bounds[i], row_bounds[i + 1]
+        p, q = pair_bounds[i], pair_bounds[i + 1]
+        mine, theirs = ratings[entity[first[p:q]]], ratings[entity[second[p:q]]]
+        expected = 1.0 / (1.0 + 10.0 ** ((theirs - mine) / 400.0))
+        delta = np.bincount(first[p:q] - a, weight[p:q] * (score[p:q] - expected), minlength=b - a)
+        np.add.at(ratings, entity[a:b], delta)
+        after[order[a:b]] = ratings[entity[a:b]]
+    return after
+
+
+def rate_kind(rows, state, kind):
+    """Rate the rows of one kind of entity
+
+    Args:
+        rows (list): (datecreated, game ID, entity, rank) rows in game order
+        state (dict): (rating, games) by (kind, entity) before the first game
+        kind (str): PLAYER or RACE
+
+    Returns:
+        list: (kind, entity, datecreated, game ID, rating) history rows
+    """
+    if not rows:
+        return []
+    created, gameids, names, ranks = zip(*rows)
+    codes = {}
+    entity = np.array([codes.setdefault(name, len(codes)) for name in names], dtype=np.int64)
+    ratings = np.array([state.get((kind, name), (INITIAL_RATING, 0))[0] for name in codes])
+    gameids = np.array(gameids, dtype=np.int64)
+    game = np.concatenate(([0], np.cumsum(gameids[1:] != gameids[:-1])))
+    after = rate(game, entity, np.array(ranks, dtype=np.float64), ratings)
+    return list(zip([kind] * len(rows), names, created, gameids.tolist(), after.tolist()))
+
+
+def update_ratings(conn, full=False):
+    """Rate all finished games of a data store that are not rated yet
+
+    Args:
+        conn (sqlite3.Connection): Open data store
+        full (bool, optional): Rate all games again from the start
+
+    Returns:
+        int: Number of rated games, including those rated again
+    """
+    since = None if full else datastore.unrated_games(conn)
+    if since is None and not full:
+        return 0
+    with METRICS.timer('ratings'):
+        state = {} if full else datastore.load_ratings(conn, since)
+        rows = datastore.rating_rows(conn, since)
+        players = []
+        races = []
+        for created, gameid, name, race, rank in rows:
+            if rank is None or rank <= 0:
+                rank = LEFT_RANK
+            elif race is not None:
+                # Only the player who ended the game in a slot rates its race
+                races.append((created, gameid, race, rank))
+            players.append((created, gameid, name, rank))
+        history = rate_kind(players, state, PLAYER) + rate_kind(races, state, RACE)
+        datastore.save_ratings(conn, since or ('', 0), history)
+    ngames = len(set(gameid for _, gameid, _, _, _ in rows))
+    METRICS.count('games rated', ngames)
+    return ngames
+
+
+def rating_table(conn, kind=PLAYER):
+    """Return the current ratings of one kind, best first
+
+    Returns:
+        list: (entity, rating, rated games) rows
+    """
+    table = [(entity, rating, games) for (k, entity), (rating, games)
+             in datastore.load_ratings(conn).items() if k == kind]
+    return sorted(table, key=lambda row: (-row[1], row[0]))
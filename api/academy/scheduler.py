@@ -0,0 +1,228 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Adaptive request scheduler for the API.
+
+Every request gets a timeout and is retried on transient failures
+(connection errors, timeouts, bodies that break off, HTTP 429 and 5xx)
+with exponential backoff and full jitter, honouring a Retry-After
+header. A request holds its slot until its body is read.
+
+The number of requests in flight is limited by an AIMD controller like
+TCP congestion control: every healthy answer raises the limit by
+1/limit, so roughly by one per round trip, while errors and answers
+much slower than the best latency seen so far halve it. This finds the
+highest parallelism the server sustains without manual tuning."""
+
+import time
+import random
+import threading
+
+import requests
+
+from metrics import METRICS
+
+
+# HTTP status codes worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Failures worth retrying, also while the body downloads
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError)
+# (connect, read) timeout in seconds
+TIMEOUT = (5, 30)
+RETRIES = 4
+BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+# Answers slower than SLOW_FACTOR times the baseline latency plus
+# SLOW_MARGIN seconds count as a sign of overload
+SLOW_FACTOR = 3.0
+SLOW_MARGIN = 0.05
+# Weight of a new latency sample in the moving average
+EWMA_WEIGHT = 0.2
+
+
+class RequestScheduler:
+    """Run GET requests with retries and an adaptive concurrency limit
+
+    Args:
+        session (requests.Session): Session used for all requests
+        max_concurrency (int, optional): Upper bound for requests in flight
+        min_concurrency (int, optional): Lower bound for requests in flight
+        initial (int, optional): Limit to start with
+        timeout (tuple, optional): (connect, read) timeout in seconds
+        retries (int, optional): Retries of a failing request
+        backoff (float, optional): Base delay in seconds before a retry,
+            doubling with every further retry
+        max_backoff (float, optional): Upper bound of the retry delay
+    """
+
+    def __init__(self, session, max_concurrency=16, min_concurrency=1, initial=2,
+                 timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        self.session = session
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max(min(initial, max_concurrency), min_concurrency))
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.peak_limit = self.limit
+        self._inflight = 0
+        self._cond = threading.Condition()
+        self._ewma = None
+        self._baseline = None
+        self._last_decrease = 0.0
+        self._random = random.Random()
+
+    def _acquire(self):
+        with self._cond:
+            while self._inflight >= int(self.limit):
+                self._cond.wait()
+            self._inflight += 1
+
+    def _release(self, healthy, latency):
+        with self._cond:
+            self._inflight -= 1
+            if latency is not None:
+                if self._ewma is None:
+                    self._ewma = self._baseline = latency
+                else:
+                    self._ewma += EWMA_WEIGHT * (latency - self._ewma)
+                    if self._ewma < self._baseline:
+                        self._baseline = self._ewma
+                    else:
+                        # Let the baseline follow lasting changes slowly
+                        self._baseline += 0.01 * (self._ewma - self._baseline)
+                if latency > SLOW_FACTOR * self._baseline + SLOW_MARGIN:
+                    healthy = False
+            if healthy:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+                self.peak_limit = max(self.peak_limit, self.limit)
+            else:
+                now = time.monotonic()
+                # Failures of requests sent at the same time count once
+                if now - self._last_decrease > (self._ewma or 0.0):
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self._last_decrease = now
+                    METRICS.count('concurrency decreases')
+            self._cond.notify_all()
+
+    def _delay(self, attempt, response):
+        delay = self._random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if response is not None:
+            try:
+                delay = max(delay, min(self.max_backoff, float(response.headers.get('Retry-After', 0))))
+            except ValueError:
+                pass
+        return delay
+
+    def get(self, url, params=None, label=''):
+        """Send a GET request, retrying transient failures
+
+        Args:
+            url (str): URL to request
+            params (dict, optional): URL parameters
+            label (str, optional): Name for the latency histogram
+
+        Returns:
+            requests.Response: The first answer that is not a transient
+                failure, or the last one if all retries failed, with its
+                body read
+
+        Raises:
+            requests.RequestException: If the last try failed to connect,
+                timed out or broke off
+        """
+        response, = self.stream(url, params, label, _read_body)
+        return response
+
+    def stream(self, url, params=None, label='', consume=None):
+        """Send a GET request and yield the items read from its body
+
+        The items are passed on while the body downloads, and the request
+        keeps its slot until the body is read or the caller stops. A
+        download that breaks off is retried like a failed request: the
+        body is read again from the start and the items yielded before
+        are skipped, so the answer must not change between tries.
+
+        Args:
+            url (str): URL to request
+            params (dict, optional): URL parameters
+            label (str, optional): Name for the latency histogram
+            consume (callable): Called with the streamed response, returns
+                an iterable of the items read from it. Called for the first
+                answer that is not a transient failure, or the last one
+
+        Yields:
+            The items returned by `consume`
+
+        Raises:
+            requests.RequestException: If the last try failed to connect,
+                timed out or broke off
+        """
+        sent = 0
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            self._acquire()
+            start = time.perf_counter()
+            # Time the caller spent on the items, which is no latency
+            paused = 0.0
+            response = None
+            transient = False
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout, stream=True)
+                transient = response.status_code in RETRY_STATUS
+                if last or not transient:
+                    with response:
+                        for i, item in enumerate(consume(response)):
+                            if i < sent:
+                                continue
+                            pause = time.perf_counter()
+                            yield item
+                            paused += time.perf_counter() - pause
+                            sent += 1
+            except RETRY_ERRORS:
+                self._release(False, None)
+                METRICS.count('request errors')
+                if last:
+                    raise
+            except BaseException:
+                # Also when the caller stops reading
+                self._release(not transient, None)
+                raise
+            else:
+                latency = time.perf_counter() - start - paused
+                METRICS.observe('latency ' + label, latency)
+                self._release(not transient, latency)
+                if transient:
+                    METRICS.count('request errors')
+                if last or not transient:
+                    return
+            METRICS.count('retries')
+            if response is not None:
+                # Release the connection of a streamed answer
+                response.close()
+            time.sleep(self._delay(attempt, response))
+
+    def stats(self):
+        """Return the current and highest concurrency limit and latencies"""
+        with self._cond:
+            return {'limit': self.limit, 'peak_limit': self.peak_limit,
+                    'latency_ewma': self._ewma, 'latency_baseline': self._baseline}
+
+
+def _read_body(response):
+    """Read the whole body of a streamed answer, see RequestScheduler.get()"""
+    response.content
+    yield response
@@ -0,0 +1,334 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Turn by turn score history of finished games.
+
+The data store only keeps the final score of every player (see
+apiaccess.crop_scores()). The history keeps the SCORE_KEYS of every
+slot after every turn, read from the turn files of game/loadturn, which
+list the scores of all slots.
+
+The history is kept in two files next to the data store. The data file
+holds blocks of consecutive turns of one game, each a turns x slots x
+SCORE_KEYS array of 32 bit integers with percent in hundredths. Every
+turn is stored as the difference to the turn before, the first turn of
+a block as it is. Scores change little from one turn to the next, so
+the differences are small numbers that zlib compresses well. The index
+file lists the blocks as fixed size INDEX_DTYPE records.
+
+Both files are only ever appended to. A sync only fetches the turns of a
+game that are not stored yet and adds them as a new block, and a sync
+that fails keeps the turns it read completely. The data file is memory
+mapped, reading a range of turns of a game only decompresses the blocks
+overlapping it."""
+
+import os
+import mmap
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import apiaccess as aa
+from constants import SCORE_KEYS
+from metrics import METRICS
+
+
+# Data file of the Academy shard, the index has the same name with INDEX_EXT
+HISTORY_FILE = 'score_history.dat'
+INDEX_EXT = '.idx'
+INDEX_DTYPE = np.dtype([('game', '<i8'), ('first', '<i4'), ('turns', '<i4'),
+                        ('slots', '<i4'), ('size', '<i4'), ('offset', '<i8')])
+VALUE_DTYPE = np.dtype('<i4')
+PERCENT = SCORE_KEYS.index('percent')
+# Percent is stored in hundredths, the API rounds it to two digits
+PERCENT_SCALE = 100
+COMPRESSION_LEVEL = 6
+
+
+def encode_block(scores):
+    """Delta encode and compress the scores of consecutive turns
+
+    Args:
+        scores (np.ndarray): turns x slots x SCORE_KEYS integer scores
+
+    Returns:
+        bytes: The compressed block
+    """
+    deltas = np.diff(scores, axis=0, prepend=np.zeros_like(scores[:1]))
+    # One series after the other, so the differences of a series are close
+    series = np.ascontiguousarray(deltas.transpose(1, 2, 0), VALUE_DTYPE)
+    return zlib.compress(series.tobytes(), COMPRESSION_LEVEL)
+
+
+def decode_block(block, turns, slots):
+    """Inverse of encode_block()
+
+    Args:
+        block (bytes): The compressed block
+        turns (int): Number of turns in the block
+        slots (int): Number of slots in the block
+
+    Returns:
+        np.ndarray: turns x slots x SCORE_KEYS integer scores
+    """
+    series = np.frombuffer(zlib.decompress(block), VALUE_DTYPE).reshape(slots, len(SCORE_KEYS), turns)
+    return np.cumsum(series.transpose(2, 0, 1), axis=0, dtype=np.int32)
+
+
+def score_array(turns):
+    """Lay out the scores of consecutive turns as an array
+
+    Args:
+        turns (list): Score objects of every turn, see fetch_turn()
+
+    Returns:
+        np.ndarray: turns x slots x SCORE_KEYS integer scores, with
+            percent in hundredths
+    """
+    slots = max((score['ownerid'] for scores in turns for score in scores), default=0)
+    array = np.zeros((len(turns), slots, len(SCORE_KEYS)), dtype=np.int32)
+    for i, scores in enumerate(turns):
+        for score in scores:
+            if score['ownerid'] > 0:
+                values = [score[k] or 0 for k in SCORE_KEYS]
+                values[PERCENT] = round(values[PERCENT] * PERCENT_SCALE)
+                array[i, score['ownerid'] - 1] = values
+    return array
+
+
+class ScoreHistory:
+    """Append-only store of the scores of every turn
+
+    Attributes:
+        filename (str): Data file
+        index_file (str): Index file, named like the data file with INDEX_EXT
+        blocks (dict): (first turn, turns, slots, size, offset) of every
+            block by game ID, in the order of the turns
+        count (int): Number of blocks
+        end (int): Size of the data file up to the end of the last block
+    """
+
+    def __init__(self, filename=HISTORY_FILE):
+        self.filename = filename
+        self.index_file = os.path.splitext(filename)[0] + INDEX_EXT
+        self.blocks = {}
+        self.count = 0
+        self.end = 0
+        self._data = None
+        self._writers = None
+        if os.path.exists(self.index_file):
+            # A record cut short by an interrupted write is ignored
+            count = os.path.getsize(self.index_file) // INDEX_DTYPE.itemsize
+            if count:
+                index = np.memmap(self.index_file, INDEX_DTYPE, 'r', shape=(count,))
+                for gameid, *block in index.tolist():
+                    self.blocks.setdefault(gameid, []).append(tuple(block))
+                    self.end = max(self.end, block[-1] + block[-2])
+                self.count = count
+                del index
+
+    def games(self):
+        """Return the IDs of all stored games, in ascending order"""
+        return sorted(self.blocks)
+
+    def last_turns(self):
+        """Return the last stored turn by game ID"""
+        return {gameid: blocks[-1][0] + blocks[-1][1] - 1 for gameid, blocks in self.blocks.items()}
+
+    def append(self, gameid, first, scores):
+        """Store the scores of consecutive turns of a game
+
+        Args:
+            gameid (int): Game ID
+            first (int): Turn of the first row of `scores`, the turn
+                after the last stored turn of the game
+            scores (np.ndarray): See score_array()
+        """
+        with METRICS.timer('history write'):
+            if self._writers is None:
+                self._writers = self._open_writers()
+            data, index = self._writers
+            block = encode_block(scores)
+            data.write(block)
+            data.flush()
+            # The index record comes last, a block is only stored with it
+            record = (gameid, first, len(scores), scores.shape[1], len(block), self.end)
+            index.write(np.array([record], INDEX_DTYPE).tobytes())
+            index.flush()
+            self.blocks.setdefault(gameid, []).append(record[1:])
+            self.count += 1
+            self.end += len(block)
+
+    def _open_writers(self):
+        # Drop what an interrupted write left behind the last block
+        data = open(self.filename, 'ab')
+        data.truncate(self.end)
+        index = open(self.index_file, 'ab')
+        index.truncate(self.count * INDEX_DTYPE.itemsize)
+        return data, index
+
+    def _read(self, offset, size):
+        if self._data is None or len(self._data) < offset + size:
+            if self._data is not None:
+                self._data.close()
+            with open(self.filename, 'rb') as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._data[offset:offset + size]
+
+    def read(self, gameid, first=1, last=None):
+        """Read the scores of a game for a range of turns
+
+        Args:
+            gameid (int): Game ID
+            first (int, optional): First turn to read
+            last (int, optional): Last turn to read, default the last stored
+
+        Returns:
+            turns (np.ndarray): The stored turns of the range
+            scores (np.ndarray): turns x slots x SCORE_KEYS scores as
+                floats, slot 1 first, percent as in the API
+        """
+        parts = []
+        with METRICS.timer('history read'):
+            for start, turns, slots, size, offset in self.blocks.get(gameid, []):
+                if start + turns <= first or (last is not None and start > last):
+                    continue
+                lo = max(first - start, 0)
+                hi = turns if last is None else min(last - start + 1, turns)
+                parts.append((start + lo, decode_block(self._read(offset, size), turns, slots)[lo:hi]))
+            if not parts:
+                return np.zeros(0, dtype=np.int32), np.zeros((0, 0, len(SCORE_KEYS)))
+            # Blocks of one game are contiguous, but may differ in slots
+            scores = np.zeros((sum(len(p) for _, p in parts), max(p.shape[1] for _, p in parts),
+                               len(SCORE_KEYS)))
+            row = 0
+            for _, part in parts:
+                scores[row:row + len(part), :part.shape[1]] = part
+                row += len(part)
+            scores[..., PERCENT] /= PERCENT_SCALE
+        return np.arange(parts[0][0], parts[0][0] + row, dtype=np.int32), scores
+
+    def close(self):
+        """Close the data and index files"""
+        if self._writers is not None:
+            for f in self._writers:
+                f.close()
+            self._writers = None
+        if self._data is not None:
+            self._data.close()
+            self._data = None
+
+
+def fetch_turn(gameid, turn):
+    """Download the scores of all slots after one turn of a game
+
+    The turn file is decoded while it downloads and only the scores are
+    kept. It is never asked for again, so it is not cached.
+
+    Args:
+        gameid (int): Game ID
+        turn (int): Turn number
+
+    Returns:
+        list: 'ownerid' (the slot) and SCORE_KEYS of every slot
+    """
+    payload = {'gameid': gameid, 'turn': turn, 'playerid': 1}
+    with METRICS.timer('turn fetch'):
+        return [{k: score.get(k) for k in ['ownerid'] + SCORE_KEYS}
+                for score in aa.api_stream('game/loadturn', payload, ['rst', 'scores'], store=False)]
+
+
+def sync_history(conn, history, workers=aa.FETCH_WORKERS):
+    """Add the turns not stored yet of all finished games to the history
+
+    Running games are left out, their turn files are only open to their
+    players. Turns are downloaded in parallel and stored game by game.
+    Only twice as many turns as there are workers are downloaded ahead
+    of the turn stored next, so a first sync over the whole archive does
+    not queue a download for every turn at once.
+
+    Args:
+        conn (sqlite3.Connection): Data store listing the games
+        history (ScoreHistory): Where to store the scores
+        workers (int, optional): Maximum number of parallel downloads,
+            1 disables threading
+
+    Returns:
+        int: Number of turns added
+    """
+    stored = history.last_turns()
+    games = [(gameid, stored.get(gameid, 0) + 1, last) for gameid, last in
+             conn.execute("SELECT id, turn FROM games WHERE status = 'Finished' ORDER BY id")
+             if last > stored.get(gameid, 0)]
+    total = sum(last - first + 1 for _, first, last in games)
+    if not total:
+        return 0
+
+    def tasks():
+        for gameid, first, last in games:
+            for turn in range(first, last + 1):
+                yield gameid, turn
+
+    gameids = (gameid for gameid, _ in tasks())
+    turns = (turn for _, turn in tasks())
+    if workers <= 1:
+        results = map(fetch_turn, gameids, turns)
+        pool = None
+    else:
+        aa.get_scheduler(workers)
+        pool = ThreadPoolExecutor(max_workers=workers)
+        results = aa.bounded_map(pool, fetch_turn, gameids, turns, window=2 * workers)
+    gameid, first, pending = None, 0, []
+    try:
+        for i, ((task_game, turn), scores) in enumerate(zip(tasks(), results)):
+            if task_game != gameid:
+                if pending:
+                    history.append(gameid, first, score_array(pending))
+                gameid, first, pending = task_game, turn, []
+            pending.append(scores)
+            aa.print_progress(i+1, total, prefix = 'Getting score history:', suffix = 'Done')
+    finally:
+        # Turns read before a failure are kept, the next sync goes on after them
+        if pending:
+            history.append(gameid, first, score_array(pending))
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    METRICS.count('history turns', total)
+    return total
+
+
+if __name__ == "__main__":
+    import argparse
+    import datastore
+    from constants import ACADEMY
+    from metrics import METRICS_FILE
+
+    parser = argparse.ArgumentParser(description='Download the score history of finished games')
+    parser.add_argument('-w', '--workers', type=int, default=aa.FETCH_WORKERS,
+                        help='maximum number of turns to fetch in parallel (default: %(default)s)')
+    parser.add_argument('-t', '--type', dest='types', action='append', type=aa.game_type,
+                        help='game type to update, can be given several times (default: academy)')
+    parser.add_argument('--metrics', metavar='FILE', default=METRICS_FILE,
+                        help='where to write the run time metrics (default: %(default)s)')
+    args = parser.parse_args()
+    for gametype in args.types or [ACADEMY]:
+        conn = datastore.connect(aa.shard_file(aa.DB_FILE, gametype))
+        history = ScoreHistory(aa.shard_file(HISTORY_FILE, gametype))
+        added = sync_history(conn, history, args.workers)
+        history.close()
+        conn.close()
+        print('{}: {} turns added, {} games, {:.1f} MB'.format(
+            history.filename, added, len(history.blocks), history.end / 2 ** 20))
+    METRICS.write(args.metrics)
@@ -0,0 +1,187 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Local stand-in for the planets.nu API.
+
+Serves the games/list, game/loadevents, game/loadinfo and game/loadturn
+endpoints from a synthdata.SyntheticAPI, with an artificial delay per
+request. Point apiaccess at it by setting apiaccess.BASE to the `base`
+attribute of the running server.
+
+To test how clients cope with a struggling server, a share of the
+requests can be answered with HTTP 503 or have their body break off
+halfway, and the server can be given a
+capacity: with more requests in flight than that, every answer is
+delayed proportionally longer."""
+
+import sys
+import json
+import time
+import random
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import synthdata
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    # Keep connections alive like the real server does
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are sent separately, without this every
+    # answer on a kept alive connection waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        with server.lock:
+            server.inflight += 1
+            load = server.inflight / server.capacity if server.capacity else 1
+            failed = server.random.random() < server.error_rate
+            broken = not failed and server.random.random() < server.break_rate
+        try:
+            if server.latency:
+                time.sleep(server.latency * max(load, 1))
+        finally:
+            with server.lock:
+                server.inflight -= 1
+        if failed:
+            with server.lock:
+                server.errors += 1
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        with server.lock:
+            server.requests += 1
+            body = self._answer(url.path.strip('/'), params)
+            if body is not None:
+                body = json.dumps(body).encode('utf-8')
+                server.bytes_sent += len(body)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if broken:
+            with server.lock:
+                server.errors += 1
+            # Close the connection with half of the promised body sent
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def _answer(self, endpoint, params):
+        api = self.server.api
+        if endpoint == 'games/list':
+            statuses = None
+            if params.get('status'):
+                statuses = {int(s) for s in params['status'].split(',')}
+            gametype = int(params['type']) if params.get('type') else None
+            return api.games_list(statuses, int(params.get('limit') or 0), gametype)
+        gameid = int(params.get('gameid', 0))
+        if endpoint == 'game/loadevents':
+            return api.events.get(gameid)
+        if endpoint == 'game/loadinfo':
+            return api.info.get(gameid)
+        if endpoint == 'game/loadturn':
+            return api.load_turn(gameid, int(params.get('turn', 0)))
+        return None
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandinServer(ThreadingHTTPServer):
+    """HTTP server answering API requests from synthetic data
+
+    Args:
+        api (synthdata.SyntheticAPI): Data to serve
+        latency (float, optional): Seconds to wait before every answer
+        port (int, optional): Port to listen on, 0 picks a free one
+        error_rate (float, optional): Share of requests failing with 503
+        break_rate (float, optional): Share of answers whose body breaks
+            off halfway
+        capacity (int, optional): Requests in flight before answers slow
+            down, 0 for no limit
+        seed (int, optional): Random seed for picking failing requests
+
+    Attributes:
+        base (str): URL to use instead of constants.BASE
+        requests (int): Number of requests answered
+        errors (int): Number of requests failed on purpose
+        bytes_sent (int): Summed size of all response bodies
+    """
+    daemon_threads = True
+
+    def __init__(self, api, latency=0.0, port=0, error_rate=0.0, capacity=0, seed=0, break_rate=0.0):
+        super().__init__(('127.0.0.1', port), StandinHandler)
+        self.api = api
+        self.latency = latency
+        self.error_rate = error_rate
+        self.break_rate = break_rate
+        self.capacity = capacity
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.base = 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+    def start(self):
+        """Serve requests in a background thread"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve synthetic Academy games like api.planets.nu')
+    parser.add_argument('--games', type=int, default=200, help='number of games (default: %(default)s)')
+    parser.add_argument('--players', type=int, default=500, help='number of players (default: %(default)s)')
+    parser.add_argument('--churn', type=float, default=0.2,
+                        help='chance of a player leaving a game (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds to delay every answer (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of requests failing with HTTP 503 (default: %(default)s)')
+    parser.add_argument('--break-rate', type=float, default=0.0,
+                        help='share of answers whose body breaks off halfway (default: %(default)s)')
+    parser.add_argument('--capacity', type=int, default=0,
+                        help='requests in flight before answers slow down, 0 for no limit')
+    args = parser.parse_args()
+
+    server = StandinServer(synthdata.generate(args.games, args.players, args.churn),
+                           args.latency, args.port, args.error_rate, args.capacity,
+                           break_rate=args.break_rate)
+    print('Serving {} games at {}'.format(args.games, server.base))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        sys.exit(0)
@@ -0,0 +1,200 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Array based player statistics.
+
+Races and end states are encoded as small integers, so the per player
+counters can be kept in one players x races x endstates NumPy array
+instead of a dict of string keyed counters per player.
+
+The arrays of several shards (see apiaccess.shard_file()) can be added
+up with merge_counts(), so statistics over all game types never need
+all games in memory at once."""
+
+import numpy as np
+
+from constants import RACES, RACE_IDS, SHORTRACES, ACADEMY, ACADEMY_RACES
+from model import STATUS_IDS
+
+
+# Race names, index is the race code which is the race ID minus one
+RACE_NAMES = [RACES[raceid] for raceid in sorted(RACES)]
+# End states in the column order of player_stats.csv
+ENDSTATES = ['finished', 'won', 'dropped', 'resigned', 'died']
+FINISHED, WON, DROPPED, RESIGNED, DIED = range(len(ENDSTATES))
+ENDSTATE_IDS = {state: i for i, state in enumerate(ENDSTATES)}
+# Status events counted as end state, by model.STATUS_IDS
+STATUS_CODES = {STATUS_IDS['dropped']: DROPPED,
+                STATUS_IDS['resigned']: RESIGNED,
+                STATUS_IDS['dead']: DIED}
+
+
+def flatten_participations(dataset):
+    """Turn the player data into flat columns
+
+    Every end state reached by a player in a game becomes one row.
+    Following the CSV output of earlier versions only the first race a
+    player had in a game is counted.
+
+    Args:
+        dataset (model.Dataset): All games and players
+
+    Returns:
+        names (list): Player names, index is the player code
+        player (np.ndarray): Player code per row
+        race (np.ndarray): Race code per row
+        state (np.ndarray): End state code per row
+    """
+    names = list(dataset.players)
+    player = []
+    race = []
+    state = []
+    for code, name in enumerate(names):
+        for part in dataset.players[name].games.values():
+            if not part.races:
+                continue
+            states = []
+            score = part.score
+            if score is not None and score.finished == 1:
+                states.append(FINISHED)
+                if score.rank == 1:
+                    states.append(WON)
+            for what, _ in part.status:
+                if what in STATUS_CODES:
+                    states.append(STATUS_CODES[what])
+            player += [code] * len(states)
+            race += [part.races[0] - 1] * len(states)
+            state += states
+    return (names, np.array(player, dtype=np.int32), np.array(race, dtype=np.int8),
+            np.array(state, dtype=np.int8))
+
+
+def count_endstates(nplayers, player, race, state):
+    """Count the end states of every player per race
+
+    Args:
+        nplayers (int): Number of players
+        player, race, state (np.ndarray): Columns from flatten_participations()
+
+    Returns:
+        np.ndarray: Counts with shape (players, races, endstates)
+    """
+    shape = (nplayers, len(RACE_NAMES), len(ENDSTATES))
+    flat = np.ravel_multi_index((player, race, state), shape)
+    counts = np.bincount(flat, minlength=nplayers * shape[1] * shape[2])
+    return counts.reshape(shape)
+
+
+def player_race_counts(dataset):
+    """Build the players x races x endstates count array
+
+    Args:
+        dataset (model.Dataset): All games and players
+
+    Returns:
+        names (list): Player names in the order of the first axis
+        counts (np.ndarray): See count_endstates()
+    """
+    names, player, race, state = flatten_participations(dataset)
+    return names, count_endstates(len(names), player, race, state)
+
+
+def stored_counts(names, rows):
+    """Build the count array from the aggregates kept in the data store
+
+    Args:
+        names (list): Player names, see datastore.load_player_counts()
+        rows (list): (name, race, end state, count) rows
+
+    Returns:
+        names (list): Player names in the order of the first axis
+        counts (np.ndarray): See count_endstates()
+    """
+    counts = np.zeros((len(names), len(RACE_NAMES), len(ENDSTATES)), dtype=np.int64)
+    if rows:
+        index = {name: i for i, name in enumerate(names)}
+        player, race, state, n = zip(*rows)
+        counts[[index[p] for p in player], [RACE_IDS[r] - 1 for r in race],
+               [ENDSTATE_IDS[e] for e in state]] = n
+    return names, counts
+
+
+def merge_counts(parts):
+    """Add up the count arrays of several shards
+
+    Rows with the same name are added up, so the shards have to name
+    their players alike, see analyse_csv.share_names().
+
+    Args:
+        parts (iterable): (names, counts) pairs as returned by
+            player_race_counts()
+
+    Returns:
+        names (list): All player names, in the order they were first seen
+        counts (np.ndarray): Summed counts, see count_endstates()
+    """
+    index = {}
+    rows = []
+    for names, counts in parts:
+        rows.append((np.array([index.setdefault(name, len(index)) for name in names],
+                              dtype=np.int64), counts))
+    merged = np.zeros((len(index), len(RACE_NAMES), len(ENDSTATES)), dtype=np.int64)
+    for row, counts in rows:
+        # Players without an account ID can share a name within a shard
+        np.add.at(merged, row, counts)
+    return list(index), merged
+
+
+def report_races(gametypes):
+    """Return the race IDs to show in statistics of some game types
+
+    Academy games only know seven races, all other types all of them.
+    """
+    if set(gametypes) == {ACADEMY}:
+        return ACADEMY_RACES
+    return sorted(RACES)
+
+
+def stats_columns(races=None):
+    """Return the column names of the per player statistics
+
+    For every end state there is one column per race and one 'Sum' column.
+
+    Args:
+        races (list, optional): Race IDs to show, defaults to all races
+    """
+    names = RACE_NAMES if races is None else [RACES[race] for race in races]
+    columns = []
+    for stat in ENDSTATES:
+        columns += ['{} {}'.format(SHORTRACES[race], stat) for race in names]
+        columns.append('Sum ' + stat)
+    return columns
+
+
+def stats_table(counts, races=None):
+    """Lay out the count array as rows matching stats_columns()
+
+    Args:
+        counts (np.ndarray): See count_endstates()
+        races (list, optional): Race IDs to show, defaults to all races
+
+    Returns:
+        np.ndarray: One row per player
+    """
+    if races is not None:
+        counts = counts[:, [race - 1 for race in races]]
+    sums = counts.sum(axis=1, keepdims=True)
+    # players x endstates x (races + sum)
+    table = np.concatenate((counts.transpose(0, 2, 1), sums.transpose(0, 2, 1)), axis=2)
+    return table.reshape(counts.shape[0], counts.shape[2] * (counts.shape[1] + 1))
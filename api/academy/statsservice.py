@@ -0,0 +1,473 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Local web service answering statistics queries from memory.
+
+The stored games, the per player counts and the ratings of the served
+game types are loaded once into a ServiceData object. Requests are
+answered from it, and every answer is kept in that object, so asking
+again only costs a dict lookup.
+
+A background thread syncs new and changed games from the API every few
+minutes and rates the newly finished games. Loading the data never
+writes to the stored files. If anything changed, a new ServiceData is built next to the
+one in use and then swapped in, so readers never wait for a refresh
+and always see one consistent version of the data.
+
+Endpoints:
+    /status                      Version and age of the data
+    /players/<name>              Counts, ratings and games of a player,
+                                 any name the player used works
+    /races                       Counts and ratings of all races
+    /games/<id>                  A game and everyone who played in it
+    /ratings/player              Rating tables by game type
+    /ratings/race
+    /csv/game_stats.csv          The reports analyse_csv.py writes
+    /csv/player_stats.csv
+    /csv/race_matchups.csv
+    /csv/head_to_head.csv
+"""
+
+import io
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote
+
+import analyse_csv
+import apiaccess as aa
+import datastore
+import identity
+import matchups
+import ratings
+import statsengine as se
+from constants import ACADEMY, GAME_TYPES, RACES
+from metrics import METRICS
+
+
+PORT = 8000
+# Seconds between two syncs with the API
+REFRESH_SECONDS = 600
+# Size of the answers kept in memory, the least recently used go first
+RESPONSE_CACHE_BYTES = 64 * 2 ** 20
+
+
+class ServiceData:
+    """One version of everything the service answers from
+
+    Built by load_data() and not changed afterwards, except for the
+    answers kept in `responses`, see cached() and keep().
+
+    Attributes:
+        version (int): Increases with every refresh that changed data
+        loaded (float): Time the data was loaded
+        gametypes (list): Game types the data covers
+        datasets (dict): model.Dataset by game type
+        aliases (dict): Canonical player names by every name seen
+        shard_names (dict): {game type: {canonical name: name in the
+            dataset}}, players are named by account ID over all game
+            types, see analyse_csv.read_shard()
+        rows (list): Game overview rows, oldest game first
+        names (list): Player names in the order of `counts`
+        counts (np.ndarray): Merged players x races x endstates counts
+        player_rows (dict): Index into `counts` by player name
+        ratings (dict): {kind: {game type name: {entity: (rating, games)}}}
+        tables (dict): {kind: {game type name: rating table rows}}
+        game_players (dict): (game type, name in the dataset, canonical
+            name) of the players by game ID
+        matrix (np.ndarray): Race matchups, see matchups.race_matrix()
+        pairs (dict): Head-to-head counts, see matchups.merge_matchups()
+        responses (OrderedDict): Answers given so far by path, least
+            recently used first, at most RESPONSE_CACHE_BYTES of bodies
+    """
+
+    def __init__(self, gametypes, version):
+        self.version = version
+        self.loaded = time.time()
+        self.gametypes = list(gametypes)
+        self.datasets = {}
+        self.aliases = {}
+        self.shard_names = {}
+        self.rows = []
+        self.names = []
+        self.counts = None
+        self.player_rows = {}
+        self.ratings = {ratings.PLAYER: {}, ratings.RACE: {}}
+        self.tables = {ratings.PLAYER: {}, ratings.RACE: {}}
+        self.game_players = {}
+        self.matrix = None
+        self.pairs = {}
+        self.responses = OrderedDict()
+        self._response_bytes = 0
+        self._lock = threading.Lock()
+
+    def cached(self, path):
+        """Return the kept answer for a path or None"""
+        with self._lock:
+            response = self.responses.get(path)
+            if response is not None:
+                self.responses.move_to_end(path)
+            return response
+
+    def keep(self, path, response):
+        """Keep an answer, dropping the least recently used ones over the limit"""
+        with self._lock:
+            old = self.responses.pop(path, None)
+            if old is not None:
+                self._response_bytes -= len(old[2])
+            self.responses[path] = response
+            self._response_bytes += len(response[2])
+            while self._response_bytes > RESPONSE_CACHE_BYTES and len(self.responses) > 1:
+                _, (_, _, body) = self.responses.popitem(last=False)
+                self._response_bytes -= len(body)
+
+
+def load_data(gametypes, version=0):
+    """Load the stored data of some game types
+
+    Nothing is written to the stored files, ratings are served as they
+    were last updated, see analyse_csv.rate_shard().
+
+    Args:
+        gametypes (list): Game types to load, see constants.GAME_TYPES
+        version (int, optional): Version number of the data
+
+    Returns:
+        ServiceData
+    """
+    data = ServiceData(gametypes, version)
+    parts = []
+    matches = []
+    shared = identity.IdentityIndex()
+    for gametype in gametypes:
+        with METRICS.timer('load'):
+            dataset = aa.load_offline(gametype)
+        shard = analyse_csv.read_shard(gametype, shared, dataset)
+        if shard is None:
+            continue
+        data.datasets[gametype] = dataset
+        rows, counts, tables, shard_matches, names = shard
+        data.shard_names[gametype] = {name: player for player, name in names.items()}
+        data.rows += rows
+        parts.append(counts)
+        matches.append(shard_matches)
+        typename = GAME_TYPES[gametype]
+        for kind, table in (tables or {}).items():
+            data.tables[kind][typename] = table
+            data.ratings[kind][typename] = {entity: (rating, games) for entity, rating, games in table}
+
+        for player, gameid, _ in dataset.participations():
+            name = names.get(player.name, player.name)
+            data.game_players.setdefault(gameid, []).append((gametype, player.name, name))
+            data.aliases.setdefault(name, set()).add(name)
+            data.aliases.setdefault(player.name, set()).add(name)
+        db_file = aa.shard_file(aa.DB_FILE, gametype)
+        if os.path.exists(db_file):
+            conn = datastore.connect(db_file)
+            index = datastore.load_identity(conn)
+            conn.close()
+            for alias in index.aliases:
+                data.aliases.setdefault(alias, set()).update(
+                    names.get(name, name) for name in index.lookup(alias))
+
+    data.rows.sort(key=lambda row: row['datecreated'])
+    with METRICS.timer('player stats'):
+        data.names, data.counts = se.merge_counts(parts)
+    data.player_rows = {name: i for i, name in enumerate(data.names)}
+    with METRICS.timer('matchups'):
+        data.matrix, data.pairs = matchups.merge_matchups(matches)
+    return data
+
+
+def _endstates(counts, races):
+    """Turn a races x endstates array into {race: {endstate: count}}"""
+    return {RACES[race]: dict(zip(se.ENDSTATES, counts[race - 1].tolist())) for race in races}
+
+
+def player_answer(data, name):
+    """Return everything known about a player, or None
+
+    Names the player used in other games are resolved to the name the
+    player is stored under. If several players used the name, a list of
+    their canonical names is returned instead.
+    """
+    names = sorted(data.aliases.get(name, ()))
+    if len(names) > 1:
+        return {'name': name, 'players': names}
+    if not names:
+        return None
+    name = names[0]
+    answer = {'name': name, 'accountid': None,
+              'aliases': sorted(alias for alias, owners in data.aliases.items()
+                                if name in owners and alias != name),
+              'ratings': {typename: dict(zip(('rating', 'games'), table[name]))
+                          for typename, table in data.ratings[ratings.PLAYER].items()
+                          if name in table},
+              'stats': {}, 'games': []}
+    row = data.player_rows.get(name)
+    if row is not None:
+        races = se.report_races(data.gametypes)
+        answer['stats'] = {race: counts for race, counts in
+                           _endstates(data.counts[row], races).items() if any(counts.values())}
+    for gametype, dataset in data.datasets.items():
+        player = dataset.players.get(data.shard_names[gametype].get(name))
+        if player is None:
+            continue
+        answer['accountid'] = player.accountid
+        for gameid, part in sorted(player.games.items()):
+            game = dict(part.to_dict(), id=gameid, type=GAME_TYPES[gametype])
+            game['name'] = dataset.games[gameid].name
+            answer['games'].append(game)
+    return answer
+
+
+def races_answer(data):
+    """Return the counts and ratings of all races"""
+    races = se.report_races(data.gametypes)
+    totals = _endstates(data.counts.sum(axis=0), races) if len(data.names) else {}
+    return [{'race': RACES[race], 'stats': totals.get(RACES[race], {}),
+             'ratings': {typename: dict(zip(('rating', 'games'), table[RACES[race]]))
+                         for typename, table in data.ratings[ratings.RACE].items()
+                         if RACES[race] in table}}
+            for race in races]
+
+
+def game_answer(data, gameid):
+    """Return a game and the participations of all its players, or None"""
+    for gametype, dataset in data.datasets.items():
+        game = dataset.games.get(gameid)
+        if game is None:
+            continue
+        answer = dict(game.to_dict(), type=GAME_TYPES[gametype], players=[])
+        for _, player, name in data.game_players.get(gameid, ()):
+            part = dataset.players[player].games[gameid]
+            answer['players'].append(dict(part.to_dict(), name=name))
+        return answer
+    return None
+
+
+def csv_answer(data, filename):
+    """Return the text of one of the CSV reports, or None"""
+    csvfile = io.StringIO(newline='')
+    if filename == 'game_stats.csv':
+        analyse_csv.game_csv(csvfile, data.rows)
+    elif filename == 'player_stats.csv':
+        races = se.report_races(data.gametypes)
+        table = se.stats_table(data.counts, races).tolist()
+        analyse_csv.stats_csv(csvfile, data.names, table, races)
+    elif filename == 'race_matchups.csv':
+        rows = matchups.matchup_rows(data.matrix, se.report_races(data.gametypes))
+        analyse_csv.matchup_csv(csvfile, rows)
+    elif filename == 'head_to_head.csv':
+        analyse_csv.head_to_head_csv(csvfile, matchups.head_to_head_rows(data.pairs))
+    else:
+        return None
+    return csvfile.getvalue()
+
+
+def answer(data, path):
+    """Answer a request
+
+    Args:
+        data (ServiceData): Data to answer from
+        path (str): Path of the request, without the query
+
+    Returns:
+        tuple: (HTTP status, content type, body) or None if there is
+            nothing at this path
+    """
+    parts = [unquote(part) for part in path.strip('/').split('/')]
+    body = None
+    if parts[0] == 'players' and len(parts) == 2:
+        body = player_answer(data, parts[1])
+    elif parts == ['races']:
+        body = races_answer(data)
+    elif parts[0] == 'games' and len(parts) == 2 and parts[1].isdigit():
+        body = game_answer(data, int(parts[1]))
+    elif parts[0] == 'ratings' and len(parts) == 2 and parts[1] in data.tables:
+        body = {typename: [{'name': name, 'rating': round(rating, 1), 'games': games}
+                           for name, rating, games in table]
+                for typename, table in data.tables[parts[1]].items()}
+    elif parts[0] == 'csv' and len(parts) == 2:
+        text = csv_answer(data, parts[1])
+        if text is not None:
+            return 200, 'text/csv; charset=utf-8', text.encode('utf-8')
+    if body is None:
+        return None
+    return 200, 'application/json', json.dumps(body).encode('utf-8')
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path.strip('/') == 'status':
+            response = 200, 'application/json', json.dumps(self.server.status()).encode('utf-8')
+        else:
+            data = self.server.data
+            response = data.cached(path)
+            if response is None:
+                with METRICS.timer('service answer'):
+                    response = answer(data, path)
+                if response is None:
+                    self.send_error(404)
+                    return
+                data.keep(path, response)
+            else:
+                METRICS.count('service cache hits')
+        status, content_type, body = response
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StatsService(ThreadingHTTPServer):
+    """HTTP server answering statistics queries from warm data
+
+    Args:
+        gametypes (list, optional): Game types to serve, default Academy
+        port (int, optional): Port to listen on, 0 picks a free one
+        refresh (float, optional): Seconds between two syncs
+        offline (bool, optional): Never ask the API, only reload the data
+            when the stored files changed
+        workers (int, optional): Maximum number of games fetched in parallel
+        use_cache (bool, optional): Keep API responses in the local cache
+
+    Attributes:
+        base (str): URL of the service
+        data (ServiceData): Data currently served
+    """
+    daemon_threads = True
+
+    def __init__(self, gametypes=None, port=PORT, refresh=REFRESH_SECONDS, offline=False,
+                 workers=aa.FETCH_WORKERS, use_cache=True):
+        super().__init__(('127.0.0.1', port), StatsHandler)
+        self.gametypes = gametypes or [ACADEMY]
+        self.refresh_seconds = refresh
+        self.offline = offline
+        self.workers = workers
+        self.use_cache = use_cache
+        self.data = None
+        self.refreshed = None
+        self.last_error = None
+        self._mtimes = None
+        self._stopped = threading.Event()
+        self.base = 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+    def _stored_mtimes(self):
+        mtimes = []
+        for gametype in self.gametypes:
+            for filename in (aa.DB_FILE, aa.SNAPSHOT_FILE):
+                try:
+                    mtimes.append(os.path.getmtime(aa.shard_file(filename, gametype)))
+                except OSError:
+                    mtimes.append(None)
+        return mtimes
+
+    def reload(self):
+        """Load the stored data and serve it from now on"""
+        version = 0 if self.data is None else self.data.version + 1
+        data = load_data(self.gametypes, version)
+        self._mtimes = self._stored_mtimes()
+        self.data = data
+
+    def refresh(self):
+        """Sync and rate the served game types, reload the data if anything changed
+
+        Returns:
+            bool: True if new data is served
+        """
+        changed = False
+        if not self.offline:
+            for gametype in self.gametypes:
+                if aa.sync_games(self.workers, self.use_cache, gametype, verbose=False):
+                    changed = True
+                # Also rates games synced by another process
+                if analyse_csv.rate_shard(gametype):
+                    changed = True
+        self.refreshed = time.time()
+        # The store may also have been updated by another process
+        if changed or self._stored_mtimes() != self._mtimes:
+            self.reload()
+            return True
+        return False
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as e:
+                # Keep serving the data we have
+                self.last_error = '{}: {}'.format(type(e).__name__, e)
+                print('Refresh failed: ' + self.last_error)
+            if self._stopped.wait(self.refresh_seconds):
+                return
+
+    def status(self):
+        data = self.data
+        return {'version': data.version, 'loaded': data.loaded, 'refreshed': self.refreshed,
+                'gametypes': [GAME_TYPES[gametype] for gametype in data.gametypes],
+                'games': sum(len(d.games) for d in data.datasets.values()),
+                'players': len(data.names), 'cached answers': len(data.responses),
+                'last error': self.last_error}
+
+    def start(self):
+        """Load the stored data, then serve and refresh in background threads"""
+        self.reload()
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve game and player statistics over HTTP')
+    parser.add_argument('-t', '--type', dest='types', action='append', type=aa.game_type,
+                        help='game type to serve, can be given several times (default: academy)')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--refresh', type=float, default=REFRESH_SECONDS,
+                        help='seconds between two syncs with the API (default: %(default)s)')
+    parser.add_argument('--offline', action='store_true',
+                        help='do not ask the API, only pick up changes of the stored data')
+    parser.add_argument('-w', '--workers', type=int, default=aa.FETCH_WORKERS,
+                        help='maximum number of games to fetch in parallel (default: %(default)s)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='do not keep API responses in the local cache')
+    args = parser.parse_args()
+
+    service = StatsService(args.types, args.port, args.refresh, args.offline, args.workers, args.cache)
+    service.start()
+    print('Serving {} statistics at {}'.format(
+        ', '.join(GAME_TYPES[t] for t in service.gametypes), service.base))
+    try:
+        service._stopped.wait()
+    except KeyboardInterrupt:
+        service.stop()
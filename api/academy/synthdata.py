@@ -0,0 +1,234 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Synthetic game data for benchmarks and offline testing.
+
+Builds payloads shaped like the answers of games/list, game/loadevents,
+game/loadinfo and game/loadturn: seven race slots per Academy game and
+eleven slots with shuffled races for other game types, 'has joined'
+events (type 3) with '+' encoded names, players resigning (type 8) or
+being dropped (type 10) and replaced, dead slots (type 7), final ranks
+for finished games and scores that grow turn by turn towards the final
+score. See standin.py for serving them over HTTP."""
+
+import random
+
+from datetime import datetime, timedelta
+
+from constants import RACES, SCORE_KEYS, ACADEMY, API_RACES
+
+
+STATUS_RUNNING, STATUS_FINISHED, STATUS_ONHOLD = 2, 3, 4
+DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+NO_DATE = '1/1/0001 12:00:00 AM'
+FIRST_GAME_ID = 200000
+# Number of early test games at the start of the list
+TEST_GAMES = 3
+
+
+def api_date(date):
+    # Same format as the API, without leading zeros
+    return '{d.month}/{d.day}/{d.year} {h}:{d:%M:%S %p}'.format(d=date, h=date.hour % 12 or 12)
+
+
+class SyntheticAPI:
+    """Generated API payloads, keyed like the real endpoints
+
+    Attributes:
+        games (list): Game objects as returned by games/list
+        events (dict): game/loadevents answer by integer game ID
+        info (dict): game/loadinfo answer by integer game ID
+    """
+
+    def __init__(self, nplayers=500, churn=0.2, seed=0):
+        self.random = random.Random(seed)
+        self.churn = churn
+        self.names = ['{} {}'.format(self.random.choice(['Admiral', 'Captain', 'Commander', 'Ensign', 'Lord']), i)
+                      if i % 4 == 0 else 'player{}'.format(i) for i in range(nplayers)]
+        self.accounts = {name: 1000 + i for i, name in enumerate(self.names)}
+        self.games = []
+        self.events = {}
+        self.info = {}
+        self.start = datetime(2017, 1, 1)
+
+    def add_games(self, count, finished=0.7, onhold=0.05, gametype=ACADEMY):
+        """Add new games
+
+        Args:
+            count (int): Number of games to add
+            finished (float, optional): Share of finished games
+            onhold (float, optional): Share of games on hold, the rest is running
+            gametype (int, optional): Game type, see constants.GAME_TYPES
+        """
+        for _ in range(count):
+            gameid = FIRST_GAME_ID + len(self.games)
+            roll = self.random.random()
+            if roll < finished:
+                status = STATUS_FINISHED
+            elif roll < finished + onhold:
+                status = STATUS_ONHOLD
+            else:
+                status = STATUS_RUNNING
+            created = self.start + timedelta(hours=7 * len(self.games), seconds=self.random.randint(0, 3600))
+            turn = self.random.randint(20, 100) if status == STATUS_FINISHED else self.random.randint(1, 60)
+            test = gametype == ACADEMY and len(self.games) < TEST_GAMES
+            game = {
+                'id': gameid,
+                'name': 'Academy Sector {}'.format(len(self.games) + 1),
+                'shortdescription': 'Test Game' if test else 'Academy Game',
+                'description': 'A synthetic Academy game for local testing. ' * 4,
+                'status': status,
+                'gametype': gametype,
+                'datecreated': api_date(created),
+                'dateended': NO_DATE,
+                'turn': turn,
+                'winner': 0,
+                'slots': 7 if gametype == ACADEMY else len(API_RACES),
+            }
+            self.games.append(game)
+            self._play(game)
+
+    def finish_games(self, count):
+        """Finish some running or on hold games and advance others
+
+        Args:
+            count (int): Number of unfinished games to finish
+        """
+        open_games = [g for g in self.games if g['status'] != STATUS_FINISHED]
+        for game in self.random.sample(open_games, min(count, len(open_games))):
+            game['status'] = STATUS_FINISHED
+            game['turn'] += self.random.randint(1, 30)
+            self._play(game)
+
+    def _play(self, game):
+        rnd = self.random
+        gameid = game['id']
+        turn = game['turn']
+        events = [{'eventtype': 1, 'playerid': 0, 'accountid': 0, 'turn': 0,
+                   'description': 'Game created'}]
+        if turn > 1:
+            events.append({'eventtype': 2, 'playerid': 0, 'accountid': 0, 'turn': 1,
+                           'description': 'Game started'})
+        players = []
+        if game['gametype'] == ACADEMY:
+            raceids = list(range(1, 8))
+        else:
+            raceids = list(API_RACES)
+            rnd.shuffle(raceids)
+        nslots = len(raceids)
+        seats = rnd.sample(self.names, nslots + int(nslots * self.churn) + 1)
+        spare = seats[nslots:]
+        for slot, raceid in enumerate(raceids, 1):
+            if game['gametype'] == ACADEMY:
+                race = RACES[slot]
+            else:
+                race = RACES[API_RACES[raceid]]
+            name = seats[slot - 1]
+            events.append(self._joined(name, slot, 0))
+            username = name.lower()
+            if spare and turn > 2 and rnd.random() < self.churn:
+                left = rnd.randint(2, turn)
+                if rnd.random() < 0.5:
+                    text = '{} has resigned from the {}'.format(name.replace(' ', '+'), race)
+                    events.append(self._event(8, name, slot, left, text))
+                else:
+                    text = '{} has been dropped from the {}'.format(name.replace(' ', '+'), race)
+                    events.append(self._event(10, name, slot, left, text))
+                if rnd.random() < 0.8:
+                    name = spare.pop()
+                    events.append(self._joined(name, slot, left))
+                    username = name.lower()
+                else:
+                    username = 'open'
+            if username != 'open' and turn > 10 and rnd.random() < 0.15:
+                text = 'The {} in slot {} are now dead'.format(race, slot)
+                events.append(self._event(7, name, slot, rnd.randint(10, turn), text))
+                username = 'dead'
+            score = {k: rnd.randint(0, 200) for k in SCORE_KEYS}
+            score['percent'] = round(rnd.random() * 40, 2)
+            score.update({'turn': turn, 'id': rnd.randint(1, 10 ** 6), 'ownerid': slot,
+                          'inventoryscore': rnd.randint(0, 10 ** 5), 'prioritypoints': 0})
+            players.append({'id': slot, 'username': username, 'raceid': raceid,
+                            'finishrank': 0, 'score': score})
+        if game['status'] == STATUS_FINISHED:
+            ranks = list(range(1, nslots + 1))
+            rnd.shuffle(ranks)
+            for player, rank in zip(players, ranks):
+                player['finishrank'] = rank
+            ended = datetime.strptime(game['datecreated'], DATE_FORMAT) + timedelta(days=turn)
+            game['dateended'] = api_date(ended)
+            winner = min(players, key=lambda p: p['finishrank'])
+            game['winner'] = winner['id']
+        rnd.shuffle(events)
+        self.events[gameid] = {'events': events}
+        self.info[gameid] = {'game': dict(game), 'players': players}
+
+    def _joined(self, name, slot, turn):
+        text = '{} has joined the game in slot {}'.format(name.replace(' ', '+'), slot)
+        return self._event(3, name, slot, turn, text)
+
+    def _event(self, eventtype, name, slot, turn, text):
+        return {'eventtype': eventtype, 'playerid': slot, 'accountid': self.accounts[name],
+                'turn': turn, 'description': text}
+
+    def load_turn(self, gameid, turn):
+        """Answer of game/loadturn, None for turns that were not played yet
+
+        The scores of every slot grow towards its final score with some
+        noise, the same turn always gives the same scores.
+        """
+        info = self.info.get(gameid)
+        if info is None or not 1 <= turn <= info['game']['turn']:
+            return None
+        rnd = random.Random(gameid * 1000 + turn)
+        share = (turn / info['game']['turn']) ** 1.5
+        scores = []
+        for player in info['players']:
+            final = player['score']
+            score = {k: max(0, round(final[k] * share) + rnd.randint(-2, 2)) for k in SCORE_KEYS}
+            score['percent'] = round(final['percent'] * share, 2)
+            score.update({'turn': turn, 'ownerid': player['id'], 'accountid': 0,
+                          'inventoryscore': rnd.randint(0, 10 ** 5), 'prioritypoints': 0})
+            scores.append(score)
+        planets = [{'id': i, 'name': 'Planet {}'.format(i), 'x': rnd.randint(1000, 3000),
+                    'y': rnd.randint(1000, 3000), 'ownerid': rnd.randint(0, len(scores))}
+                   for i in range(1, 51)]
+        return {'success': True, 'rst': {'game': dict(info['game'], turn=turn),
+                                          'planets': planets, 'scores': scores}}
+
+    def games_list(self, statuses=None, limit=0, gametype=None):
+        """Answer of games/list, optionally filtered by status and type and limited"""
+        games = [g for g in self.games if (statuses is None or g['status'] in statuses)
+                 and (gametype is None or g['gametype'] == gametype)]
+        if limit:
+            games = games[:limit]
+        return games
+
+
+def generate(ngames=200, nplayers=500, churn=0.2, seed=0):
+    """Build a synthetic Academy data set
+
+    Args:
+        ngames (int, optional): Number of games
+        nplayers (int, optional): Size of the player population
+        churn (float, optional): Chance for every slot that its player
+            resigns or is dropped during the game
+        seed (int, optional): Random seed, equal seeds give equal data
+
+    Returns:
+        SyntheticAPI
+    """
+    api = SyntheticAPI(nplayers, churn, seed)
+    api.add_games(ngames)
+    return api
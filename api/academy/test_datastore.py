@@ -0,0 +1,215 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Regression tests of the incremental updates of the data store.
+
+Most tests sync synthetic games from a stand-in server into a fresh
+directory, see synthdata.py and standin.py. Run with
+```python -m unittest test_datastore``` or ```python -m pytest```."""
+
+import io
+import os
+import csv
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+import analyse_csv
+import apiaccess as aa
+import datastore
+import identity
+import ratings
+import standin
+import synthdata
+from constants import ACADEMY
+
+
+AGGREGATE_TABLES = ['player_counts', 'race_matchups', 'head_to_head', 'game_index']
+STANDARD = 2
+
+
+class SyncTestCase(unittest.TestCase):
+    """Serves synthetic games and runs every test in its own directory"""
+
+    def setUp(self):
+        self.api = synthdata.generate(60, 40, 0.3, seed=9)
+        self.server = standin.StandinServer(self.api).start()
+        self.old_base, self.old_cwd = aa.BASE, os.getcwd()
+        self.workdir = tempfile.TemporaryDirectory()
+        aa.BASE = self.server.base
+        aa.CACHE = None
+        aa._SESSION = None
+        aa._SCHEDULER = None
+        os.chdir(self.workdir.name)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        aa.BASE = self.old_base
+        aa.CACHE = None
+        aa._SESSION = None
+        aa._SCHEDULER = None
+        self.server.stop()
+        self.workdir.cleanup()
+
+    def sync(self, gametype=ACADEMY):
+        with redirect_stdout(io.StringIO()):
+            self.assertIsNotNone(aa.sync_games(4, False, gametype))
+
+    def sync_changes(self, rounds=3):
+        """Sync, then let games start and finish between further syncs"""
+        self.sync()
+        for _ in range(rounds):
+            self.api.add_games(10)
+            self.api.finish_games(20)
+            self.sync()
+
+    def rename(self, index, name):
+        """Give the account of a synthetic player a new display name"""
+        self.api.accounts[name] = self.api.accounts[self.api.names[index]]
+        self.api.names[index] = name
+
+
+def aggregates(conn):
+    return {table: sorted(conn.execute('SELECT * FROM ' + table)) for table in AGGREGATE_TABLES}
+
+
+class TestAggregates(SyncTestCase):
+
+    def test_incremental_equals_rebuild(self):
+        self.sync_changes()
+        conn = datastore.connect()
+        incremental = aggregates(conn)
+        datastore.rebuild_aggregates(conn)
+        self.assertEqual(incremental, aggregates(conn))
+        conn.close()
+
+
+class TestRatings(SyncTestCase):
+
+    def test_incremental_equals_rerate(self):
+        self.sync()
+        for _ in range(3):
+            conn = datastore.connect()
+            ratings.update_ratings(conn)
+            conn.close()
+            self.api.add_games(10)
+            self.api.finish_games(20)
+            self.sync()
+        conn = datastore.connect()
+        ratings.update_ratings(conn)
+        incremental = {kind: ratings.rating_table(conn, kind) for kind in (ratings.PLAYER, ratings.RACE)}
+        ratings.update_ratings(conn, True)
+        for kind, table in incremental.items():
+            full = ratings.rating_table(conn, kind)
+            self.assertEqual([(entity, games) for entity, _, games in table],
+                             [(entity, games) for entity, _, games in full])
+            for (_, rating, _), (_, expected, _) in zip(table, full):
+                self.assertAlmostEqual(rating, expected, places=6)
+        conn.close()
+
+    def test_current_ratings_migrated(self):
+        self.sync()
+        conn = datastore.connect()
+        ratings.update_ratings(conn)
+        current = datastore.load_ratings(conn)
+        conn.execute("DELETE FROM meta WHERE key = 'ratings'")
+        conn.execute('DELETE FROM current_ratings')
+        conn.commit()
+        conn.close()
+        conn = datastore.connect()
+        self.assertEqual(current, datastore.load_ratings(conn))
+        conn.close()
+
+
+class TestIdentity(SyncTestCase):
+
+    def test_renamed_account_is_one_player(self):
+        self.sync()
+        self.rename(5, 'Renamed Guy')
+        self.api.add_games(20)
+        self.sync()
+        conn = datastore.connect()
+        names = {name: accountid for name, accountid in datastore.load_accounts(conn)}
+        self.assertIn('player5', names)
+        self.assertNotIn('Renamed Guy', names)
+        self.assertEqual(datastore.load_identity(conn).lookup('Renamed Guy'), ['player5'])
+        incremental = aggregates(conn)
+        datastore.rebuild_aggregates(conn)
+        self.assertEqual(incremental, aggregates(conn))
+        conn.close()
+
+    def test_shards_merge_by_account(self):
+        self.rename(5, 'Renamed Guy')
+        self.api.add_games(40, gametype=STANDARD)
+        # Another account takes over a name used in the Academy games
+        self.api.accounts['player10'] = 9999
+        self.api.add_games(40, gametype=STANDARD)
+        self.sync()
+        self.sync(STANDARD)
+        with redirect_stdout(io.StringIO()):
+            analyse_csv.write_reports([ACADEMY, STANDARD], offline=True)
+        with open('player_stats.csv', newline='') as csvfile:
+            names = [row[0] for row in csv.reader(csvfile)]
+        self.assertIn('player5', names)
+        self.assertNotIn('Renamed Guy', names)
+        self.assertIn('player10', names)
+        self.assertIn('player10 #9999', names)
+        self.assertEqual(len(names), len(set(names)))
+
+    def test_unknown_account_stays_apart(self):
+        self.sync()
+        # Events of later games name the player without account ID
+        self.api.accounts['player7'] = 0
+        self.api.add_games(30)
+        self.sync()
+        conn = datastore.connect()
+        accounts = dict(datastore.load_accounts(conn))
+        self.assertEqual(accounts['player7'], 1007)
+        self.assertIsNone(accounts['player7 #0'])
+        self.assertEqual(datastore.load_identity(conn).resolve(0, 'player7'), 'player7 #0')
+        conn.close()
+
+
+class TestApplyGame(unittest.TestCase):
+
+    SLOTS = [(1, False, 20, {'rank': 1}), (2, True, 20, {'rank': 2})]
+
+    def test_dead_without_account(self):
+        players = {}
+        actions = [('joined', 0, 'Anonymous', 0, 1, 'Fed'), ('joined', 1002, 'Known', 0, 2, 'Lizard'),
+                   ('dead', 0, None, 15, 1, None)]
+        aa.apply_game(players, 1, (actions, self.SLOTS))
+        self.assertEqual(sorted(players), ['Anonymous', 'Known'])
+        self.assertIn({'what': 'dead', 'when': 15}, players['Anonymous'][1]['status'])
+
+    def test_dead_of_unknown_slot_skipped(self):
+        players = {}
+        actions = [('joined', 1001, 'Known', 0, 1, 'Fed'), ('joined', 1002, 'Other', 0, 2, 'Lizard'),
+                   ('dead', 0, None, 15, 3, None)]
+        with redirect_stdout(io.StringIO()) as out:
+            aa.apply_game(players, 1, (actions, self.SLOTS))
+        self.assertEqual(sorted(players), ['Known', 'Other'])
+        self.assertIn('skipped', out.getvalue())
+
+    def test_name_without_account_not_merged(self):
+        index = identity.IdentityIndex()
+        self.assertEqual(index.resolve(1001, 'Bob'), 'Bob')
+        self.assertEqual(index.resolve(0, 'Bob'), 'Bob #0')
+        self.assertEqual(index.resolve(0, 'Alice'), 'Alice')
+        self.assertEqual(index.resolve(0, 'Alice'), 'Alice')
+        self.assertEqual(index.resolve(1002, 'Alice'), 'Alice #1002')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# Copyright 2018 Markus Hoff-Holtmanns
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Regression tests of the streaming JSON decoder.
+
+Documents are cut into chunks of 1 to 16 bytes, so every token shorter
+than that is split at every possible position."""
+
+import json
+import unittest
+
+import jsonstream
+
+
+ITEMS = [
+    {'id': 1, 'name': 'Captain 4', 'percent': 12.75, 'dead': False, 'notes': None},
+    {'id': -2, 'name': 'qu"ote \\ back\\slash', 'list': [1e10, -0.5, [], {}]},
+    'brackets ]}[{ in a string',
+    'ünicode € \U0001f600',
+    '',
+    12345678901234567890,
+    [[1, 2], {'a': [3, {'b': 'c'}]}],
+    True,
+]
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestIterItems(unittest.TestCase):
+
+    def assertChunked(self, document, key, expected):
+        for ensure_ascii in (True, False):
+            data = json.dumps(document, ensure_ascii=ensure_ascii).encode()
+            for size in list(range(1, 17)) + [len(data)]:
+                with self.subTest(ensure_ascii=ensure_ascii, size=size):
+                    self.assertEqual(list(jsonstream.iter_items(chunked(data, size), key)), expected)
+
+    def test_top_level_array(self):
+        self.assertChunked(ITEMS, None, ITEMS)
+
+    def test_nested_key(self):
+        document = {'skipped': ITEMS, 'rst': {'other': {'scores': 0}, 'scores': ITEMS, 'after': ITEMS},
+                    'tail': 'x'}
+        self.assertChunked(document, ['rst', 'scores'], ITEMS)
+
+    def test_scalars_before_key(self):
+        document = {'n': 3.25, 'flag': True, 'none': None, 's': 'scores', 'scores': [0.5, 7, -1]}
+        self.assertChunked(document, 'scores', [0.5, 7, -1])
+
+    def test_empty_array(self):
+        self.assertChunked({'scores': []}, 'scores', [])
+
+    def test_missing_key(self):
+        with self.assertRaises(KeyError):
+            list(jsonstream.iter_items([b'{"a": [1], "b": {"scores": []}}'], 'scores'))
+
+
+if __name__ == '__main__':
+    unittest.main()